@@ -56,7 +56,6 @@ setup(
         'opencv-contrib-python',
         'face_recognition',
         'imutils',
-        'schedule',
         'flask',
         'Flask-SocketIO',
         'gooey',
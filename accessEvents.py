@@ -0,0 +1,278 @@
+'''
+Structured log of the access decisions (one JSON object per line), written by
+a background thread so the decision path never waits on the disk.
+
+Each event has the time of the decision, the card ID, the CWID of the card
+(if any), the decision ('granted', 'refused' or 'cancelled', when the
+recognition was preempted by another swipe), the reason of a refusal, the
+latency of the recognition and the number of distinct faces seen. The writer:
+    - batches the events waiting, so a burst is written at once.
+    - syncs the file to disk after each batch ('batch'), at most every few
+      seconds ('interval') or never, leaving it to the OS ('never').
+    - rotates the file when it exceeds a size or when the day changes. The old
+      segments are renamed with the time of the rotation (e.g.
+      'accesslog-20190625-000001.jsonl') and compressed with gzip.
+    - passes each batch to the sinks (e.g. the store of events, see
+      accessStore). The events of a sink that fails are passed again with
+      the next batch (or after a few seconds), so they aren't lost.
+
+Usage example:
+    logger = accessEvents.AccessLogger("accesslog.jsonl")
+    logger.log(accessEvents.event("1234", "123456789", accessEvents.GRANTED))
+    logger.close()
+'''
+
+# Import the necessary packages
+from datetime import date, datetime
+import glob
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import metrics
+
+
+# Decisions
+GRANTED = "granted"
+REFUSED = "refused"
+CANCELLED = "cancelled"     # The recognition was preempted by another swipe
+
+# Policies to sync the log to disk
+FSYNC_BATCH = "batch"           # After each batch written
+FSYNC_INTERVAL = "interval"     # At most every `fsync_interval` seconds
+FSYNC_NEVER = "never"           # Left to the OS
+FSYNC_POLICIES = (FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_NEVER)
+
+# Metrics of the log (served by faceSec on '/metrics')
+events_logged = metrics.counter("facesec_access_events_logged_total",
+    "Access events written to the access log")
+events_dropped = metrics.counter("facesec_access_events_dropped_total",
+    "Access events discarded because the queue of the access log was full")
+sink_events_dropped = metrics.counter(
+    "facesec_access_sink_events_dropped_total",
+    "Access events not passed to a sink that kept failing")
+
+
+def event(card, CWID, decision, reason="", latency=None, faces=None,
+    timestamp=None):
+    '''
+    Build the record of an access decision.
+
+    :param `card`: ID of the card swiped.\n
+    :param `CWID`: CWID of the owner of the card (`None` if the card isn't
+    accepted).\n
+    :param `decision`: either `'granted'`, `'refused'` or `'cancelled'`.\n
+    :param `reason`: reason of a refusal or cancellation (default: `''`).\n
+    :param `latency`: seconds taken by the recognition (default: `None`,
+    there wasn't a recognition).\n
+    :param `faces`: number of distinct faces seen during the recognition
+    (default: `None`).\n
+    :param `timestamp`: time of the decision, in seconds since the epoch
+    (default: `None`, now).\n
+    :return The event `dictionary`.
+    '''
+    timestamp = time.time() if timestamp is None else timestamp
+    return {"timestamp": datetime.fromtimestamp(timestamp).isoformat(
+        timespec="milliseconds"), "card": card, "CWID": CWID,
+        "decision": decision, "reason": reason,
+        "latency": None if latency is None else round(latency, 3),
+        "faces": faces}
+
+
+def compress(path):
+    '''
+    Compress a segment of the log with gzip (to `path + '.gz'`), and remove
+    the original.
+    '''
+    with open(path, "rb") as source, gzip.open(path + ".gz", "wb") as target:
+        shutil.copyfileobj(source, target)
+    os.remove(path)
+
+
+class AccessLogger(object):
+    '''
+    Creates an AccessLogger object, with its own writer thread.
+
+    :param `path`: path to the log (default: `'accesslog.jsonl'`).\n
+    :param `batch_size`: max number of events written at once (default:
+    `64`).\n
+    :param `fsync`: policy to sync the log to disk: `'batch'`, `'interval'`
+    or `'never'` (default: `'batch'`).\n
+    :param `fsync_interval`: min number of seconds between two syncs with
+    the `'interval'` policy (default: `5`).\n
+    :param `max_bytes`: size of the log that triggers a rotation (default:
+    16 MB, `0` to only rotate daily).\n
+    :param `daily`: whether or not to rotate the log when the day changes
+    (default: `True`).\n
+    :param `max_queue`: max number of events waiting to be written; the new
+    events are discarded when it is full (default: `10000`).\n
+    :param `sinks`: functions called from the writer thread with each batch
+    of events written, e.g. to insert them in the store of events (see
+    accessStore). If a sink raises, its events are passed again (up to
+    `max_queue` of them) with the next batch, so it must skip the events
+    already passed (default: `None`).\n
+    '''
+
+    def __init__(self, path="accesslog.jsonl", batch_size=64, fsync="batch",
+        fsync_interval=5.0, max_bytes=16 * 2**20, daily=True,
+        max_queue=10000, sinks=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("[ERROR] unknown fsync policy '%s'" % fsync)
+        self.path = path
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.daily = daily
+        self.sinks = list(sinks or [])
+        self.max_queue = max_queue
+        # Events not passed yet to each sink (because it failed)
+        self.pending = [[] for sink in self.sinks]
+        self.queue = queue.Queue(max_queue)
+        self.file = None
+        self.day = None         # Day of the events of the current segment
+        self.last_sync = 0.0
+        self.dirty = False      # Whether or not there is data not synced
+        self._thread = threading.Thread(name="AccessLogger", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, record):
+        '''
+        Queue an event to be written, without waiting.
+
+        :param `record`: the event dictionary (see `event`).\n
+        :return Whether or not the event was queued.
+        '''
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            events_dropped.inc()
+            return False
+
+    def close(self, timeout=5):
+        '''
+        Write the events waiting, sync and close the log.
+        '''
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout)
+
+    def _open(self):
+        # Open the current segment, compressing the segments left
+        # uncompressed by a previous run
+        (root, ext) = os.path.splitext(self.path)
+        for segment in glob.glob(glob.escape(root) + "-*" + ext):
+            compress(segment)
+        self.file = open(self.path, "a")
+        self.day = date.fromtimestamp(os.path.getmtime(self.path)) \
+            if self.file.tell() else date.today()
+
+    def _rotate(self):
+        # Close the current segment, rename it with the time of the rotation
+        # and compress it
+        self._sync(True)
+        self.file.close()
+        (root, ext) = os.path.splitext(self.path)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        segment = "%s-%s%s" % (root, stamp, ext)
+        count = 1
+        while os.path.exists(segment + ".gz"):
+            # Several rotations in the same second
+            segment = "%s-%s.%s%s" % (root, stamp, count, ext)
+            count += 1
+        os.replace(self.path, segment)
+        compress(segment)
+        self.file = open(self.path, "a")
+        self.day = date.today()
+
+    def _sync(self, force=False):
+        # Sync the log to disk, following the policy
+        if not self.dirty:
+            return
+        self.file.flush()
+        now = time.monotonic()
+        if not force and self.fsync == FSYNC_INTERVAL and (now - self.last_sync
+            < self.fsync_interval):
+            return
+        if force or self.fsync != FSYNC_NEVER:
+            os.fsync(self.file.fileno())
+        self.last_sync = now
+        self.dirty = False
+
+    def _write(self, batch):
+        # Write a batch of events, rotating the log first if needed
+        if (self.daily and date.today() != self.day) or (self.max_bytes
+            and self.file.tell() >= self.max_bytes):
+            self._rotate()
+        self.file.write("".join(json.dumps(record) + "\n"
+            for record in batch))
+        self.dirty = True
+        self._sync()
+        events_logged.inc(len(batch))
+        self._pass(batch)
+
+    def _pass(self, batch=()):
+        # Pass a batch of events to the sinks, with the events of the previous
+        # batches that a sink failed to take. The oldest ones are dropped when
+        # there are more than `max_queue` waiting
+        for (i, sink) in enumerate(self.sinks):
+            records = self.pending[i] + list(batch)
+            if not records:
+                continue
+            try:
+                sink(records)
+                self.pending[i] = []
+            except Exception as e:
+                print("[ERROR] unable to pass %s events to %s (will retry): "
+                    % (len(records), getattr(sink, "__qualname__", sink))
+                    + "%s" % e)
+                if len(records) > self.max_queue:
+                    sink_events_dropped.inc(len(records) - self.max_queue)
+                    records = records[-self.max_queue:]
+                self.pending[i] = records
+
+    def _run(self):
+        # Writer: wait for an event, then write it with the ones waiting
+        try:
+            self._open()
+        except (IOError, OSError) as e:
+            print("[ERROR] unable to open the access log '%s': %s"
+                % (self.path, e))
+            return
+        closed = False
+        while not closed:
+            try:
+                # With data not synced yet, or events a sink failed to take,
+                # wake up to sync it in time (or retry the sink)
+                record = self.queue.get(timeout=self.fsync_interval
+                    if self.dirty or any(self.pending) else None)
+            except queue.Empty:
+                self._sync()
+                self._pass()
+                continue
+            batch = []
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            closed = record is None
+            try:
+                if batch:
+                    self._write(batch)
+            except (IOError, OSError) as e:
+                print("[ERROR] unable to write %s events to the access log: "
+                    % len(batch) + "%s" % e)
+        # Last try for the events a sink failed to take (the ones left are
+        # still in the log, see accessStore.backfill)
+        self._pass()
+        self._sync(True)
+        self.file.close()
@@ -0,0 +1,397 @@
+'''
+Queryable store of the access events (see accessEvents), in an embedded
+SQLite database indexed on the time, the card and the CWID, so the questions
+like "all the accesses of card X last month" or "refusals per hour" don't need
+to scan the whole access log.
+
+The store is fed by the writer thread of the access log (each batch of events
+is inserted in one transaction), and queried by the admin endpoints of
+faceSec. Each thread uses its own connection, and the database is in WAL mode
+so the queries don't block the inserts.
+
+Besides the events, the store keeps the number of events per hour, decision
+and reason (updated with each insert), so the aggregates over long periods
+only read a few rows per hour instead of all the events.
+
+The events already logged (the current access log, its compressed segments
+and the legacy text log 'accesslog.txt') can be imported with `backfill`. An
+event is only stored once (by its time, card and decision), so the imports
+and the batches replayed by the writer of the log never add duplicates.
+
+This module can also be runned as an independent script, to import the logs
+into the store.
+
+Usage example:
+    store = accessStore.AccessStore("access.db")
+    store.add([accessEvents.event("1234", "123456789", accessEvents.GRANTED)])
+    page = store.events(card="1234", start=accessStore.parse_time(
+        "2019-06-01"))
+    counts = store.counts("hour", decision=accessEvents.REFUSED)
+'''
+
+# Import the necessary packages
+from datetime import datetime
+from argparse import RawTextHelpFormatter
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+# Time buckets of the aggregates, as SQLite strftime formats
+BUCKETS = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "month": "%Y-%m"}
+HOUR = BUCKETS["hour"]
+# Columns the aggregates can be grouped by (besides the time bucket)
+GROUPS = ("decision", "reason", "card", "CWID")
+MAX_PAGE = 500      # Max number of events of a page
+BACKFILL_BATCH = 1000   # Number of events imported per transaction
+
+# Line of the legacy text log, e.g. "Access refused on: 2019-06-25
+# 10:51:22.890024 for card ID '1234' (no face detection)"
+LEGACY_LINE = re.compile(r"Access (granted|refused) on: (.+?) for card ID "
+    r"'(.*)'(?: \((.*)\))?\s*$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    card TEXT,
+    CWID TEXT,
+    decision TEXT NOT NULL,
+    reason TEXT,
+    latency REAL,
+    faces INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_card ON events (card, time);
+CREATE INDEX IF NOT EXISTS events_CWID ON events (CWID, time);
+CREATE UNIQUE INDEX IF NOT EXISTS events_key ON events (time, card, decision);
+CREATE TABLE IF NOT EXISTS hourly (
+    hour TEXT NOT NULL,
+    decision TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (hour, decision, reason)
+);
+CREATE TABLE IF NOT EXISTS imported (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+"""
+
+COLUMNS = ("id", "time", "card", "CWID", "decision", "reason", "latency",
+    "faces")
+
+
+def parse_time(text):
+    '''
+    Parse a date or date and time (ISO 8601, local time), e.g. `'2019-06-25'`
+    or `'2019-06-25T13:45:00.123'`.
+
+    :param `text`: the date (and time).\n
+    :return The time, in `seconds` since the epoch.
+    '''
+    for format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+        "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d",
+        "%Y-%m"):
+        try:
+            moment = datetime.strptime(text, format)
+        except ValueError:
+            continue
+        return time.mktime(moment.timetuple()) + moment.microsecond / 1e6
+    raise ValueError("invalid date '%s'" % text)
+
+
+def read_log(path):
+    '''
+    Read the events of a segment of the access log (see accessEvents),
+    compressed with gzip or not. The lines that can't be parsed (e.g. the
+    last one of a segment cut by a crash) are skipped.
+
+    :param `path`: path to the segment.\n
+    :return The `list` of event dictionaries.
+    '''
+    records = []
+    with (gzip.open(path, "rt") if path.endswith(".gz")
+        else open(path)) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+                parse_time(record["timestamp"])
+                record["decision"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            records.append(record)
+    return records
+
+
+def read_legacy(path):
+    '''
+    Read the events of the legacy text log (`'accesslog.txt'`). It doesn't
+    have the CWID, the latency nor the number of faces.
+
+    :param `path`: path to the text log.\n
+    :return The `list` of event dictionaries.
+    '''
+    records = []
+    with open(path) as file:
+        for line in file:
+            match = LEGACY_LINE.match(line)
+            if match is None:
+                continue
+            (decision, moment, card, reason) = match.groups()
+            try:
+                # Written with `datetime.now()`, e.g. '2019-06-25
+                # 10:51:22.890024'
+                timestamp = parse_time(moment.replace(" ", "T"))
+            except ValueError:
+                continue
+            records.append({"timestamp": datetime.fromtimestamp(
+                timestamp).isoformat(timespec="milliseconds"), "card": card,
+                "CWID": None, "decision": decision, "reason": reason or ""})
+    return records
+
+
+def _filters(start, end, card, CWID, decision):
+    # WHERE clause (and its parameters) of the filters given
+    clauses = []
+    params = []
+    for (clause, value) in (("time >= ?", start), ("time < ?", end),
+        ("card = ?", card), ("CWID = ?", CWID), ("decision = ?", decision)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def _on_hour(moment):
+    # Whether or not a time (if any) is at the start of an hour (local time)
+    return moment is None or (moment % 60 == 0
+        and time.localtime(moment).tm_min == 0)
+
+
+class AccessStore(object):
+    '''
+    Creates an AccessStore object, creating the database if needed.
+
+    :param `path`: path to the SQLite database (default: `'access.db'`).\n
+    '''
+
+    def __init__(self, path="access.db"):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def _connection(self):
+        # Connection of the current thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def add(self, records):
+        '''
+        Insert a batch of access events (see `accessEvents.event`), in one
+        transaction. The events already stored are skipped.
+
+        :param `records`: list of event dictionaries.\n
+        :return The number of `events` inserted.
+        '''
+        rows = [(parse_time(record["timestamp"]), record.get("card"),
+            record.get("CWID"), record["decision"], record.get("reason", ""),
+            record.get("latency"), record.get("faces"))
+            for record in records]
+        hours = {}
+        inserted = 0
+        with self._connection() as connection:
+            for row in rows:
+                cursor = connection.execute("INSERT OR IGNORE INTO events "
+                    +"(time, card, CWID, decision, reason, latency, faces) "
+                    +"VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+                if cursor.rowcount != 1:
+                    continue
+                inserted += 1
+                key = (time.strftime(HOUR, time.localtime(row[0])), row[3],
+                    row[4] or "")
+                hours[key] = hours.get(key, 0) + 1
+            connection.executemany("INSERT OR IGNORE INTO hourly VALUES "
+                +"(?, ?, ?, 0)", list(hours))
+            connection.executemany("UPDATE hourly SET count = count + ? WHERE "
+                +"hour = ? AND decision = ? AND reason = ?",
+                [(count,) + key for (key, count) in hours.items()])
+        return inserted
+
+    def backfill(self, path="accesslog.jsonl", legacy="accesslog.txt"):
+        '''
+        Import the events already logged: the legacy text log, the segments
+        of the access log (compressed or not) and the current log, in order.
+        The files already imported, and not changed since, are skipped.
+
+        :param `path`: path to the access log (default:
+        `'accesslog.jsonl'`).\n
+        :param `legacy`: path to the legacy text log (default:
+        `'accesslog.txt'`, `None` to skip it).\n
+        :return The number of `files` read and of `events` inserted.
+        '''
+        (root, ext) = os.path.splitext(path)
+        # The segments are named after the time of their rotation
+        segments = sorted(glob.glob(glob.escape(root) + "-*" + ext)
+            + glob.glob(glob.escape(root) + "-*" + ext + ".gz"))
+        files = ([legacy] if legacy else []) + segments + [path]
+        connection = self._connection()
+        read = inserted = 0
+        for file in files:
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                continue
+            row = connection.execute("SELECT size FROM imported WHERE "
+                +"path = ?", (os.path.abspath(file),)).fetchone()
+            if row is not None and row["size"] == size:
+                continue
+            records = read_legacy(file) if file == legacy else read_log(file)
+            for start in range(0, len(records), BACKFILL_BATCH):
+                inserted += self.add(records[start:start + BACKFILL_BATCH])
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO imported VALUES "
+                    +"(?, ?)", (os.path.abspath(file), size))
+            read += 1
+        print("[INFO] access store backfilled: %s files read, " % read
+            + "%s events inserted" % inserted)
+        return read, inserted
+
+    def events(self, start=None, end=None, card=None, CWID=None,
+        decision=None, limit=50, cursor=None):
+        '''
+        Page of the access events matching the filters, the most recent
+        first.
+
+        :param `start`, `end`: range of times, in seconds since the epoch
+        (default: `None`, unbounded).\n
+        :param `card`, `CWID`, `decision`: values of the events (default:
+        `None`, any).\n
+        :param `limit`: max number of events of the page (default: `50`, at
+        most `MAX_PAGE`).\n
+        :param `cursor`: cursor of the page, as returned with the previous
+        one (default: `None`, first page).\n
+        :return A `dictionary` with the `events` of the page (dictionaries,
+        with the time as ISO 8601 local time) and the `cursor` of the next
+        page (`None` if it is the last one).
+        '''
+        limit = max(1, min(int(limit), MAX_PAGE))
+        (where, params) = _filters(start, end, card, CWID, decision)
+        if cursor:
+            # Keyset pagination: the events older than the last one of the
+            # previous page
+            try:
+                (last_time, last_id) = cursor.split(":")
+                (last_time, last_id) = (float(last_time), int(last_id))
+            except ValueError:
+                raise ValueError("invalid cursor '%s'" % cursor)
+            where += (" AND " if where else " WHERE ") \
+                + "(time < ? OR (time = ? AND id < ?))"
+            params += [last_time, last_time, last_id]
+        rows = self._connection().execute("SELECT %s FROM events%s ORDER BY "
+            % (", ".join(COLUMNS), where) + "time DESC, id DESC LIMIT ?",
+            params + [limit + 1]).fetchall()
+        events = []
+        for row in rows[:limit]:
+            event = dict(zip(COLUMNS, row))
+            event["timestamp"] = datetime.fromtimestamp(
+                event.pop("time")).isoformat(timespec="milliseconds")
+            events.append(event)
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = "%r:%s" % (rows[limit - 1]["time"],
+                rows[limit - 1]["id"])
+        return {"events": events, "cursor": next_cursor}
+
+    def counts(self, bucket="day", by="decision", start=None, end=None,
+        card=None, CWID=None, decision=None):
+        '''
+        Number of access events per time bucket and value of a column.
+
+        :param `bucket`: time bucket: `'hour'`, `'day'` or `'month'`
+        (default: `'day'`).\n
+        :param `by`: column the events are counted by: `'decision'`,
+        `'reason'`, `'card'` or `'CWID'` (default: `'decision'`).\n
+        :param `start`, `end`, `card`, `CWID`, `decision`: filters (see
+        `events`).\n
+        :return The `list` of buckets, in order, each one a dictionary with
+        the `bucket` (local time) and the `counts` of each value.
+        '''
+        if bucket not in BUCKETS:
+            raise ValueError("unknown bucket '%s'" % bucket)
+        if by not in GROUPS:
+            raise ValueError("unknown column '%s'" % by)
+        if card is None and CWID is None and by in ("decision", "reason") \
+            and _on_hour(start) and _on_hour(end):
+            # Aggregate the hourly counts (the buckets are prefixes of the
+            # hours)
+            (where, params) = _filters(None, None, None, None, decision)
+            for (clause, value) in (("hour >= ?", start), ("hour < ?", end)):
+                if value is not None:
+                    where += (" AND " if where else " WHERE ") + clause
+                    params.append(time.strftime(HOUR, time.localtime(value)))
+            rows = self._connection().execute("SELECT substr(hour, 1, ?) AS "
+                +"bucket, %s, SUM(count) FROM hourly%s GROUP BY bucket, %s "
+                % (by, where, by) + "ORDER BY bucket",
+                [len(time.strftime(BUCKETS[bucket]))] + params).fetchall()
+        else:
+            (where, params) = _filters(start, end, card, CWID, decision)
+            rows = self._connection().execute("SELECT strftime(?, time, "
+                +"'unixepoch', 'localtime') AS bucket, %s, COUNT(*) FROM "
+                % by + "events%s GROUP BY bucket, %s ORDER BY bucket"
+                % (where, by), [BUCKETS[bucket]] + params).fetchall()
+        buckets = []
+        for (name, value, count) in rows:
+            if not buckets or buckets[-1]["bucket"] != name:
+                buckets.append({"bucket": name, "counts": {}})
+            buckets[-1]["counts"][value if value is not None else ""] = count
+        return buckets
+
+    def close(self):
+        '''
+        Close the connection of the current thread.
+        '''
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def argParser():
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    ap.add_argument("-d", "--db", type=str, default="access.db",
+        help="path to the SQLite database of the access events"+
+        "\ndefault: 'access.db'")
+    ap.add_argument("-l", "--log", type=str, default="accesslog.jsonl",
+        help="path to the access log (its segments are imported too)"+
+        "\ndefault: 'accesslog.jsonl'")
+    ap.add_argument("-t", "--legacy", type=str, default="accesslog.txt",
+        help="path to the legacy text log ('' to skip it)"+
+        "\ndefault: 'accesslog.txt'")
+    global args
+    args = vars(ap.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    # Call the argument parser function
+    argParser()
+
+    # Import the logs into the store
+    store = AccessStore(args["db"])
+    (read, inserted) = store.backfill(args["log"], args["legacy"] or None)
+    store.close()
+    print("[FINISHED] %s events imported from %s files" % (inserted, read))
@@ -0,0 +1,278 @@
+'''
+Benchmark of the matching step against galleries of growing size.
+
+Synthetic galleries of 128-d encodings (grouped in identities, like the real
+ones) and query sets (faces of known identities and of impostors) are
+generated, and each matcher is timed on the same queries. For each gallery
+size it reports the latency percentiles of matching the faces of a frame, the
+memory allocated to build the matcher (besides the gallery), the load time of
+the gallery (from a pickle file and from a store of encodings), and the
+agreement of the names with the legacy matcher. The results are written as
+JSON, to track regressions.
+
+Matchers:
+    - legacy: `compare_faces` of each face against the whole gallery, and a
+      Python loop counting the votes (the original matching of faceRecon).
+    - faceMatch: the vectorized matcher of faceMatch (`FaceMatcher`).
+    - faceIndex: the same matcher with the approximate index of faceIndex
+      (its build time is included), probing `--nprobe` lists per face.
+Other matchers can be compared by adding them to `MATCHERS`.
+
+Usage examples:
+    python benchGallery.py
+    python benchGallery.py --sizes 1000,10000,100000,1000000 --queries 200 \
+--output gallery.json
+    python benchGallery.py --sizes 100000,500000 \
+--matchers faceMatch,faceIndex --nprobe 16
+Default params are '--sizes 1000,10000,100000 --queries 100 --faces 1 \
+--matchers legacy,faceMatch'
+'''
+
+# Import the necessary packages
+from argparse import RawTextHelpFormatter
+import argparse
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import encodingStore
+import faceIndex
+import faceMatch
+
+
+TOLERANCE = 0.55        # Max distance between two encodings to be a match
+
+
+class LegacyMatcher(object):
+    '''
+    Creates a LegacyMatcher object, matching as faceRecon originally did:
+    `face_recognition.compare_faces` of each face against the list of known
+    encodings, and a loop counting the matches of each name.
+
+    :param `encodings`: list of known encodings.\n
+    :param `names`: list with the name of each encoding.\n
+    '''
+
+    def __init__(self, encodings, names):
+        self.encodings = list(np.asarray(encodings, dtype=np.float64))
+        self.names = list(names)
+
+    def identify(self, queries, tolerance=TOLERANCE):
+        names = []
+        for encoding in queries:
+            # Same as face_recognition.compare_faces
+            matches = list(np.linalg.norm(np.array(self.encodings) - encoding,
+                axis=1) <= tolerance)
+            name = "Unknown"
+            if True in matches:
+                matchedIdxs = [i for (i, b) in enumerate(matches) if b]
+                counts = {}
+                for i in matchedIdxs:
+                    counts[self.names[i]] = counts.get(self.names[i], 0) + 1
+                name = max(counts, key=counts.get)
+            names.append(name)
+        return names
+
+
+def IndexedMatcher(encodings, names):
+    # FaceMatcher with the approximate index of the gallery
+    return faceMatch.FaceMatcher(encodings, names,
+        index=faceIndex.build(encodings), nprobe=args["nprobe"])
+
+
+# Matchers to compare: name -> function building the matcher from the
+# encodings and names of the gallery (the matcher has an `identify` method)
+MATCHERS = {
+    "legacy": LegacyMatcher,
+    "faceMatch": faceMatch.FaceMatcher,
+    "faceIndex": IndexedMatcher,
+}
+
+
+def make_gallery(size, per_identity=5, seed=0):
+    '''
+    Generate a synthetic gallery of encodings.
+
+    :param `size`: number of encodings.\n
+    :param `per_identity`: number of encodings of each identity (default:
+    `5`).\n
+    :param `seed`: seed of the random encodings (default: `0`).\n
+    :return The `encodings` (size x 128 float32 matrix), the `names` of the
+    encodings and the `centers` of the identities.
+    '''
+    random = np.random.RandomState(seed)
+    n_identities = (size + per_identity - 1) // per_identity
+    # The distance between two identities is about 1, and between two
+    # encodings of the same identity about 0.4 (as with dlib's encodings)
+    centers = random.normal(scale=1 / np.sqrt(2 * 128),
+        size=(n_identities, 128)).astype(np.float32)
+    identity = np.arange(size) // per_identity
+    encodings = centers[identity] + random.normal(scale=0.2 / np.sqrt(128),
+        size=(size, 128)).astype(np.float32)
+    names = ["%09d_Synthetic_%s" % (i, i) for i in identity]
+    return encodings, names, centers
+
+
+def make_queries(centers, count, faces=1, seed=1):
+    '''
+    Generate the synthetic queries: frames with faces of known identities
+    (half of them) and of impostors.
+
+    :param `centers`: centers of the identities of the gallery.\n
+    :param `count`: number of frames.\n
+    :param `faces`: number of faces on each frame (default: `1`).\n
+    :return The list of `frames`, each one a faces x 128 float32 matrix.
+    '''
+    random = np.random.RandomState(seed)
+    frames = []
+    for index in range(count):
+        if index % 2 == 0:
+            base = centers[random.randint(len(centers), size=faces)]
+        else:
+            base = random.normal(scale=1 / np.sqrt(2 * 128),
+                size=(faces, 128))
+        frames.append((base + random.normal(scale=0.2 / np.sqrt(128),
+            size=(faces, 128))).astype(np.float32))
+    return frames
+
+
+def time_load(encodings, names, folder):
+    '''
+    Time the load of a gallery from a pickle file (the original format) and
+    from a store of encodings (including the build of the FaceMatcher).
+
+    :return A `dictionary` with the load times, in seconds, and the file
+    sizes, in bytes.
+    '''
+    pickle_path = os.path.join(folder, "encodings.pickle")
+    store_path = os.path.join(folder, "encodings.bin")
+    with open(pickle_path, "wb") as file:
+        file.write(pickle.dumps({"encodings": list(encodings.astype(
+            np.float64)), "names": names}))
+    encodingStore.save(store_path, encodings, names)
+
+    start = time.perf_counter()
+    with open(pickle_path, "rb") as file:
+        pickle.loads(file.read())
+    pickle_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = encodingStore.load(store_path)
+    faceMatch.FaceMatcher.from_store(store)
+    store_seconds = time.perf_counter() - start
+    store.close()
+    return {"pickle_seconds": pickle_seconds, "store_seconds": store_seconds,
+        "pickle_bytes": os.path.getsize(pickle_path),
+        "store_bytes": os.path.getsize(store_path)}
+
+
+def time_matcher(build, encodings, names, frames, reference=None):
+    '''
+    Build a matcher and time the matching of each frame.
+
+    :param `build`: function building the matcher.\n
+    :param `encodings`, `names`: the gallery.\n
+    :param `frames`: list of frames of query encodings.\n
+    :param `reference`: names found by the reference matcher, to compute the
+    agreement (default: `None`).\n
+    :return A `dictionary` with the results, and the `names` found.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    matcher = build(encodings, names)
+    build_seconds = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    latencies = []
+    found = []
+    for frame in frames:
+        start = time.perf_counter()
+        found.append(matcher.identify(frame, tolerance=TOLERANCE))
+        latencies.append(time.perf_counter() - start)
+    latencies = 1000 * np.array(latencies)
+    result = {"build_seconds": build_seconds, "memory_bytes": memory,
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99))}
+    if reference is not None:
+        same = sum(a == b for (frame_a, frame_b) in zip(found, reference)
+            for (a, b) in zip(frame_a, frame_b))
+        result["agreement"] = same / float(sum(len(f) for f in reference))
+    return result, found
+
+
+def argParser():
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    ap.add_argument("-s", "--sizes", type=str, default="1000,10000,100000",
+        help="comma-separated number of encodings of the galleries"+
+        "\ndefault: '1000,10000,100000'")
+    ap.add_argument("-q", "--queries", type=int, default=100,
+        help="number of query frames\ndefault: '100'")
+    ap.add_argument("-f", "--faces", type=int, default=1,
+        help="number of faces on each query frame\ndefault: '1'")
+    ap.add_argument("-m", "--matchers", type=str, default="legacy,faceMatch",
+        help="comma-separated matchers to compare (the first one is the "+
+        "reference of the agreement)\ndefault: 'legacy,faceMatch'")
+    ap.add_argument("-l", "--legacy-max", type=int, default=100000,
+        help="max gallery size timed with the legacy matcher (it is slow and "+
+        "needs a lot of memory)\ndefault: '100000'")
+    ap.add_argument("-p", "--nprobe", type=int, default=8,
+        help="number of lists probed per face by the 'faceIndex' matcher"+
+        "\ndefault: '8'")
+    ap.add_argument("-o", "--output", type=str, default="",
+        help="output path to the JSON file of results\ndefault: '' (not "+
+        "saved)")
+    global args
+    args = vars(ap.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    # Call the argument parser function
+    argParser()
+
+    results = []
+    folder = tempfile.mkdtemp(prefix="faceSec-bench-")
+    try:
+        for size in [int(size) for size in args["sizes"].split(",")]:
+            print("[INFO] gallery of %s encodings" % size)
+            encodings, names, centers = make_gallery(size)
+            frames = make_queries(centers, args["queries"], args["faces"])
+            result = {"size": size, "queries": args["queries"],
+                "faces": args["faces"], "load": time_load(encodings, names,
+                folder), "matchers": {}}
+            print("  load: pickle %.3fs, store %.3fs" % (
+                result["load"]["pickle_seconds"],
+                result["load"]["store_seconds"]))
+            reference = None
+            for name in args["matchers"].split(","):
+                if name == "legacy" and size > args["legacy_max"]:
+                    print("  %-10s skipped (gallery larger than %s)"
+                        % (name, args["legacy_max"]))
+                    continue
+                (timing, found) = time_matcher(MATCHERS[name], encodings,
+                    names, frames, reference)
+                if reference is None:
+                    reference = found
+                result["matchers"][name] = timing
+                print("  %-10s p50 %8.3fms  p95 %8.3fms  p99 %8.3fms  "
+                    % (name, timing["p50_ms"], timing["p95_ms"],
+                    timing["p99_ms"]) + "memory %6.1fMB  agreement %s" % (
+                    timing["memory_bytes"] / 1e6,
+                    "%.1f%%" % (100 * timing["agreement"])
+                    if "agreement" in timing else "-"))
+            results.append(result)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args["output"]:
+        with open(args["output"], "w") as file:
+            json.dump(results, file, indent=4)
+        print("[FINISHED] results saved to '%s'" % args["output"])
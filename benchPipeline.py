@@ -0,0 +1,273 @@
+'''
+End-to-end benchmark of the live recognition, without a camera: the frames
+are replayed from a video file, a folder of images or a synthetic source (see
+frameSource), and recognition sessions are driven through `accessControl`
+(as the web server does) or `faceRecon.main` (as the local mode does).
+
+For each face detection method and each size of the gallery of known
+encodings (the encodings of the store, padded with random synthetic
+identities), it reports the frames per second, the latency of each stage of
+the processing of a frame, the time to decision of the sessions and the CPU
+usage. With a replayed source at a fixed rate, the numbers are reproducible
+from one run to another.
+
+Usage examples:
+    python benchPipeline.py
+    python benchPipeline.py --source videos/door.mp4 --rate 15 \
+--methods hog,cnn --gallery-sizes 0,10000,100000 --cwid 123456789
+    python benchPipeline.py --source synthetic --faces \
+images/known_people/123456789_Name_Surname --output bench.json
+Default params are '--source synthetic --encodings encodings.bin \
+--methods hog --gallery-sizes 0 --sessions 5 --timeout 15'
+'''
+
+# Import the necessary packages
+from argparse import RawTextHelpFormatter
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+import encodingStore
+import faceDecision
+import faceRecon
+import frameSource
+import metrics
+
+
+def pad_gallery(store_path, size, output_path, per_identity=5, seed=0):
+    '''
+    Write a store of encodings with the encodings of another store, padded
+    with random synthetic identities up to the given number of encodings.
+
+    :param `store_path`: input path to the store of encodings.\n
+    :param `size`: total number of encodings of the output store (`0` to
+    keep the input store as it is).\n
+    :param `output_path`: output path to the padded store.\n
+    :param `per_identity`: number of encodings of each synthetic identity
+    (default: `5`).\n
+    :param `seed`: seed of the random encodings (default: `0`).\n
+    :return The number of `encodings` of the output store.
+    '''
+    store = encodingStore.load(store_path)
+    encodings = np.array(store.encodings, dtype=np.float32)
+    names = store.names
+    store.close()
+    missing = max(0, size - len(names))
+    if missing:
+        # Random encodings, with the norm of a real one, and similar within
+        # each identity
+        random = np.random.RandomState(seed)
+        n_identities = (missing + per_identity - 1) // per_identity
+        centers = random.normal(size=(n_identities, 128)).astype(np.float32)
+        identity = np.arange(missing) // per_identity
+        extra = centers[identity] + 0.3 * random.normal(
+            size=(missing, 128)).astype(np.float32)
+        extra /= np.linalg.norm(extra, axis=1, keepdims=True)
+        encodings = np.concatenate([encodings.reshape(-1, 128), extra])
+        names = names + ["9%08d_Synthetic_%s" % (i, i) for i in identity]
+    encodingStore.save(output_path, encodings, names)
+    return len(names)
+
+
+def open_source(args):
+    # Open the source of the frames of the benchmark
+    if args["source"] == "synthetic":
+        faces = []
+        if args["faces"]:
+            faces = [cv2.imread(os.path.join(args["faces"], name))
+                for name in sorted(os.listdir(args["faces"]))
+                if name.lower().endswith(frameSource.IMAGE_EXTENSIONS)]
+        return frameSource.SyntheticSource(faces=[face for face in faces
+            if face is not None], rate=args["rate"] or None)
+    return frameSource.open_source(args["source"], args["rate"] or None,
+        loop=True)
+
+
+def _snapshot():
+    # State of the metrics of the pipeline
+    return {"stages": dict((stage, histogram.snapshot()) for (stage, histogram)
+        in faceRecon.stage_seconds.items()),
+        "captured": faceRecon.frames_captured.value,
+        "processed": faceRecon.frames_processed.value,
+        "dropped": faceRecon.frames_dropped.value,
+        "skipped": faceRecon.frames_skipped.value}
+
+
+def _stages(before, after):
+    # Latency of each stage between two snapshots (in milliseconds)
+    stages = {}
+    for (stage, (counts, total, count)) in after["stages"].items():
+        (counts_0, total_0, count_0) = before["stages"][stage]
+        counts = [c - c0 for (c, c0) in zip(counts, counts_0)]
+        count -= count_0
+        if count == 0:
+            continue
+        buckets = faceRecon.stage_seconds[stage].buckets
+        stages[stage] = {"count": count,
+            "mean_ms": 1000 * (total - total_0) / count,
+            "p50_ms": 1000 * metrics.quantile(buckets, counts, 0.5),
+            "p95_ms": 1000 * metrics.quantile(buckets, counts, 0.95)}
+    return stages
+
+
+def run(args, method, gallery_path, gallery_size, unknown_path):
+    '''
+    Run the recognition sessions of one configuration.
+
+    :param `args`: the parsed arguments.\n
+    :param `method`: face detection method: either `'hog'` or `'cnn'`.\n
+    :param `gallery_path`: path to the store of encodings.\n
+    :param `gallery_size`: number of encodings of the store.\n
+    :param `unknown_path`: output path of the captures of unknown subjects.\n
+    :return A `dictionary` with the results.
+    '''
+    faceRecon.maxElapsedTime = args["timeout"]
+    videoCamera = None
+    if not args["local"]:
+        videoCamera = faceRecon.VideoCamera(unknown_path, gallery_path,
+            method, args["count_recon"], detect_every=args["detect_every"],
+            motion_sensitivity=args["motion_sensitivity"],
+            decision=faceDecision.load(args["decision"])
+                if args["sequential"] else None,
+            source=open_source(args))
+        videoCamera.start()
+
+    before = _snapshot()
+    start, cpu_start = time.monotonic(), time.process_time()
+    decisions = []
+    for session in range(args["sessions"]):
+        faceRecon.startup()
+        session_start = time.monotonic()
+        if args["local"]:
+            granted = faceRecon.main(gallery_path, 0, method,
+                args["count_recon"], args["cwid"] or None,
+                source=open_source(args))
+        else:
+            granted = faceRecon.accessControl(videoCamera,
+                args["cwid"] or None)
+        decisions.append({"seconds": time.monotonic() - session_start,
+            "granted": list(granted)})
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+    after = _snapshot()
+    if videoCamera is not None:
+        videoCamera.stop()
+
+    times = [decision["seconds"] for decision in decisions]
+    return {"method": method,
+        "gallery": gallery_size,
+        "sessions": len(decisions),
+        "granted": sum(1 for decision in decisions if decision["granted"]),
+        "decision_p50_s": float(np.percentile(times, 50)),
+        "decision_p95_s": float(np.percentile(times, 95)),
+        "fps_captured": (after["captured"] - before["captured"]) / elapsed,
+        "fps_processed": (after["processed"] - before["processed"]) / elapsed,
+        "frames_dropped": after["dropped"] - before["dropped"],
+        "frames_skipped": after["skipped"] - before["skipped"],
+        "cpu_percent": 100 * cpu / elapsed,
+        "stages": _stages(before, after),
+        "decisions": decisions}
+
+
+def report(result):
+    # Print the results of a configuration
+    print("\n[RESULT] %s, %s encodings: %s/%s sessions granted" % (
+        result["method"], result["gallery"], result["granted"],
+        result["sessions"]))
+    print("  time to decision: p50 %.2fs, p95 %.2fs" % (
+        result["decision_p50_s"], result["decision_p95_s"]))
+    print("  frames/s: %.1f captured, %.1f processed (%s dropped, %s "
+        % (result["fps_captured"], result["fps_processed"],
+        result["frames_dropped"], result["frames_skipped"])
+        + "skipped without motion)")
+    print("  CPU: %.0f%%" % result["cpu_percent"])
+    print("  %-10s %8s %10s %10s %10s" % ("stage", "count", "mean ms",
+        "p50 ms", "p95 ms"))
+    for (stage, latency) in result["stages"].items():
+        print("  %-10s %8s %10.2f %10.2f %10.2f" % (stage, latency["count"],
+            latency["mean_ms"], latency["p50_ms"], latency["p95_ms"]))
+
+
+def argParser():
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    ap.add_argument("-s", "--source", type=str, default="synthetic",
+        help="source of the frames: 'synthetic', path to a folder of images "+
+        "or path to a video file (replayed in a loop)\ndefault: 'synthetic'")
+    ap.add_argument("-f", "--faces", type=str, default="",
+        help="folder of face images pasted on the synthetic frames (e.g. the "+
+        "folder of a known subject)\ndefault: '' (no faces)")
+    ap.add_argument("-R", "--rate", type=float, default=15,
+        help="frames per second of the source ('0' for free-running)"+
+        "\ndefault: '15'")
+    ap.add_argument("-e", "--encodings", type=str, default="encodings.bin",
+        help="path to the store of encodings\ndefault: 'encodings.bin'")
+    ap.add_argument("-m", "--methods", type=str, default="hog",
+        help="comma-separated face detection methods to compare"+
+        "\ndefault: 'hog'")
+    ap.add_argument("-g", "--gallery-sizes", type=str, default="0",
+        help="comma-separated number of encodings of the gallery (padded "+
+        "with synthetic identities)\ndefault: '0' (the store as it is)")
+    ap.add_argument("-n", "--sessions", type=int, default=5,
+        help="number of recognition sessions of each configuration"+
+        "\ndefault: '5'")
+    ap.add_argument("-T", "--timeout", type=float, default=15,
+        help="max number of seconds of each session\ndefault: '15'")
+    ap.add_argument("-C", "--cwid", type=str, default="",
+        help="CWID of the swiped card (1:1 verification)\ndefault: '' "+
+        "(identification against the whole gallery)")
+    ap.add_argument("-c", "--count-recon", type=int, default=15,
+        help="number of times a subject must be recogised before granting "+
+        "access\ndefault: '15'")
+    ap.add_argument("-N", "--detect-every", type=int, default=1,
+        help="run the face detection every N frames\ndefault: '1'")
+    ap.add_argument("-M", "--motion-sensitivity", type=float, default=0,
+        help="min fraction of the pixels that must change for a frame to be "+
+        "processed\ndefault: '0' (process all the frames)")
+    ap.add_argument("-S", "--sequential", type=int, default=1,
+        help="whether or not to use the sequential decision (see "+
+        "faceDecision), besides the count of matches\ndefault: '1' (yes)")
+    ap.add_argument("-D", "--decision", type=str, default="decision.json",
+        help="path to the parameters of the sequential decision"+
+        "\ndefault: 'decision.json'")
+    ap.add_argument("-L", "--local", type=int, default=0,
+        help="whether or not to drive 'faceRecon.main' (local mode) instead "+
+        "of 'accessControl' (web server mode)\ndefault: '0' (no)")
+    ap.add_argument("-o", "--output", type=str, default="",
+        help="output path to the JSON file of results\ndefault: '' (not "+
+        "saved)")
+    global args
+    args = vars(ap.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    # Call the argument parser function
+    argParser()
+
+    # Run every configuration, with the galleries and the captures of unknown
+    # subjects in a temporary folder
+    folder = tempfile.mkdtemp(prefix="faceSec-bench-")
+    results = []
+    try:
+        for size in [int(size) for size in args["gallery_sizes"].split(",")]:
+            gallery_path = os.path.join(folder, "gallery-%s.bin" % size)
+            count = pad_gallery(args["encodings"], size, gallery_path)
+            for method in args["methods"].split(","):
+                print("[INFO] benchmarking %s with %s encodings..."
+                    % (method, count))
+                result = run(args, method, gallery_path, count,
+                    os.path.join(folder, "unknown"))
+                report(result)
+                results.append(result)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args["output"]:
+        with open(args["output"], "w") as file:
+            json.dump(results, file, indent=4)
+        print("\n[FINISHED] results saved to '%s'" % args["output"])
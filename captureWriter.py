@@ -0,0 +1,260 @@
+'''
+Background writer of the captures of unknown subjects, so the JPEG encoding
+and the writing of the frames (slow on SD cards) is kept off the recognition
+hot path.
+
+The frames are handed over through a bounded queue: once submitted, a frame
+belongs to the writer and must not be modified. When the queue is full the
+frame is dropped (and counted) instead of blocking the recognition.
+
+Only a padded crop of each unknown face is stored, and the captures nearly
+identical to one already stored in the session (by the distance of their
+facial encodings or, without encoding, by their perceptual hash) are skipped.
+The day folders older than some days are compacted into a ZIP archive (see
+`compact`).
+'''
+
+# Import the necessary packages
+from datetime import datetime, timedelta
+import os
+import queue
+import shutil
+import threading
+import zipfile
+import cv2
+import numpy as np
+import metrics
+
+
+# Metrics of the writer (served by faceSec on '/metrics')
+captures_written = metrics.counter("facesec_captures_written_total",
+    "Captures of unknown subjects written to disk")
+captures_dropped = metrics.counter("facesec_captures_dropped_total",
+    "Captures of unknown subjects dropped (queue of the writer full)")
+captures_failed = metrics.counter("facesec_captures_failed_total",
+    "Captures of unknown subjects that couldn't be encoded or written")
+write_seconds = metrics.histogram("facesec_capture_write_seconds",
+    "Latency of the encoding and writing of each capture")
+
+
+def crop(frame, box, padding=0.25):
+    '''
+    Crop a face from a frame, with some margin around it.
+
+    :param `frame`: the frame.\n
+    :param `box`: box of the face, as (top, right, bottom, left).\n
+    :param `padding`: margin added on each side, as a fraction of the size of
+    the face (default: `0.25`).\n
+    :return The `crop` of the frame (a view of it, not a copy).
+    '''
+    (top, right, bottom, left) = box
+    pad_y = int((bottom - top) * padding)
+    pad_x = int((right - left) * padding)
+    (height, width) = frame.shape[:2]
+    return frame[max(0, top - pad_y):min(height, bottom + pad_y),
+        max(0, left - pad_x):min(width, right + pad_x)]
+
+
+def dhash(image, size=8):
+    '''
+    Compute the difference hash of an image: whether each pixel of the
+    downsampled gray image is brighter than its left neighbour.
+
+    :param `image`: the BGR image.\n
+    :param `size`: size of the hash, in bits per side (default: `8`).\n
+    :return The `hash`, as an integer of `size` x `size` bits.
+    '''
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+class CaptureDeduplicator(object):
+    '''
+    Creates a CaptureDeduplicator object, remembering the captures stored
+    during a session to skip the near-duplicates.
+
+    :param `max_distance`: max distance between the facial encodings of two
+    captures to be duplicates (default: `0.2`).\n
+    :param `max_hamming`: max number of different bits between the hashes of
+    two captures to be duplicates, when there is no encoding (default:
+    `5`).\n
+    '''
+
+    def __init__(self, max_distance=0.2, max_hamming=5):
+        self.max_distance = max_distance
+        self.max_hamming = max_hamming
+        self.skipped = 0    # Number of duplicates skipped
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the captures stored (e.g. at the end of a recognition session).
+        The counter of duplicates is kept.
+        '''
+        self.encodings = []
+        self.hashes = []
+
+    def is_duplicate(self, encoding=None, image=None):
+        '''
+        Check whether or not a capture is a near-duplicate of one already
+        stored, and remember it if not.
+
+        :param `encoding`: facial encoding of the capture, if any (default:
+        `None`).\n
+        :param `image`: the BGR image of the capture (default: `None`).\n
+        :return `True` if the capture can be skipped.
+        '''
+        if encoding is not None:
+            encoding = np.asarray(encoding, dtype=np.float32)
+            if self.encodings and np.linalg.norm(np.array(self.encodings)
+                - encoding, axis=1).min() <= self.max_distance:
+                self.skipped += 1
+                return True
+            self.encodings.append(encoding)
+        if image is not None and image.size:
+            image_hash = dhash(image)
+            if encoding is None and any(bin(image_hash ^ other).count("1")
+                <= self.max_hamming for other in self.hashes):
+                self.skipped += 1
+                return True
+            self.hashes.append(image_hash)
+        return False
+
+
+class CaptureWriter(object):
+    '''
+    Creates a CaptureWriter object, with its own writer thread.
+
+    :param `max_queue`: max number of frames waiting to be written (default:
+    `32`).\n
+    '''
+
+    def __init__(self, max_queue=32):
+        self.queue = queue.Queue(max_queue)
+        self.written = 0        # Number of frames written
+        self.dropped = 0        # Number of frames dropped (queue full)
+        self.failed = 0         # Number of frames not written (errors)
+        self._folders = set()   # Folders already created (or existing)
+        self._thread = threading.Thread(name="CaptureWriter", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, folder, filename, frame):
+        '''
+        Queue a frame to be written, without waiting. The frame must not be
+        modified afterwards.
+
+        :param `folder`: folder of the capture (created if needed).\n
+        :param `filename`: file name of the capture (e.g. `'1.jpg'`).\n
+        :param `frame`: the BGR frame.\n
+        :return `True` if the frame was queued, `False` if it was dropped.
+        '''
+        try:
+            self.queue.put_nowait((folder, filename, frame))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            captures_dropped.inc()
+            print("[WARNING] capture writer busy, image %s dropped (%s "
+                % (filename, self.dropped) + "dropped so far)")
+            return False
+
+    def _makedirs(self, folder):
+        # Create the folder of a capture, only checking it once per folder
+        if folder in self._folders:
+            return
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+            print("[INFO] folder %s created" % folder)
+        self._folders.add(folder)
+
+    def _run(self):
+        # Write the queued frames until the writer is closed
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                (folder, filename, frame) = item
+                with metrics.Timer(write_seconds):
+                    self._makedirs(folder)
+                    # imwrite doesn't raise on most failures (e.g. disk
+                    # full), it only returns False
+                    if not cv2.imwrite(os.path.join(folder, filename), frame):
+                        raise IOError("the image couldn't be encoded or "
+                            + "written")
+                self.written += 1
+                captures_written.inc()
+            except Exception as error:
+                self.failed += 1
+                captures_failed.inc()
+                print("[ERROR] unable to write capture %s: %s"
+                    % (filename, error))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''
+        Wait until all the queued frames have been written.
+        '''
+        self.queue.join()
+
+    def close(self):
+        '''
+        Write the queued frames and stop the writer thread.
+        '''
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+
+def compact(path, keep_days=7, delete_days=0):
+    '''
+    Compact the day folders of captures older than `keep_days` into one ZIP
+    archive per day (e.g. '2019-06-25.zip'), and delete the archives older
+    than `delete_days`.
+
+    :param `path`: path to the folder of unknown subjects.\n
+    :param `keep_days`: number of days the folders are kept as they are
+    (default: `7`).\n
+    :param `delete_days`: number of days the archives are kept (default: `0`,
+    never deleted).\n
+    :return The number of `folders` compacted and of `archives` deleted.
+    '''
+    today = datetime.now().date()
+    compacted = deleted = 0
+    if not os.path.isdir(path):
+        return compacted, deleted
+    for entry in sorted(os.listdir(path)):
+        (day, extension) = os.path.splitext(entry)
+        try:
+            date = datetime.strptime(day, "%Y-%m-%d").date()
+        except ValueError:
+            # Not a day folder (or archive)
+            continue
+        entry_path = os.path.join(path, entry)
+        if extension == ".zip":
+            if delete_days > 0 and date < today - timedelta(days=delete_days):
+                os.remove(entry_path)
+                deleted += 1
+        elif (os.path.isdir(entry_path)
+            and date < today - timedelta(days=keep_days)):
+            # The images already archived (by a previous run interrupted
+            # before removing the folder) aren't added twice
+            with zipfile.ZipFile(entry_path + ".zip", "a",
+                zipfile.ZIP_STORED) as archive:
+                archived = set(archive.namelist())
+                for (root, _, files) in os.walk(entry_path):
+                    for file in sorted(files):
+                        file_path = os.path.join(root, file)
+                        name = os.path.relpath(file_path, path).replace(
+                            os.sep, "/")
+                        if name not in archived:
+                            archive.write(file_path, name)
+            shutil.rmtree(entry_path)
+            compacted += 1
+    print("[INFO] captures of unknown subjects: %s day folders compacted, "
+        % compacted + "%s archives deleted" % deleted)
+    return compacted, deleted
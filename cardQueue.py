@@ -0,0 +1,166 @@
+'''
+Ingestion queue of the card swipes received from the reader (see wiegand), so
+the thread handling the swipes blocks until there is one, instead of polling.
+
+The queue is bounded, and the repeated swipes of the same card within a short
+window are coalesced into the first one accepted (a swipe dropped or discarded
+doesn't start a window). The swipes received while a recognition session is in
+progress follow a policy:
+    - queue: the swipe waits for the end of the session.
+    - drop: the swipe is discarded.
+    - preempt: the session is cancelled, and the swipe is handled next (the
+      other waiting swipes are discarded).
+'''
+
+# Import the necessary packages
+import collections
+import threading
+import time
+import metrics
+
+
+# Policies for the swipes received during a recognition session
+QUEUE = "queue"
+DROP = "drop"
+PREEMPT = "preempt"
+POLICIES = (QUEUE, DROP, PREEMPT)
+
+# Result of the submission of a swipe
+QUEUED = "queued"           # The swipe waits to be handled
+DUPLICATE = "duplicate"     # Repeated swipe of the same card, coalesced
+DROPPED = "dropped"         # Received during a session, discarded
+FULL = "full"               # Queue full, discarded
+PREEMPTED = "preempted"     # The session in progress is cancelled for it
+
+# Metrics of the queue (served by faceSec on '/metrics')
+swipes_received = metrics.counter("facesec_swipes_received_total",
+    "Card swipes received from the reader")
+swipes_discarded = metrics.counter("facesec_swipes_discarded_total",
+    "Card swipes coalesced (duplicate) or discarded (dropped, full)")
+sessions_preempted = metrics.counter("facesec_sessions_preempted_total",
+    "Recognition sessions cancelled by a new card swipe")
+
+
+class SwipeEvent(object):
+    '''
+    Creates a SwipeEvent object, with the data of a card swipe.
+
+    :param `card`: string of bits of the card.\n
+    :param `facility_code`: facility code (FC) of the card (default: `''`).\n
+    :param `card_code`: card code (CC) of the card (default: `''`).\n
+    :param `timestamp`: time of the swipe, in seconds since the epoch
+    (default: `None`, now).\n
+    '''
+
+    def __init__(self, card, facility_code="", card_code="", timestamp=None):
+        self.card = card
+        self.facility_code = facility_code
+        self.card_code = card_code
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def __repr__(self):
+        return "SwipeEvent(card=%r, FC=%r, CC=%r)" % (self.card,
+            self.facility_code, self.card_code)
+
+
+class SwipeQueue(object):
+    '''
+    Creates a SwipeQueue object.
+
+    :param `max_size`: max number of swipes waiting (default: `8`).\n
+    :param `window`: number of seconds during which the repeated swipes of a
+    card are coalesced (default: `2`).\n
+    :param `policy`: policy for the swipes received during a recognition
+    session: `'queue'`, `'drop'` or `'preempt'` (default: `'queue'`).\n
+    :param `on_preempt`: function called when a swipe preempts the session
+    in progress, e.g. to wake it up (default: `None`).\n
+    '''
+
+    def __init__(self, max_size=8, window=2.0, policy=QUEUE, on_preempt=None):
+        if policy not in POLICIES:
+            raise ValueError("[ERROR] unknown swipe policy '%s'" % policy)
+        self.max_size = max_size
+        self.window = window
+        self.policy = policy
+        self.on_preempt = on_preempt
+        self.swipes = collections.deque()
+        self.condition = threading.Condition()
+        self.busy = False           # Whether or not a session is in progress
+        self.closed = False
+        self.last_swipe = {}        # Time of the last swipe of each card
+        # Set when the session in progress must be cancelled
+        self.preempted = threading.Event()
+
+    def put(self, event):
+        '''
+        Submit a swipe, without waiting.
+
+        :param `event`: the SwipeEvent object.\n
+        :return The `result`: `'queued'`, `'duplicate'`, `'dropped'`,
+        `'full'` or `'preempted'`.
+        '''
+        swipes_received.inc()
+        with self.condition:
+            # Coalesce the repeated swipes of the same card (the window
+            # starts at the first one accepted)
+            last = self.last_swipe.get(event.card)
+            if last is not None and 0 <= event.timestamp - last < self.window:
+                swipes_discarded.inc()
+                return DUPLICATE
+            for card in [card for (card, timestamp) in self.last_swipe.items()
+                if event.timestamp - timestamp >= self.window]:
+                del self.last_swipe[card]
+
+            result = QUEUED
+            if self.busy and self.policy == DROP:
+                swipes_discarded.inc()
+                return DROPPED
+            if self.busy and self.policy == PREEMPT:
+                swipes_discarded.inc(len(self.swipes))
+                self.swipes.clear()
+                self.preempted.set()
+                result = PREEMPTED
+            elif len(self.swipes) >= self.max_size:
+                swipes_discarded.inc()
+                return FULL
+            self.swipes.append(event)
+            self.last_swipe[event.card] = event.timestamp
+            self.condition.notify()
+        if result == PREEMPTED:
+            sessions_preempted.inc()
+            if self.on_preempt is not None:
+                self.on_preempt()
+        return result
+
+    def get(self, timeout=None):
+        '''
+        Wait for the next swipe, and mark the session of that swipe as in
+        progress (until `done` is called).
+
+        :param `timeout`: max number of seconds to wait (default: `None`,
+        wait until there is a swipe).\n
+        :return The `SwipeEvent` object, or `None` on timeout or if the queue
+        is closed.
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.swipes or self.closed,
+                timeout) or not self.swipes:
+                return None
+            self.busy = True
+            self.preempted.clear()
+            return self.swipes.popleft()
+
+    def done(self):
+        '''
+        Mark the session of the last swipe as finished.
+        '''
+        with self.condition:
+            self.busy = False
+
+    def close(self):
+        '''
+        Wake up the threads waiting for a swipe (they get `None`).
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
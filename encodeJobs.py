@@ -0,0 +1,331 @@
+'''
+Manager of the jobs updating the encodings (and other maintenance jobs, like
+the compaction of the captures of unknown subjects), run one at a time by a
+single worker thread.
+
+The jobs are submitted without waiting for them (e.g. from the admin page),
+or run every day at a given time. The worker sleeps until the next job is
+submitted or due, instead of polling. The encoding jobs run in a child
+process (so they don't slow down the live recognition), which reports its
+progress (images done/total) back to the manager. Each change of the status
+of a job is passed to a callback (e.g. to push it to the admin clients), and
+so is each job finished (e.g. to reload the encodings).
+'''
+
+# Import the necessary packages
+from datetime import datetime, timedelta
+import collections
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+
+# Status of a job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Job(object):
+    '''
+    Creates a Job object.
+
+    :param `name`: name of the job (e.g. `'encodings (hog)'`). Only one job
+    of each name is queued at a time.\n
+    :param `target`: function run by the job. If the job runs in a child
+    process, it gets a `progress(done, total)` callback as keyword argument.\n
+    :param `kwargs`: keyword arguments of the function (default: `None`).\n
+    :param `process`: whether or not to run the job in a child process
+    (default: `True`).\n
+    :param `reason`: why the job was submitted, e.g. `'schedule'` or
+    `'admin'` (default: `''`).\n
+    '''
+    _ids = itertools.count(1)
+
+    def __init__(self, name, target, kwargs=None, process=True, reason=""):
+        self.id = next(self._ids)
+        self.name = name
+        self.target = target
+        self.kwargs = kwargs or {}
+        self.process = process
+        self.reason = reason
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = 0           # Number of items (images) done
+        self.total = 0          # Number of items to do (0 if unknown)
+        self.result = None
+        self.error = ""
+
+    @property
+    def duration(self):
+        '''
+        Number of seconds the job has been running (or ran).
+        '''
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        '''
+        Status of the job, as a JSON serializable dictionary.
+        '''
+        return {"id": self.id, "name": self.name, "reason": self.reason,
+            "status": self.status, "done": self.done, "total": self.total,
+            "submitted": _format(self.submitted),
+            "started": _format(self.started),
+            "finished": _format(self.finished),
+            "duration": round(self.duration, 1), "result": self.result,
+            "error": self.error}
+
+
+def _format(timestamp):
+    # Timestamp as a readable string (empty if not set)
+    if timestamp is None:
+        return ""
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _run_in_process(target, kwargs, messages):
+    # Entry point of the child process of a job: run it, reporting its
+    # progress and its result (or error) through the queue of messages
+    def progress(done, total):
+        messages.put(("progress", done, total))
+    try:
+        messages.put(("result", target(progress=progress, **kwargs)))
+    except Exception as e:
+        traceback.print_exc()
+        messages.put(("error", "%s: %s" % (type(e).__name__, e)))
+
+
+class JobManager(object):
+    '''
+    Creates a JobManager object, with its own worker thread.
+
+    :param `on_update`: function called with the status of the manager (see
+    `status`) whenever it changes (default: `None`).\n
+    :param `on_finished`: function called with each job finished (default:
+    `None`).\n
+    :param `history`: number of finished jobs remembered (default: `10`).\n
+    '''
+
+    def __init__(self, on_update=None, on_finished=None, history=10):
+        self.on_update = on_update
+        self.on_finished = on_finished
+        self.condition = threading.Condition()
+        self.jobs = collections.deque()     # Jobs waiting to run
+        self.current = None                 # Job running
+        self.finished = collections.deque(maxlen=history)
+        self.daily = []         # Daily jobs: [time, name, target, kwargs,
+                                # process, next run]
+        self.scheduled = True   # Whether or not the daily jobs are enabled
+        self.stopped = False
+        self._process = None    # Child process of the job running
+        self._thread = threading.Thread(name="JobManager", target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        '''
+        Start the worker thread.
+        '''
+        self._thread.start()
+        return self
+
+    def submit(self, name, target, kwargs=None, process=True, reason=""):
+        '''
+        Queue a job, without waiting for it. If a job with the same name is
+        already waiting, that one is returned instead.
+
+        :return The `Job` object.
+        '''
+        with self.condition:
+            for job in self.jobs:
+                if job.name == name:
+                    return job
+            job = Job(name, target, kwargs, process, reason)
+            self.jobs.append(job)
+            self.condition.notify()
+        print("[INFO] job '%s' queued (%s)" % (name, reason or "manual"))
+        self._updated()
+        return job
+
+    def every_day(self, at, name, target, kwargs=None, process=True):
+        '''
+        Run a job every day at the given time.
+
+        :param `at`: time of the day, as `'HH:MM:SS'` (or `'HH:MM'`).\n
+        :param `name`, `target`, `kwargs`, `process`: the job (see `Job`).\n
+        '''
+        at = datetime.strptime(at, "%H:%M:%S" if at.count(":") == 2
+            else "%H:%M").time()
+        with self.condition:
+            self.daily.append([at, name, target, kwargs, process,
+                self._next_run(at)])
+            self.condition.notify()
+        self._updated()
+
+    def _next_run(self, at):
+        # Next time (timestamp) the given time of the day comes
+        now = datetime.now()
+        run = datetime.combine(now.date(), at)
+        if run <= now:
+            run += timedelta(days=1)
+        return time.mktime(run.timetuple())
+
+    def set_scheduled(self, scheduled):
+        '''
+        Enable or disable the daily jobs (the submitted ones still run).
+        '''
+        with self.condition:
+            self.scheduled = scheduled
+            for entry in self.daily:
+                entry[5] = self._next_run(entry[0])
+            self.condition.notify()
+        self._updated()
+
+    def status(self):
+        '''
+        Status of the manager: the job running, the jobs waiting, the last
+        jobs finished, whether or not the daily jobs are enabled and their
+        next run.
+
+        :return The status `dictionary` (JSON serializable).
+        '''
+        with self.condition:
+            return {"current": self.current.to_dict() if self.current
+                else None,
+                "queued": [job.to_dict() for job in self.jobs],
+                "finished": [job.to_dict() for job in self.finished],
+                "last": self.finished[-1].to_dict() if self.finished
+                else None,
+                "scheduled": self.scheduled,
+                "next": [{"name": entry[1], "at": _format(entry[5])}
+                    for entry in self.daily] if self.scheduled else []}
+
+    def _updated(self):
+        # Pass the new status to the callback
+        if self.on_update is not None:
+            try:
+                self.on_update(self.status())
+            except Exception as e:
+                print("[WARNING] unable to report the status of the jobs: %s"
+                    % e)
+
+    def _next_job(self):
+        # Wait until a job is queued or a daily job is due, and return it
+        # (None once the manager is stopped)
+        with self.condition:
+            while not self.stopped:
+                now = time.time()
+                if self.scheduled:
+                    for entry in self.daily:
+                        if entry[5] <= now:
+                            entry[5] = self._next_run(entry[0])
+                            if not any(job.name == entry[1]
+                                for job in self.jobs):
+                                self.jobs.append(Job(entry[1], entry[2],
+                                    entry[3], entry[4], "schedule"))
+                if self.jobs:
+                    self.current = self.jobs.popleft()
+                    return self.current
+                timeout = None
+                if self.scheduled and self.daily:
+                    timeout = max(0, min(entry[5] for entry in self.daily)
+                        - now)
+                self.condition.wait(timeout)
+            return None
+
+    def _run(self):
+        # Worker: run the jobs one at a time
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            job.status = RUNNING
+            job.started = time.time()
+            print("[INFO] job '%s' started" % job.name)
+            self._updated()
+            try:
+                if job.process:
+                    self._run_process(job)
+                else:
+                    job.result = job.target(**job.kwargs)
+                    job.status = DONE
+            except Exception as e:
+                traceback.print_exc()
+                job.status = FAILED
+                job.error = "%s: %s" % (type(e).__name__, e)
+            job.finished = time.time()
+            with self.condition:
+                self.current = None
+                self.finished.append(job)
+            print("[INFO] job '%s' %s in %.1fs" % (job.name, job.status,
+                job.duration))
+            self._updated()
+            if self.on_finished is not None:
+                try:
+                    self.on_finished(job)
+                except Exception as e:
+                    print("[WARNING] error after job '%s': %s" % (job.name, e))
+
+    def _run_process(self, job):
+        # Run a job in a child process (not daemonic, so it can start a pool
+        # of workers), relaying its progress until it ends
+        messages = multiprocessing.Queue()
+        process = multiprocessing.Process(name="Job-%s" % job.id,
+            target=_run_in_process, args=(job.target, job.kwargs, messages))
+        process.daemon = False
+        with self.condition:
+            if self.stopped:
+                job.status = CANCELLED
+                return
+            self._process = process
+            process.start()
+        job.status = FAILED
+        job.error = "the process of the job ended unexpectedly"
+        while True:
+            try:
+                message = messages.get(timeout=1)
+            except queue.Empty:
+                # Only check that the process is still alive
+                if process.is_alive():
+                    continue
+                break
+            if message[0] == "progress":
+                (job.done, job.total) = message[1:]
+                self._updated()
+            else:
+                if message[0] == "result":
+                    (job.status, job.result, job.error) = (DONE, message[1],
+                        "")
+                else:
+                    job.error = message[1]
+                break
+        process.join()
+        with self.condition:
+            self._process = None
+            if self.stopped and job.status != DONE:
+                job.status = CANCELLED
+
+    def stop(self):
+        '''
+        Stop the worker, terminating the job running (if any). The jobs
+        waiting are cancelled.
+        '''
+        with self.condition:
+            self.stopped = True
+            for job in self.jobs:
+                job.status = CANCELLED
+            self.jobs.clear()
+            if self._process is not None and self._process.is_alive():
+                self._process.terminate()
+            self.condition.notify_all()
+        if self._thread.is_alive() and (self._thread
+            is not threading.current_thread()):
+            self._thread.join(timeout=5)
@@ -0,0 +1,253 @@
+'''
+Compact binary store of facial encodings, replacing the pickled dictionary of
+encodings and names.
+
+File layout (little-endian):
+    - magic (`FSENC` padded with NUL bytes to 8 bytes).
+    - format version and length of the metadata (2 x uint32).
+    - metadata: UTF-8 JSON with the number and size of the encodings, the \
+offset of each data section, the table of identities (folder name, CWID and \
+name), stored only once per identity, and the version of the store (hash of \
+its content) and its creation time.
+    - data sections (64-byte aligned): the N x 128 float32 matrix of \
+encodings, grouped by identity, and the N int32 labels with the index of the \
+identity of each encoding.
+
+The store is written to a temporary file which then replaces the previous one
+atomically, so a reader (e.g. the live recognition reloading the encodings)
+never sees a partially written store. The file is mapped in memory when
+loaded, so the matrix of encodings is read in place (zero-copy) and no code is
+ever executed from the file, unlike with pickle.
+
+This module can also be runned as an independent script, to convert an
+existing pickle file of encodings into the new format.
+
+Usage examples:
+    python encodingStore.py
+    python encodingStore.py --input myEncodings.pickle --output myEncodings.bin
+Default params are '--input encodings.pickle --output encodings.bin'
+'''
+
+# Import the necessary packages
+from datetime import datetime
+from argparse import RawTextHelpFormatter
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+
+
+MAGIC = b"FSENC\0\0\0"  # Magic bytes at the start of every store file
+FORMAT_VERSION = 1      # Version of the file layout
+ALIGNMENT = 64          # Alignment (in bytes) of the data sections
+PREAMBLE = struct.Struct("<8sII")   # Magic, format version, metadata length
+
+
+def _align(offset):
+    # Round up the offset to the next multiple of the alignment
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _split_identity(identity):
+    # The folder names have the format '[CWID]_[Name_Surname]'
+    return {"folder": identity, "cwid": identity[:9],
+        "name": identity[10:].replace("_", " ")}
+
+
+def group(encodings, names):
+    '''
+    Group the encodings by identity, as they are written to the store.
+
+    :param `encodings`: list (or N x 128 array) of facial encodings.\n
+    :param `names`: list with the identity (folder name) of each encoding.\n
+    :return The N x 128 float32 `matrix` of encodings grouped by identity,
+    the `label` of each row and the list of `identities`, in order of first
+    appearance.
+    '''
+    # Assign an integer label to each identity, in order of first appearance,
+    # and group the encodings by identity
+    identities = []
+    label_of = {}
+    for name in names:
+        if name not in label_of:
+            label_of[name] = len(identities)
+            identities.append(name)
+    labels = np.array([label_of[name] for name in names], dtype="<i4")
+    order = np.argsort(labels, kind="stable")
+    if len(names) == 0:
+        matrix = np.zeros((0, 128), dtype="<f4")
+    else:
+        matrix = np.asarray(encodings, dtype="<f4").reshape(len(names), -1)
+    return (np.ascontiguousarray(matrix[order]),
+        np.ascontiguousarray(labels[order]), identities)
+
+
+def save(path, encodings, names):
+    '''
+    Write the facial encodings and their names to a store file, replacing the
+    previous one atomically.
+
+    :param `path`: output path of the store file.\n
+    :param `encodings`: list (or N x 128 array) of facial encodings.\n
+    :param `names`: list with the identity (folder name) of each encoding, in
+    the same order as `encodings`.
+    '''
+    if len(encodings) != len(names):
+        raise ValueError("[ERROR] the number of encodings and names don't "
+            +"match")
+
+    (matrix, labels, identities) = group(encodings, names)
+
+    # Data sections, with their offsets relative to the start of the data
+    sections = [("encodings", matrix), ("labels", labels)]
+    meta = {
+        "count": matrix.shape[0],
+        "dim": matrix.shape[1],
+        "sections": {},
+        "identities": [_split_identity(identity) for identity in identities],
+    }
+    offset = 0
+    for (name, data) in sections:
+        meta["sections"][name] = {"offset": offset, "dtype": data.dtype.str,
+            "shape": list(data.shape)}
+        offset = _align(offset + data.nbytes)
+    sha1 = hashlib.sha1(json.dumps(meta, sort_keys=True).encode("utf-8"))
+    for (name, data) in sections:
+        sha1.update(np.ascontiguousarray(data).tobytes())
+    meta["version"] = sha1.hexdigest()[:16]
+    meta["created"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    data_start = _align(PREAMBLE.size + len(meta_bytes))
+
+    # Write a temporary file next to the store, flushed to disk, and then
+    # rename it over the store
+    with open(path + ".tmp", "wb") as file:
+        file.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(meta_bytes)))
+        file.write(meta_bytes)
+        for (name, data) in sections:
+            file.write(b"\0" * (data_start + meta["sections"][name]["offset"]
+                - file.tell()))
+            file.write(np.ascontiguousarray(data).tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class EncodingStore(object):
+    '''
+    Creates an EncodingStore object, mapping a store file in memory.
+
+    :param `path`: input path of the store file.\n
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            preamble = file.read(PREAMBLE.size)
+            if len(preamble) < PREAMBLE.size or preamble[:8] != MAGIC:
+                raise ValueError("[ERROR] '%s' is not a store of encodings. "
+                    % path +"If it's a pickle file, convert it first with "
+                    +"'python encodingStore.py --input %s'" % path)
+            (_, version, meta_length) = PREAMBLE.unpack(preamble)
+            if version > FORMAT_VERSION:
+                raise ValueError("[ERROR] unsupported version %s of the store "
+                    % version +"of encodings '%s'" % path)
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.meta = json.loads(self._mmap[PREAMBLE.size:
+            PREAMBLE.size + meta_length].decode("utf-8"))
+        self._data_start = _align(PREAMBLE.size + meta_length)
+        # Version of the store (empty for the stores written without it)
+        self.version = self.meta.get("version", "")
+        self.created = self.meta.get("created", "")
+
+        # Identities (one entry per folder name)
+        self.identities = [i["folder"] for i in self.meta["identities"]]
+        self.cwids = [i["cwid"] for i in self.meta["identities"]]
+        self.subject_names = [i["name"] for i in self.meta["identities"]]
+
+        # Data sections, read in place from the mapped file
+        self.encodings = self._section("encodings")
+        self.labels = self._section("labels")
+
+    def _section(self, name):
+        # Read-only numpy view of a data section of the mapped file
+        section = self.meta["sections"][name]
+        shape = tuple(section["shape"])
+        count = int(np.prod(shape)) if shape else 0
+        return np.frombuffer(self._mmap, dtype=section["dtype"], count=count,
+            offset=self._data_start + section["offset"]).reshape(shape)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    @property
+    def names(self):
+        '''
+        List with the identity (folder name) of each encoding.
+        '''
+        return [self.identities[label] for label in self.labels]
+
+    def close(self):
+        '''
+        Release the views on the mapped file and unmap it.
+        '''
+        self.encodings = None
+        self.labels = None
+        self._mmap.close()
+
+
+def load(path):
+    '''
+    Load a store of encodings.
+
+    :param `path`: input path of the store file.\n
+    :return The `EncodingStore` object.
+    '''
+    return EncodingStore(path)
+
+
+def convert(pickle_path, store_path):
+    '''
+    Convert a pickle file of encodings (a dictionary with the `"encodings"`
+    and `"names"` lists) into a store file.
+
+    :param `pickle_path`: input path of the pickle file.\n
+    :param `store_path`: output path of the store file.\n
+    :return The number of `encodings` converted.
+    '''
+    # Only place where a pickle file is loaded: do not convert files from an
+    # untrusted source
+    import pickle
+    with open(pickle_path, "rb") as file:
+        data = pickle.load(file)
+    save(store_path, data["encodings"], data["names"])
+    return len(data["names"])
+
+
+def argParser():
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    ap.add_argument("-i", "--input", type=str, default="encodings.pickle",
+        help="input path to the pickle file of encodings to convert"+
+        "\ndefault: 'encodings.pickle'")
+    ap.add_argument("-o", "--output", type=str, default="encodings.bin",
+        help="output path to the store of encodings "+
+        "\ndefault: 'encodings.bin'")
+    global args
+    args = vars(ap.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    # Call the argument parser function
+    argParser()
+
+    # Convert the pickle file
+    print("[INFO] converting '%s' into '%s'..." % (args["input"],
+        args["output"]), end=" ")
+    count = convert(args["input"], args["output"])
+    print("DONE")
+    print("[FINISHED] %s encodings converted" % count)
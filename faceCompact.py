@@ -0,0 +1,293 @@
+'''
+Compaction of the gallery of known encodings: each identity (folder name) is
+reduced to a small set of representative prototypes, so the subjects enrolled
+with many photos don't dominate the match time nor the votes of the
+recognition.
+
+The prototypes are either medoids (the encodings of the identity closest to
+the others of their cluster, so they are real encodings) or the centroids of
+the clusters of encodings of the identity. The identities with no more
+encodings than the cap are kept as they are.
+
+The impact of the compaction is estimated on a held-out split: part of the
+encodings of each identity (genuine attempts) and some whole identities
+(impostor attempts) are left out, and they are identified against the
+remaining gallery, with and without compaction.
+
+This module can also be runned as an independent script, to compact an
+existing store of encodings.
+
+Usage examples:
+    python faceCompact.py
+    python faceCompact.py --input myEncodings.bin --output compact.bin \
+--cap 3 --method centroids
+Default params are '--input encodings.bin --output encodings.bin --cap 5 \
+--method medoids --holdout 0.2'
+'''
+
+# Import the necessary packages
+from argparse import RawTextHelpFormatter
+import argparse
+import numpy as np
+import encodingStore
+import faceMatch
+
+
+METHODS = ("medoids", "centroids")
+
+
+def _distances(a, b):
+    # Euclidean distances between the rows of a and b
+    distances = np.einsum("ij,ij->i", a, a)[:, None] - 2 * np.dot(a, b.T)
+    distances += np.einsum("ij,ij->i", b, b)[None, :]
+    return np.sqrt(np.maximum(distances, 0))
+
+
+def _seeds(encodings, k):
+    # Farthest-point initialization: the medoid of all the encodings, then
+    # each time the encoding farthest from the ones already chosen
+    distances = _distances(encodings, encodings)
+    seeds = [int(distances.sum(axis=1).argmin())]
+    closest = distances[seeds[0]].copy()
+    while len(seeds) < k:
+        seeds.append(int(closest.argmax()))
+        np.minimum(closest, distances[seeds[-1]], out=closest)
+    return seeds, distances
+
+
+def medoids(encodings, k, iterations=10):
+    '''
+    Cluster the encodings of an identity around k medoids.
+
+    :param `encodings`: the N x 128 float32 matrix of encodings.\n
+    :param `k`: number of medoids.\n
+    :param `iterations`: max number of iterations (default: `10`).\n
+    :return The `rows` of the medoids.
+    '''
+    (rows, distances) = _seeds(encodings, k)
+    rows = np.array(rows)
+    for _ in range(iterations):
+        assignment = distances[:, rows].argmin(axis=1)
+        new_rows = rows.copy()
+        for cluster in range(k):
+            members = np.flatnonzero(assignment == cluster)
+            if len(members):
+                cost = distances[np.ix_(members, members)].sum(axis=1)
+                new_rows[cluster] = members[cost.argmin()]
+        if np.array_equal(new_rows, rows):
+            break
+        rows = new_rows
+    return np.sort(rows)
+
+
+def centroids(encodings, k, iterations=10):
+    '''
+    Cluster the encodings of an identity around k centroids (k-means).
+
+    :param `encodings`: the N x 128 float32 matrix of encodings.\n
+    :param `k`: number of centroids.\n
+    :param `iterations`: max number of iterations (default: `10`).\n
+    :return The `centroids` (k x 128 float32 matrix).
+    '''
+    centers = encodings[_seeds(encodings, k)[0]].copy()
+    for _ in range(iterations):
+        assignment = _distances(encodings, centers).argmin(axis=1)
+        for cluster in range(k):
+            members = assignment == cluster
+            if members.any():
+                centers[cluster] = encodings[members].mean(axis=0)
+    return centers
+
+
+def _groups(names):
+    # Rows of each identity, in order of first appearance of the identities
+    (identities, first, labels) = np.unique(names, return_index=True,
+        return_inverse=True)
+    order = np.argsort(labels, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(labels))[:-1])
+    return [(identities[i], groups[i]) for i in np.argsort(first)]
+
+
+def compact(encodings, names, cap=5, method="medoids"):
+    '''
+    Reduce the encodings of each identity to at most `cap` prototypes.
+
+    :param `encodings`: list (or N x 128 array) of facial encodings.\n
+    :param `names`: list with the identity (folder name) of each encoding.\n
+    :param `cap`: max number of prototypes per identity (default: `5`).\n
+    :param `method`: either `'medoids'` or `'centroids'` (default:
+    `'medoids'`).\n
+    :return The compacted `encodings` (float32 matrix) and their `names`.
+    '''
+    if method not in METHODS:
+        raise ValueError("[ERROR] unknown compaction method '%s'" % method)
+    if cap < 1:
+        raise ValueError("[ERROR] the cap of prototypes must be at least 1")
+    if len(names) == 0:
+        return np.zeros((0, 128), dtype=np.float32), []
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1)
+    compact_encodings = []
+    compact_names = []
+    for (identity, rows) in _groups(np.array(names, dtype=object)):
+        group = encodings[rows]
+        if len(rows) > cap:
+            if method == "medoids":
+                group = group[medoids(group, cap)]
+            else:
+                group = centroids(group, cap)
+        compact_encodings.append(group)
+        compact_names.extend([identity] * len(group))
+    return np.concatenate(compact_encodings), compact_names
+
+
+def split(names, holdout=0.2, seed=0):
+    '''
+    Split a gallery into the encodings kept and the ones held out: a fraction
+    of the encodings of each identity (keeping at least one), and a fraction
+    of the identities with all their encodings (impostors).
+
+    :param `names`: list with the identity of each encoding.\n
+    :param `holdout`: fraction held out (default: `0.2`).\n
+    :param `seed`: seed of the random split (default: `0`).\n
+    :return The boolean masks of the encodings `kept`, held out as `genuine`
+    attempts and held out as `impostor` attempts.
+    '''
+    random = np.random.RandomState(seed)
+    names = np.array(names, dtype=object)
+    kept = np.ones(len(names), dtype=bool)
+    genuine = np.zeros(len(names), dtype=bool)
+    impostor = np.zeros(len(names), dtype=bool)
+    groups = _groups(names)
+    # Only hold out whole identities if some are left in the gallery
+    n_impostors = int(round(holdout * len(groups)))
+    if n_impostors >= len(groups):
+        n_impostors = 0
+    impostors = set(random.choice(len(groups), n_impostors, replace=False))
+    for (i, (_, rows)) in enumerate(groups):
+        if i in impostors:
+            kept[rows] = False
+            impostor[rows] = True
+        elif len(rows) > 1:
+            count = min(len(rows) - 1, max(1, int(round(holdout * len(rows)))))
+            held = random.choice(rows, count, replace=False)
+            kept[held] = False
+            genuine[held] = True
+    return kept, genuine, impostor
+
+
+def _identify(matcher, encodings, tolerance, chunk=256):
+    # Identify the attempts in chunks, to bound the memory of the distances
+    return [name for start in range(0, len(encodings), chunk)
+        for name in matcher.identify(encodings[start:start + chunk],
+        tolerance)]
+
+
+def _rates(matcher, encodings, names, genuine, impostor, tolerance):
+    # Rate of the genuine attempts identified as their identity, and of the
+    # impostor attempts identified as anyone (false accepts)
+    accuracy = false_accepts = float("nan")
+    if genuine.any():
+        found = _identify(matcher, encodings[genuine], tolerance)
+        accuracy = float(np.mean([a == b for (a, b) in zip(found,
+            names[genuine])]))
+    if impostor.any():
+        found = _identify(matcher, encodings[impostor], tolerance)
+        false_accepts = float(np.mean([name != "Unknown" for name in found]))
+    return accuracy, false_accepts
+
+
+def evaluate(encodings, names, cap=5, method="medoids", holdout=0.2,
+    tolerance=0.55, seed=0):
+    '''
+    Estimate the impact of the compaction on a held-out split of the gallery
+    (see `split`).
+
+    :param `encodings`: list (or N x 128 array) of facial encodings.\n
+    :param `names`: list with the identity (folder name) of each encoding.\n
+    :param `cap`: max number of prototypes per identity (default: `5`).\n
+    :param `method`: either `'medoids'` or `'centroids'` (default:
+    `'medoids'`).\n
+    :param `holdout`: fraction held out (default: `0.2`).\n
+    :param `tolerance`: max distance between two encodings for them to be
+    considered a match (default: `0.55`).\n
+    :param `seed`: seed of the random split (default: `0`).\n
+    :return A `dictionary` with the size of the gallery, the accuracy of the
+    genuine attempts and the rate of false accepts of the impostor attempts,
+    before and after the compaction.
+    '''
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1)
+    names = np.array(names, dtype=object)
+    (kept, genuine, impostor) = split(names, holdout, seed)
+    matcher = faceMatch.FaceMatcher(encodings[kept], list(names[kept]))
+    (before, before_fa) = _rates(matcher, encodings, names, genuine,
+        impostor, tolerance)
+    matcher = faceMatch.FaceMatcher(*compact(encodings[kept],
+        list(names[kept]), cap, method))
+    (after, after_fa) = _rates(matcher, encodings, names, genuine, impostor,
+        tolerance)
+    counts = np.unique(names, return_counts=True)[1]
+    return {"size_before": len(names),
+        "size_after": int(np.minimum(counts, cap).sum()),
+        "genuine": int(genuine.sum()), "impostor": int(impostor.sum()),
+        "accuracy_before": before, "accuracy_after": after,
+        "false_accepts_before": before_fa, "false_accepts_after": after_fa}
+
+
+def _percent(rate):
+    # Rate as a percentage, or '-' if there weren't any attempts
+    return "-" if np.isnan(rate) else "%.1f%%" % (100 * rate)
+
+
+def report(result):
+    '''
+    Print the report of a compaction (see `evaluate`).
+    '''
+    print("[INFO] gallery compacted from %s to %s encodings (%.1fx smaller)"
+        % (result["size_before"], result["size_after"],
+        result["size_before"] / float(max(1, result["size_after"]))))
+    print("[INFO] held-out accuracy: %s before, %s after (%s genuine attempts)"
+        % (_percent(result["accuracy_before"]),
+        _percent(result["accuracy_after"]), result["genuine"]))
+    print("[INFO] held-out false accepts: %s before, %s after (%s impostor "
+        % (_percent(result["false_accepts_before"]),
+        _percent(result["false_accepts_after"]), result["impostor"])
+        + "attempts)")
+
+
+def argParser():
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    ap.add_argument("-i", "--input", type=str, default="encodings.bin",
+        help="input path to the store of encodings\ndefault: 'encodings.bin'")
+    ap.add_argument("-o", "--output", type=str, default="encodings.bin",
+        help="output path to the compacted store of encodings"+
+        "\ndefault: 'encodings.bin'")
+    ap.add_argument("-k", "--cap", type=int, default=5,
+        help="max number of prototypes per identity\ndefault: '5'")
+    ap.add_argument("-m", "--method", type=str, default="medoids",
+        help="prototypes: either 'medoids' or 'centroids'\ndefault: 'medoids'")
+    ap.add_argument("-H", "--holdout", type=float, default=0.2,
+        help="fraction of the gallery held out to estimate the accuracy"+
+        "\ndefault: '0.2'")
+    global args
+    args = vars(ap.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    # Call the argument parser function
+    argParser()
+
+    # Load the gallery (copied, so the store can be overwritten)
+    store = encodingStore.load(args["input"])
+    encodings = np.array(store.encodings, dtype=np.float32)
+    names = store.names
+    store.close()
+
+    # Estimate the impact of the compaction, then compact the whole gallery
+    report(evaluate(encodings, names, args["cap"], args["method"],
+        args["holdout"]))
+    (encodings, names) = compact(encodings, names, args["cap"],
+        args["method"])
+    encodingStore.save(args["output"], encodings, names)
+    print("[FINISHED] compacted encodings saved to '%s'" % args["output"])
@@ -0,0 +1,344 @@
+'''
+Sequential decision of the access, accumulating the evidence of the match
+distances across the frames (a sequential probability ratio test), instead of
+waiting for a fixed number of matches.
+
+The distance between a face and the closest encoding of a subject is modelled
+as normally distributed, around `genuine_mean` if the face belongs to the
+subject and around `impostor_mean` if not. Each frame adds the log-likelihood
+ratio of its distance to the evidence of the subject, so a very clear match
+grants the access in a couple of frames, and a face that clearly belongs to
+someone else is refused early. The bounds are set by the tolerated rates of
+false accepts and false rejects.
+
+The recognition sessions (the distances of each frame) can be recorded, and
+this module can also be runned as an independent script, to replay them and
+calibrate the parameters of the decision.
+
+Usage examples:
+    python faceDecision.py
+    python faceDecision.py --sessions mySessions.jsonl --output myDecision.json
+Default params are '--sessions sessions.jsonl --output decision.json'
+'''
+
+# Import the necessary packages
+from datetime import datetime
+from argparse import RawTextHelpFormatter
+import argparse
+import json
+import math
+import os
+import numpy as np
+
+
+GRANT = "grant"         # The evidence has crossed the upper bound
+REFUSE = "refuse"       # The evidence has crossed the lower bound
+TIMEOUT = "timeout"     # No decision before the end of the session
+
+
+class SequentialDecision(object):
+    '''
+    Creates a SequentialDecision object.
+
+    :param `genuine_mean`: mean distance of a face to its own subject
+    (default: `0.40`).\n
+    :param `impostor_mean`: mean distance of a face to the closest other
+    subject (default: `0.70`).\n
+    :param `sigma`: standard deviation of the distances (default: `0.08`).\n
+    :param `false_accept`: tolerated rate of false accepts, which sets the
+    upper bound of the evidence (default: `0.001`).\n
+    :param `false_reject`: tolerated rate of false rejects, which sets the
+    lower bound of the evidence (default: `0.01`).\n
+    :param `max_step`: max evidence added (or removed) by a single frame, so a
+    single bad frame (e.g. blurred) is never enough to decide (default:
+    `3.0`).\n
+    '''
+
+    def __init__(self, genuine_mean=0.40, impostor_mean=0.70, sigma=0.08,
+        false_accept=0.001, false_reject=0.01, max_step=3.0):
+        self.genuine_mean = genuine_mean
+        self.impostor_mean = impostor_mean
+        self.sigma = sigma
+        self.false_accept = false_accept
+        self.false_reject = false_reject
+        self.max_step = max_step
+        # Wald's bounds of the log-likelihood ratio
+        self.upper = math.log((1 - false_reject) / false_accept)
+        self.lower = math.log(false_reject / (1 - false_accept))
+        self.reset()
+
+    def params(self):
+        '''
+        Parameters of the decision, to save them (see `save`).
+
+        :return The `dictionary` of parameters.
+        '''
+        return {"genuine_mean": self.genuine_mean,
+            "impostor_mean": self.impostor_mean, "sigma": self.sigma,
+            "false_accept": self.false_accept,
+            "false_reject": self.false_reject, "max_step": self.max_step}
+
+    def reset(self, claimed=None):
+        '''
+        Start a new recognition session.
+
+        :param `claimed`: identity (folder name) claimed by the swiped card,
+        if any. If given, the session is refused as soon as the evidence
+        against that subject crosses the lower bound (default: `None`).\n
+        '''
+        self.claimed = claimed
+        self.evidence = {}      # Accumulated evidence of each identity
+        self.frames = []        # Distances of each frame, for the recording
+        self.state = None       # GRANT, REFUSE or None (undecided)
+        self.granted = []       # Identities granted
+        self.started = datetime.now()
+
+    def llr(self, distance):
+        '''
+        Log-likelihood ratio of a distance (genuine against impostor), clipped
+        to `max_step`.
+
+        :param `distance`: distance (or array of distances) to a subject.\n
+        :return The `evidence` of the distance.
+        '''
+        ratio = ((distance - self.impostor_mean) ** 2
+            - (distance - self.genuine_mean) ** 2) / (2 * self.sigma ** 2)
+        return np.clip(ratio, -self.max_step, self.max_step)
+
+    def observe(self, distances):
+        '''
+        Add the evidence of a frame and update the decision.
+
+        :param `distances`: dictionary with the best distance of the faces of
+        the frame to each candidate identity.\n
+        :return The `state` of the decision: `GRANT`, `REFUSE` or `None`.
+        '''
+        self.frames.append([round((datetime.now() - self.started)
+            .total_seconds(), 3), dict((identity, round(float(distance), 4))
+            for (identity, distance) in distances.items())])
+        if self.state is not None:
+            return self.state
+        for (identity, distance) in distances.items():
+            self.evidence[identity] = (self.evidence.get(identity, 0.0)
+                + float(self.llr(distance)))
+        self.granted = sorted(identity for (identity, evidence)
+            in self.evidence.items() if evidence >= self.upper
+            and (self.claimed is None or identity == self.claimed))
+        if self.granted:
+            self.state = GRANT
+        elif self.claimed is not None:
+            if self.evidence.get(self.claimed, 0.0) <= self.lower:
+                self.state = REFUSE
+        elif self.evidence and max(self.evidence.values()) <= self.lower:
+            # No candidate left: every face seen belongs to someone else
+            self.state = REFUSE
+        return self.state
+
+    def candidates(self):
+        '''
+        Identities with evidence in the current session, and the claimed
+        identity (if any), so its distances are always recorded.
+
+        :return The `list` of identities.
+        '''
+        identities = list(self.evidence)
+        if self.claimed is not None and self.claimed not in self.evidence:
+            identities.append(self.claimed)
+        return identities
+
+    def session(self):
+        '''
+        Record of the current session (see `record_session`).
+
+        :return The `dictionary` of the session.
+        '''
+        return {"started": self.started.isoformat(), "claimed": self.claimed,
+            "outcome": self.state or TIMEOUT, "granted": self.granted,
+            "frames": self.frames}
+
+
+def load(path):
+    '''
+    Load the parameters of the decision, if the file exists.
+
+    :param `path`: input path to the JSON file of parameters.\n
+    :return The `SequentialDecision` object (with the default parameters if
+    the file doesn't exist).
+    '''
+    if not path or not os.path.exists(path):
+        return SequentialDecision()
+    with open(path) as file:
+        return SequentialDecision(**json.load(file))
+
+
+def save(path, decision):
+    '''
+    Save the parameters of the decision.
+
+    :param `path`: output path to the JSON file of parameters.\n
+    :param `decision`: the SequentialDecision object.\n
+    '''
+    with open(path, "w") as file:
+        json.dump(decision.params(), file, indent=4)
+
+
+def record_session(path, session):
+    '''
+    Append a recognition session to the file of sessions (one JSON object per
+    line).
+
+    :param `path`: path to the file of sessions.\n
+    :param `session`: the dictionary of the session.\n
+    '''
+    with open(path, "a") as file:
+        file.write(json.dumps(session) + "\n")
+
+
+def load_sessions(path):
+    '''
+    Load the recorded recognition sessions.
+
+    :param `path`: path to the file of sessions.\n
+    :return The `list` of sessions.
+    '''
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _streams(sessions):
+    # Split the sessions with a claimed identity into the stream of distances
+    # of the genuine subject and the streams of the other subjects (impostors)
+    genuine, impostors = [], []
+    for session in sessions:
+        claimed = session.get("claimed")
+        if not claimed:
+            continue
+        streams = {}
+        for (t, distances) in session["frames"]:
+            for (identity, distance) in distances.items():
+                streams.setdefault(identity, []).append((t, distance))
+        for (identity, stream) in streams.items():
+            (genuine if identity == claimed else impostors).append(stream)
+    return genuine, impostors
+
+
+def replay(stream, decision):
+    '''
+    Replay the distances of a single subject through a decision.
+
+    :param `stream`: list of (time, distance) of the frames.\n
+    :param `decision`: the SequentialDecision object.\n
+    :return The `outcome`, the `time` (in seconds since the start of the
+    session) and the number of `frames` used to decide.
+    '''
+    decision.reset("subject")
+    for (frame, (t, distance)) in enumerate(stream, 1):
+        state = decision.observe({"subject": distance})
+        if state is not None:
+            return state, t, frame
+    return TIMEOUT, None, len(stream)
+
+
+def calibrate(sessions, false_reject=0.01, max_step=3.0):
+    '''
+    Fit the distributions of the genuine and impostor distances of the
+    recorded sessions (the claimed subject is assumed to be the genuine one).
+
+    :param `sessions`: list of recorded sessions.\n
+    :param `false_reject`: tolerated rate of false rejects (default: `0.01`).\n
+    :param `max_step`: max evidence of a single frame (default: `3.0`).\n
+    :return The `parameters` of the decision (without `false_accept`).
+    '''
+    genuine, impostors = _streams(sessions)
+    params = SequentialDecision().params()
+    genuine = [d for stream in genuine for (_, d) in stream]
+    impostors = [d for stream in impostors for (_, d) in stream]
+    if genuine:
+        params["genuine_mean"] = float(np.mean(genuine))
+    if impostors:
+        params["impostor_mean"] = float(np.mean(impostors))
+    if len(genuine) + len(impostors) > 2:
+        # Pooled standard deviation of both distributions
+        residuals = ([d - params["genuine_mean"] for d in genuine]
+            + [d - params["impostor_mean"] for d in impostors])
+        params["sigma"] = max(0.01, float(np.std(residuals)))
+    params["false_reject"] = false_reject
+    params["max_step"] = max_step
+    del params["false_accept"]
+    return params
+
+
+def evaluate(sessions, decision):
+    '''
+    Replay the recorded sessions through a decision.
+
+    :param `sessions`: list of recorded sessions.\n
+    :param `decision`: the SequentialDecision object.\n
+    :return A `dictionary` with the rate of genuine subjects granted, the
+    median time and frames to grant them, and the rate of impostors
+    granted.
+    '''
+    genuine, impostors = _streams(sessions)
+    grants = [replay(stream, decision) for stream in genuine]
+    times = [t for (state, t, _) in grants if state == GRANT]
+    frames = [n for (state, _, n) in grants if state == GRANT]
+    false_grants = [replay(stream, decision)[0] == GRANT
+        for stream in impostors]
+    return {"genuine": len(genuine), "impostors": len(impostors),
+        "granted": len(times) / float(len(genuine)) if genuine else 0.0,
+        "median_time": float(np.median(times)) if times else None,
+        "median_frames": float(np.median(frames)) if frames else None,
+        "false_accepts": (sum(false_grants) / float(len(impostors))
+            if impostors else 0.0)}
+
+
+def argParser():
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    ap.add_argument("-s", "--sessions", type=str, default="sessions.jsonl",
+        help="path to the file of recorded recognition sessions"+
+        "\ndefault: 'sessions.jsonl'")
+    ap.add_argument("-o", "--output", type=str, default="decision.json",
+        help="output path to the parameters of the decision"+
+        "\ndefault: 'decision.json'")
+    ap.add_argument("-a", "--false-accept", type=float, default=0.001,
+        help="tolerated rate of false accepts of the saved parameters"+
+        "\ndefault: '0.001'")
+    ap.add_argument("-f", "--false-reject", type=float, default=0.01,
+        help="tolerated rate of false rejects\ndefault: '0.01'")
+    global args
+    args = vars(ap.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    # Call the argument parser function
+    argParser()
+
+    # Load the recorded sessions and fit the distributions of distances
+    print("[INFO] loading sessions...", end=" ")
+    sessions = load_sessions(args["sessions"])
+    print("DONE (%s sessions)" % len(sessions))
+    params = calibrate(sessions, args["false_reject"])
+    print("[INFO] genuine mean: %.3f, impostor mean: %.3f, sigma: %.3f" % (
+        params["genuine_mean"], params["impostor_mean"], params["sigma"]))
+
+    # Replay the sessions with different bounds
+    print("[INFO] replaying sessions...")
+    print("%14s %10s %12s %14s %14s" % ("false accept", "granted",
+        "median time", "median frames", "false accepts"))
+    for false_accept in sorted(set([0.01, 0.001, 0.0001, 0.00001,
+        args["false_accept"]]), reverse=True):
+        result = evaluate(sessions, SequentialDecision(
+            false_accept=false_accept, **params))
+        print("%14s %9.1f%% %12s %14s %13.2f%%" % (false_accept,
+            100 * result["granted"], "-" if result["median_time"] is None
+            else "%.2fs" % result["median_time"],
+            "-" if result["median_frames"] is None
+            else "%.0f" % result["median_frames"],
+            100 * result["false_accepts"]))
+
+    # Save the parameters for the chosen rate of false accepts
+    save(args["output"], SequentialDecision(false_accept=args["false_accept"],
+        **params))
+    print("[FINISHED] parameters saved to '%s'" % args["output"])
@@ -12,10 +12,26 @@ This module can also be runned as an independent script.
 
 Usage examples:
     python faceEncode.py
-    python faceEncode.py --dataset dataset --encodings myEncodings.pickle \
+    python faceEncode.py --dataset dataset --encodings myEncodings.bin \
 --detection-method cnn
-Default params are '--dataset images/known_people --encodings encodings.pickle \
+Default params are '--dataset images/known_people --encodings encodings.bin \
 --detection-method hog'
+
+The images can be encoded in parallel by a pool of worker processes (see the
+'--workers' option), and the output is identical to a serial run.
+
+The encodings of each image are cached (next to the output store, in a
+'.cache' file) under a key made of the hash of the content of the image, the
+detection method and the version of the models, so only the new or changed
+images are processed on each run.
+
+The encodings of each identity can be reduced to a few representative
+prototypes (see faceCompact and the '--compact' option), reporting the impact
+on the accuracy on a held-out split of the gallery.
+
+For large galleries, an approximate index of the encodings (see faceIndex) is
+built next to the output store (in a '.idx' file), so the live recognition
+doesn't need to scan the whole gallery (see the '--index' option).
 '''
 
 # Import the necessary packages
@@ -25,20 +41,134 @@ from gooey import Gooey, GooeyParser
 import cv2
 import face_recognition
 import argparse
+import hashlib
+import multiprocessing
 import os
-import pickle
+import numpy as np
+import encodingStore
+import faceCompact
+import faceIndex
+
+
+def modelVersion():
+    '''
+    Get the version of the models used to detect and encode the faces, so the
+    cached encodings are recomputed whenever the models change.
+
+    :return The `version` string.
+    '''
+    import dlib
+    import face_recognition_models
+    return "dlib-%s_models-%s" % (dlib.__version__,
+        face_recognition_models.__version__)
+
+
+def loadCache(cachePath):
+    '''
+    Load the cache of encodings.
+
+    :param `cachePath`: path to the cache file.\n
+    :return The `cache` dictionary, mapping each key to the array of
+    encodings of the image (empty if the cache can't be read).
+    '''
+    try:
+        with np.load(cachePath, allow_pickle=False) as data:
+            keys, counts, cached = data["keys"], data["counts"], data["encodings"]
+    except (IOError, ValueError, KeyError):
+        # Does not exist yet, or it is not a valid cache file
+        return {}
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return {str(key): cached[offsets[i]:offsets[i + 1]]
+        for (i, key) in enumerate(keys)}
+
+
+def saveCache(cachePath, cache):
+    '''
+    Save the cache of encodings, replacing the previous one.
+
+    :param `cachePath`: path to the cache file.\n
+    :param `cache`: the cache dictionary to save.
+    '''
+    keys = sorted(cache)
+    counts = np.array([len(cache[key]) for key in keys], dtype=np.int64)
+    cached = [np.asarray(cache[key], dtype=np.float64).reshape(-1, 128)
+        for key in keys]
+    cached = np.concatenate(cached) if cached else np.zeros((0, 128))
+    with open(cachePath + ".tmp", "wb") as file:
+        np.savez(file, keys=np.array(keys, dtype=np.str_), counts=counts,
+            encodings=cached)
+    os.replace(cachePath + ".tmp", cachePath)
+
 
-def main(dataset='images/known_people', encodings='encodings.pickle',
-    detection_method='hog'):
+def encodeImage(data, detection_method):
+    '''
+    Detect and encode the faces of an image.
+
+    :param `data`: content of the image file (bytes).\n
+    :param `detection_method`: face detection model to use: either `'hog'`
+    or `'cnn'`.\n
+    :return The `list of encodings` of the faces found in the image.
+    '''
+    # Load the input image and convert it from RGB (OpenCV ordering)
+    # to RGB (dlib ordering, which face_recognition uses)
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    # Detect the (x, y)-coordinates of the bounding face locations
+    # corresponding to each face in the input image, and then compute
+    # the facial embeddings for each face
+    face_locations = face_recognition.face_locations(rgb,
+        model=detection_method)
+    return face_recognition.face_encodings(rgb, face_locations)
+
+
+def encodeWorker(task):
+    '''
+    Encode an image of the dataset inside a worker process of the pool.
+
+    :param `task`: tuple with the position of the image in the list of
+    images to encode, the number of images to encode, the path to the image
+    and the face detection model to use.\n
+    :return The `list of encodings` of the faces found in the image.
+    '''
+    (i, total, imagePath, detection_method) = task
+    with open(imagePath, "rb") as file:
+        face_encodings = encodeImage(file.read(), detection_method)
+    print(f"[INFO] {multiprocessing.current_process().name}: encoded image "
+        +f"{i + 1}/{total} ({len(face_encodings)} faces)", flush=True)
+    return face_encodings
+
+
+def main(dataset='images/known_people', encodings='encodings.bin',
+    detection_method='hog', use_cache=True, workers=1, index=None,
+    compact=0, compact_method='medoids', progress=None):
     '''
     Performs the encodings update.
 
     :param `dataset`: path to input directory of face images to encode 
     (default: `'images/known_people'`).\n
-    :param `encodings`: output path to serialized db of facial encodings 
-    (default: `'encodings.pickle'`).\n
+    :param `encodings`: output path to the store of facial encodings 
+    (default: `'encodings.bin'`).\n
     :param `encode_detection_method`: face detection model to use for 
-    encodings: either `'hog'` or `'cnn'` (default: `'hog'`).
+    encodings: either `'hog'` or `'cnn'` (default: `'hog'`).\n
+    :param `use_cache`: whether or not to reuse the cached encodings of the
+    images that haven't changed (default: `True`).\n
+    :param `workers`: number of worker processes encoding the images in
+    parallel, or `0` to use one per available core (default: `1`, encode
+    them in this process).\n
+    :param `index`: whether or not to build the approximate index of the
+    encodings (default: `None`, only when there are at least
+    `faceIndex.MIN_SIZE` encodings).\n
+    :param `compact`: max number of prototypes kept per identity (default:
+    `0`, keep all the encodings).\n
+    :param `compact_method`: prototypes of the compaction: either
+    `'medoids'` or `'centroids'` (default: `'medoids'`).\n
+    :param `progress`: function called with the number of images done and
+    the number of images to encode, after each image is encoded (default:
+    `None`).\n
+    :return The `statistics` of the run: number of images `reused` from the
+    cache, `added` (encoded) and `removed` from the cache, and number of
+    `encodings` written.
     '''
     # Check if the input path for the dataset folder has "/" at the end, and
     # remove it if does
@@ -54,24 +184,71 @@ def main(dataset='images/known_people', encodings='encodings.pickle',
     known_face_encodings = []
     known_face_names = []
 
+    # Load the cache of encodings. The new cache only keeps the entries of
+    # the current images (with any detection method), so the deleted images
+    # (or folders) are dropped
+    cachePath = encodings + ".cache"
+    cache = loadCache(cachePath) if use_cache else {}
+    newCache = {}
+    pending = {}
+    version = "%s_%s" % (detection_method, modelVersion())
+    hashes = set()          # Content hashes of the current images
+
     if len(imagePaths) != 0:
+        # Compute the cache key of each image and find the ones that must be
+        # encoded (new or changed since the last run)
+        print("[INFO] checking images against the cache...", end=" ")
+        keys = []
+        for imagePath in imagePaths:
+            with open(imagePath, "rb") as file:
+                digest = hashlib.sha1(file.read()).hexdigest()
+            hashes.add(digest)
+            key = "%s_%s" % (digest, version)
+            keys.append(key)
+            if key not in cache and key not in pending:
+                pending[key] = imagePath
+        print("DONE")
+
+        # Detect and encode the faces of the pending images, serially or with
+        # a pool of workers. The results are gathered in the order of the
+        # images, so the output is the same in both cases
+        pendingKeys = list(pending)
+        if progress is not None:
+            progress(0, len(pendingKeys))
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(pendingKeys))
+        if workers > 1 and multiprocessing.current_process().daemon:
+            print("[WARNING] daemonic processes can't start workers, the "
+                +"images will be encoded in this process")
+            workers = 1
+        if workers > 1:
+            print(f"[INFO] encoding {len(pendingKeys)} images with "
+                +f"{workers} workers...")
+            tasks = [(i, len(pendingKeys), pending[key], detection_method)
+                for (i, key) in enumerate(pendingKeys)]
+            with multiprocessing.Pool(workers) as pool:
+                results = pool.imap(encodeWorker, tasks)
+                for (i, key) in enumerate(pendingKeys):
+                    cache[key] = next(results)
+                    if progress is not None:
+                        progress(i + 1, len(pendingKeys))
+        else:
+            for (i, key) in enumerate(pendingKeys):
+                print(f"[INFO] processing image {i + 1}/{len(pendingKeys)}...",
+                    end=" ")
+                with open(pending[key], "rb") as file:
+                    cache[key] = encodeImage(file.read(), detection_method)
+                print("DONE")
+                if progress is not None:
+                    progress(i + 1, len(pendingKeys))
+
         # Loop over the image paths
-        for (i, imagePath) in enumerate(imagePaths):
+        for (imagePath, key) in zip(imagePaths, keys):
             # Extract the person name from the image path
-            print(f"[INFO] processing image {i + 1}/{len(imagePaths)}...", end=" ")
             name = imagePath.split(os.path.sep)[-2]
-
-            # Load the input image and convert it from RGB (OpenCV ordering)
-            # to RGB (dlib ordering, which face_recognition uses)
-            image = cv2.imread(imagePath)
-            rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-            # Detect the (x, y)-coordinates of the bounding face locations
-            # corresponding to each face in the input image, and then compute
-            # the facial embeddings for each face
-            face_locations = face_recognition.face_locations(rgb,
-                model=detection_method)
-            face_encodings = face_recognition.face_encodings(rgb, face_locations)
+            face_encodings = cache[key]
+            newCache[key] = face_encodings
 
             # Loop over the encodings
             for encoding in face_encodings:
@@ -79,18 +256,57 @@ def main(dataset='images/known_people', encodings='encodings.pickle',
                 # encodings
                 known_face_encodings.append(encoding)
                 known_face_names.append(name)
-            print("DONE")
-        else:
-            print("[INFO] dataset is empty, please check the input path. The "
-                +"program will run anyway")
+    else:
+        print("[INFO] dataset is empty, please check the input path. The "
+            +"program will run anyway")
+    # Keep the entries of the current images encoded with the other
+    # detection method (same models), so the runs with 'hog' and 'cnn' don't
+    # evict each other's entries
+    models = modelVersion()
+    for (key, face_encodings) in cache.items():
+        if key.split("_", 1)[0] in hashes and (key.split("_", 2)[2:]
+            == [models]):
+            newCache.setdefault(key, face_encodings)
+    added = len(pending)
+    reused = len(imagePaths) - added
+    # Images (contents) in the cache that are no longer in the dataset
+    removed = len(set(key.split("_", 1)[0] for key in cache) - hashes)
+    print(f"[INFO] images reused from cache: {reused}, added: {added}, "
+        +f"removed: {removed}")
+
+    # Reduce the encodings of each identity to a few prototypes (if enabled),
+    # reporting the impact on a held-out split of the gallery. The cache keeps
+    # all the encodings
+    if compact > 0 and known_face_names:
+        print("[INFO] compacting encodings...")
+        faceCompact.report(faceCompact.evaluate(known_face_encodings,
+            known_face_names, compact, compact_method))
+        (known_face_encodings, known_face_names) = faceCompact.compact(
+            known_face_encodings, known_face_names, compact, compact_method)
+
+    # Build the approximate index of the encodings, or remove the previous
+    # one (it wouldn't match the new store anyway). The index is written
+    # before the store, so the live recognition reloading the new store finds
+    # its index
+    indexPath = faceIndex.index_path(encodings)
+    if index is None:
+        index = len(known_face_names) >= faceIndex.MIN_SIZE
+    if index and known_face_names:
+        print("[INFO] Indexing encodings...", end=" ")
+        faceIndex.save(indexPath, faceIndex.build(encodingStore.group(
+            known_face_encodings, known_face_names)[0]))
+        print("DONE")
+    elif os.path.exists(indexPath):
+        os.remove(indexPath)
 
-    # Dump the facial encodings + names to disk
+    # Write the facial encodings + names to the store on disk (replacing the
+    # previous one atomically)
     print("[INFO] Serializing encodings...", end=" ")
-    data = {"encodings": known_face_encodings, "names": known_face_names}
-    f = open(encodings, "wb")
-    f.write(pickle.dumps(data))
-    f.close()
+    encodingStore.save(encodings, known_face_encodings, known_face_names)
+    saveCache(cachePath, newCache)
     print("DONE")
+    return {"reused": reused, "added": added, "removed": removed,
+        "encodings": len(known_face_names)}
 
 @Gooey(program_name="Face Encoder", image_dir='.')
 def argParser():
@@ -99,12 +315,28 @@ def argParser():
     ap.add_argument("-i", "--dataset", type=str, default="images/known_people",
         help="path to input directory of face images.\ndefault: "+
         "'images/known_people'")
-    ap.add_argument("-e", "--encodings", type=str, default="encodings.pickle",
-        help="output path to serialized db of facial encodings "+
-        "\ndefault: 'encodings.pickle'")
+    ap.add_argument("-e", "--encodings", type=str, default="encodings.bin",
+        help="output path to the store of facial encodings "+
+        "\ndefault: 'encodings.bin'")
     ap.add_argument("-d", "--detection-method", type=str, default="hog",
         help="face detection model to use: either `hog` or `cnn`"+
         "\ndefault: 'hog'")
+    ap.add_argument("-w", "--workers", type=int, default=1,
+        help="number of worker processes encoding the images in parallel "+
+        "(`0` to use one per available core)\ndefault: `1`")
+    ap.add_argument("-C", "--cache", type=int, default=1,
+        help="whether or not to reuse the cached encodings of the images "+
+        "that haven't changed\ndefault: `1` (yes)")
+    ap.add_argument("-k", "--compact", type=int, default=0,
+        help="max number of prototypes kept per identity (see faceCompact)"+
+        "\ndefault: `0` (keep all the encodings)")
+    ap.add_argument("-m", "--compact-method", type=str, default="medoids",
+        help="prototypes of the compaction: either `medoids` or `centroids`"+
+        "\ndefault: 'medoids'")
+    ap.add_argument("-x", "--index", type=int, default=-1,
+        help="whether or not to build the approximate index of the encodings "+
+        "for the live recognition (`-1` to build it only for large "+
+        "galleries)\ndefault: `-1`")
     global args
     args = vars(ap.parse_args())
     return args
@@ -118,7 +350,10 @@ if __name__ == "__main__":
     startTime = datetime.now()
 
     # Call the 'main' function with the parsed arguments
-    main(args["dataset"], args["encodings"], args["detection_method"])
+    main(args["dataset"], args["encodings"], args["detection_method"],
+        args["cache"] > 0, args["workers"],
+        None if args["index"] < 0 else args["index"] > 0, args["compact"],
+        args["compact_method"])
 
     # Calculate the elapsed time to make the encodings
     elapsedTime = (datetime.now() - startTime)
@@ -0,0 +1,214 @@
+'''
+Approximate nearest-neighbour index of the gallery of known encodings, for
+very large galleries (hundreds of thousands of encodings), where even the
+vectorized scan of the whole gallery is too slow.
+
+The index is an inverted file: the encodings are clustered with k-means, and
+each encoding is listed under its closest centroid. A face is only compared
+with the encodings of the `nprobe` lists closest to it (the candidates), so
+the search cost depends on the size of the lists instead of the size of the
+gallery. The more lists probed, the higher the recall (and the cost). The
+matcher then re-ranks the best candidates exactly (see `faceMatch`).
+
+The index is built by faceEncode next to the store of encodings (in a '.idx'
+file), and it is ignored if it doesn't match the store (e.g. the store has
+been updated without the index).
+'''
+
+# Import the necessary packages
+import hashlib
+import os
+import numpy as np
+
+
+INDEX_VERSION = 1       # Version of the file layout of the index
+MIN_SIZE = 50000        # Min gallery size to build the index automatically
+
+
+def index_path(encodings_path):
+    '''
+    Path to the index of a store of encodings.
+
+    :param `encodings_path`: path to the store of encodings.\n
+    :return The `path` to the index file.
+    '''
+    return encodings_path + ".idx"
+
+
+def fingerprint(encodings):
+    '''
+    Fingerprint of a gallery, to check that an index was built for it: the
+    hash of its shape and of a sample of its rows.
+
+    :param `encodings`: the N x 128 matrix of encodings.\n
+    :return The `fingerprint`, as an hexadecimal string.
+    '''
+    encodings = np.asarray(encodings, dtype=np.float32)
+    sha1 = hashlib.sha1(str(encodings.shape).encode("utf-8"))
+    if len(encodings):
+        rows = np.linspace(0, len(encodings) - 1, min(1024, len(encodings)))
+        sha1.update(np.ascontiguousarray(
+            encodings[rows.astype(np.int64)]).tobytes())
+    return sha1.hexdigest()
+
+
+def _sq_distances(data, centroids, centroid_sq_norms):
+    # Squared distances (up to the norm of each row of data, which doesn't
+    # change the closest centroid) of each row to each centroid
+    return centroid_sq_norms[None, :] - 2 * np.dot(data, centroids.T)
+
+
+def _assign(data, centroids, chunk=65536):
+    # Closest centroid of each row of data, in chunks to bound the memory
+    centroid_sq_norms = np.einsum("ij,ij->i", centroids, centroids)
+    assignment = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), chunk):
+        assignment[start:start + chunk] = _sq_distances(
+            data[start:start + chunk], centroids, centroid_sq_norms).argmin(
+            axis=1)
+    return assignment
+
+
+def kmeans(data, n_lists, iterations=10, sample=64, seed=0):
+    '''
+    Cluster the rows of data with k-means (Lloyd's algorithm), trained on a
+    random sample of them.
+
+    :param `data`: the N x D float32 matrix.\n
+    :param `n_lists`: number of clusters.\n
+    :param `iterations`: number of iterations (default: `10`).\n
+    :param `sample`: number of rows of the sample per cluster (default:
+    `64`).\n
+    :param `seed`: seed of the random sample and initialization (default:
+    `0`).\n
+    :return The `centroids` (n_lists x D float32 matrix).
+    '''
+    random = np.random.RandomState(seed)
+    if len(data) > n_lists * sample:
+        data = data[np.sort(random.choice(len(data), n_lists * sample,
+            replace=False))]
+    centroids = data[random.choice(len(data), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _assign(data, centroids)
+        counts = np.bincount(assignment, minlength=n_lists)
+        # Sum the rows of each cluster, grouped by cluster
+        order = np.argsort(assignment, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        empty = counts == 0
+        sums = np.add.reduceat(data[order], starts[~empty], axis=0)
+        # The empty clusters are moved to random rows
+        centroids[~empty] = sums / counts[~empty, None]
+        centroids[empty] = data[random.choice(len(data), int(empty.sum()))]
+    return centroids
+
+
+class FaceIndex(object):
+    '''
+    Creates a FaceIndex object (see `build` and `load`).
+
+    :param `centroids`: the L x 128 float32 matrix of centroids.\n
+    :param `rows`: the gallery rows, sorted by list.\n
+    :param `offsets`: the L + 1 offsets of each list in `rows`.\n
+    :param `fingerprint`: fingerprint of the gallery indexed.\n
+    '''
+
+    def __init__(self, centroids, rows, offsets, fingerprint):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.centroid_sq_norms = np.einsum("ij,ij->i", self.centroids,
+            self.centroids)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.fingerprint = fingerprint
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def probe(self, query, nprobe=8):
+        '''
+        Find the candidates of the faces: the gallery rows listed under the
+        `nprobe` centroids closest to each face.
+
+        :param `query`: the F x 128 float32 matrix of face encodings.\n
+        :param `nprobe`: number of lists probed per face (default: `8`).\n
+        :return The sorted array of candidate `rows` of all the faces.
+        '''
+        nprobe = min(nprobe, self.n_lists)
+        distances = _sq_distances(query, self.centroids,
+            self.centroid_sq_norms)
+        if nprobe < self.n_lists:
+            lists = np.argpartition(distances, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            lists = np.tile(np.arange(self.n_lists), (len(query), 1))
+        lists = np.unique(lists)
+        rows = [self.rows[self.offsets[l]:self.offsets[l + 1]] for l in lists]
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(rows))
+
+
+def build(encodings, n_lists=None, iterations=10, seed=0):
+    '''
+    Build the index of a gallery.
+
+    :param `encodings`: the N x 128 matrix of encodings of the gallery.\n
+    :param `n_lists`: number of lists (default: `None`, 4 x sqrt(N), so each
+    list has about sqrt(N) / 4 encodings).\n
+    :param `iterations`: number of iterations of k-means (default: `10`).\n
+    :param `seed`: seed of k-means (default: `0`).\n
+    :return The `FaceIndex` object.
+    '''
+    encodings = np.asarray(encodings, dtype=np.float32)
+    if len(encodings) == 0:
+        raise ValueError("[ERROR] unable to index an empty gallery")
+    if n_lists is None:
+        n_lists = int(4 * np.sqrt(len(encodings)))
+    n_lists = max(1, min(n_lists, len(encodings)))
+    centroids = kmeans(encodings, n_lists, iterations, seed=seed)
+    assignment = _assign(encodings, centroids)
+    rows = np.argsort(assignment, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment,
+        minlength=n_lists))))
+    return FaceIndex(centroids, rows, offsets, fingerprint(encodings))
+
+
+def save(path, index):
+    '''
+    Write an index, replacing the previous one.
+
+    :param `path`: output path of the index file.\n
+    :param `index`: the FaceIndex object.\n
+    '''
+    with open(path + ".tmp", "wb") as file:
+        np.savez(file, version=INDEX_VERSION, centroids=index.centroids,
+            rows=index.rows, offsets=index.offsets,
+            fingerprint=np.array(index.fingerprint))
+    os.replace(path + ".tmp", path)
+
+
+def load(path, encodings):
+    '''
+    Load the index of a gallery, if it exists and it matches the gallery.
+
+    :param `path`: input path of the index file.\n
+    :param `encodings`: the N x 128 matrix of encodings of the gallery.\n
+    :return The `FaceIndex` object, or `None` if there isn't a valid index
+    (the gallery must be scanned exhaustively).
+    '''
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) > INDEX_VERSION:
+                raise ValueError("unsupported version")
+            index = FaceIndex(data["centroids"], data["rows"],
+                data["offsets"], str(data["fingerprint"]))
+    except (IOError, ValueError, KeyError) as e:
+        print("[WARNING] unable to read the index '%s' (%s), the gallery will "
+            % (path, e) + "be scanned exhaustively")
+        return None
+    if index.fingerprint != fingerprint(encodings):
+        print("[WARNING] the index '%s' doesn't match the encodings, the "
+            % path + "gallery will be scanned exhaustively")
+        return None
+    return index
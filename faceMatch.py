@@ -0,0 +1,319 @@
+'''
+Vectorized matching of live facial encodings against the known encodings.
+
+The known encodings (the gallery) are kept as a single contiguous float32
+matrix, one row per encoding, with a parallel array of integer labels pointing
+to the identity (folder name) each row belongs to. The rows are grouped by
+identity, so the distances of all the faces of a frame against the whole
+gallery are computed in one batched operation, and then reduced per identity
+(best distance and number of votes) without looping over the encodings in
+Python.
+
+When the CWID of the subject is already known (from the swiped card), the
+matcher can also verify the faces only against the encodings of that subject
+(1:1 verification), optionally normalizing the scores against a small
+background set of impostor encodings from other subjects.
+
+For very large galleries, an approximate index (see `faceIndex`) can narrow
+the identification down to a few candidate identities, whose encodings are
+then all compared exactly.
+'''
+
+# Import the necessary packages
+import numpy as np
+
+
+class FaceMatcher(object):
+    '''
+    Creates a FaceMatcher object.
+
+    :param `encodings`: list (or N x 128 array) of known facial encodings.\n
+    :param `names`: list with the identity (folder name) of each encoding, in
+    the same order as `encodings`.\n
+    :param `impostors`: number of encodings to keep as background impostor
+    set for the score normalization of the 1:1 verification (default: `0`,
+    no normalization).\n
+    :param `index`: approximate index of the gallery (a FaceIndex object), to
+    identify the faces without scanning the whole gallery (default: `None`,
+    exhaustive scan).\n
+    :param `nprobe`: number of lists of the index probed per face. The higher,
+    the higher the recall. `0` to always scan the whole gallery (default:
+    `8`).\n
+    :param `top_k`: number of closest candidate encodings per face whose
+    identities are re-ranked exactly (default: `32`).\n
+    '''
+
+    def __init__(self, encodings, names, impostors=0, index=None, nprobe=8,
+        top_k=32):
+        if len(encodings) != len(names):
+            raise ValueError("[ERROR] the number of encodings and names of "
+                +"the gallery don't match")
+
+        # Assign an integer label to each identity, in order of first
+        # appearance in the list of names
+        identities = []
+        label_of = {}
+        for name in names:
+            if name not in label_of:
+                label_of[name] = len(identities)
+                identities.append(name)
+        labels = np.array([label_of[name] for name in names], dtype=np.int32)
+        self._build(encodings, labels, identities, impostors, index, nprobe,
+            top_k)
+
+    @classmethod
+    def from_store(cls, store, impostors=0, index=None, nprobe=8, top_k=32):
+        '''
+        Create a FaceMatcher from a store of encodings (see `encodingStore`).
+        The encodings of the store are already grouped by identity, so the
+        gallery is used in place, without copying it.
+
+        :param `store`: the EncodingStore object.\n
+        :param `impostors`: number of encodings to keep as background impostor
+        set for the score normalization of the 1:1 verification (default:
+        `0`).\n
+        :param `index`: approximate index of the store (default: `None`).\n
+        :param `nprobe`: number of lists of the index probed per face
+        (default: `8`).\n
+        :param `top_k`: number of candidate encodings per face re-ranked
+        exactly (default: `32`).\n
+        :return The `FaceMatcher` object.
+        '''
+        matcher = cls.__new__(cls)
+        matcher._build(store.encodings, store.labels, store.identities,
+            impostors, index, nprobe, top_k)
+        # Keep the store mapped as long as the matcher uses it
+        matcher.store = store
+        matcher.version = store.version
+        return matcher
+
+    def _build(self, encodings, labels, identities, impostors, index=None,
+        nprobe=8, top_k=32):
+        self.identities = list(identities)
+        self.store = None
+        self.version = ""
+        labels = np.asarray(labels, dtype=np.int32)
+        gallery = np.asarray(encodings, dtype=np.float32)
+        if gallery.size == 0:
+            gallery = gallery.reshape(0, 128)
+
+        # Group the rows of the gallery by identity (stable, so the order of
+        # the encodings of each identity is kept), unless they already are
+        if np.any(labels[1:] < labels[:-1]):
+            order = np.argsort(labels, kind="stable")
+            gallery = gallery[order]
+            labels = labels[order]
+            if index is not None:
+                # The rows of the index point to the original order
+                print("[WARNING] the gallery isn't grouped by identity, the "
+                    +"index is ignored")
+                index = None
+        self.gallery = np.ascontiguousarray(gallery)
+        self.labels = labels
+        self.sq_norms = np.einsum("ij,ij->i", self.gallery, self.gallery)
+
+        # First row of each identity in the gallery (for the per identity
+        # reductions)
+        self.starts = np.searchsorted(self.labels,
+            np.arange(len(self.identities)))
+
+        # Gallery rows of each CWID (the first 9 characters of the folder
+        # name), for the 1:1 verification
+        stops = np.append(self.starts[1:], len(self.labels))
+        self.cwid_rows = {}
+        for (label, identity) in enumerate(self.identities):
+            rows = np.arange(self.starts[label], stops[label])
+            cwid = identity[:9]
+            if cwid in self.cwid_rows:
+                rows = np.concatenate((self.cwid_rows[cwid], rows))
+            self.cwid_rows[cwid] = rows
+
+        # Background impostor set, evenly spread over the whole gallery
+        n_rows = len(self.labels)
+        if impostors > 0 and n_rows > 0:
+            self.impostor_rows = np.unique(np.linspace(0, n_rows - 1,
+                min(impostors, n_rows)).astype(np.int64))
+        else:
+            self.impostor_rows = np.zeros(0, dtype=np.int64)
+
+        # Approximate index (if any)
+        self.index = index
+        self.nprobe = nprobe
+        self.top_k = top_k
+
+    def __len__(self):
+        return self.gallery.shape[0]
+
+    def _query(self, encodings):
+        # Convert the input encodings into a F x 128 float32 matrix
+        return np.asarray(encodings, dtype=np.float32).reshape(-1,
+            self.gallery.shape[1])
+
+    def _distances(self, query, rows=None):
+        # Distances of each encoding of the query to the gallery rows (all of
+        # them if not given)
+        if rows is None:
+            gallery, sq_norms = self.gallery, self.sq_norms
+        else:
+            gallery, sq_norms = self.gallery[rows], self.sq_norms[rows]
+        q_sq_norms = np.einsum("ij,ij->i", query, query)
+        # |a - b|^2 = |a|^2 + |b|^2 - 2ab, with all the products in one
+        # matrix multiplication
+        distances = np.dot(query, gallery.T)
+        distances *= -2
+        distances += q_sq_norms[:, None]
+        distances += sq_norms[None, :]
+        np.maximum(distances, 0, out=distances)
+        return np.sqrt(distances, out=distances)
+
+    def face_distance(self, encodings):
+        '''
+        Compute the euclidean distance of each face encoding to every known
+        encoding of the gallery.
+
+        :param `encodings`: list (or F x 128 array) of facial encodings.\n
+        :return The `F x N` float32 matrix of distances.
+        '''
+        return self._distances(self._query(encodings))
+
+    def match(self, encodings, tolerance=0.55):
+        '''
+        Match each face encoding against the whole gallery.
+
+        :param `encodings`: list (or F x 128 array) of facial encodings.\n
+        :param `tolerance`: max distance between two encodings for them to be
+        considered a match (default: `0.55`).\n
+        :return The `best distance` (F x K float32 matrix) and the number of
+        `votes` (F x K int matrix) of each face for each of the K identities.
+        '''
+        n_faces = len(encodings)
+        n_identities = len(self.identities)
+        if n_faces == 0 or n_identities == 0:
+            return (np.full((n_faces, n_identities), np.inf, dtype=np.float32),
+                np.zeros((n_faces, n_identities), dtype=np.int64))
+        if self.index is not None and self.nprobe > 0:
+            return self._match_candidates(self._query(encodings), tolerance)
+        distances = self.face_distance(encodings)
+        best = np.minimum.reduceat(distances, self.starts, axis=1)
+        votes = np.add.reduceat((distances <= tolerance).astype(np.int64),
+            self.starts, axis=1)
+        return best, votes
+
+    def _match_candidates(self, query, tolerance):
+        # Match the faces only against the candidate identities: the
+        # identities of the `top_k` closest encodings among the lists of the
+        # index probed. All the encodings of the candidate identities are
+        # compared (exact re-ranking), so their best distance and votes are
+        # the same as with the exhaustive scan. The other identities get an
+        # infinite distance and no votes
+        n_faces = query.shape[0]
+        best = np.full((n_faces, len(self.identities)), np.inf,
+            dtype=np.float32)
+        votes = np.zeros((n_faces, len(self.identities)), dtype=np.int64)
+        rows = self.index.probe(query, self.nprobe)
+        if len(rows) == 0:
+            return best, votes
+        distances = self._distances(query, rows)
+        k = min(self.top_k, len(rows))
+        closest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        candidates = np.unique(self.labels[rows[closest]])
+
+        # All the rows of the candidate identities (grouped by identity)
+        stops = np.append(self.starts[1:], len(self.labels))
+        rows = np.concatenate([np.arange(self.starts[label], stops[label])
+            for label in candidates])
+        distances = self._distances(query, rows)
+        starts = np.searchsorted(self.labels[rows], candidates)
+        best[:, candidates] = np.minimum.reduceat(distances, starts, axis=1)
+        votes[:, candidates] = np.add.reduceat((distances <= tolerance).astype(
+            np.int64), starts, axis=1)
+        return best, votes
+
+    def identify(self, encodings, tolerance=0.55, scores=None):
+        '''
+        Identify each face encoding as the identity with the largest number of
+        matches (votes) in the gallery. In the event of a tie, the identity
+        with the smallest distance is selected.
+
+        :param `encodings`: list (or F x 128 array) of facial encodings.\n
+        :param `tolerance`: max distance between two encodings for them to be
+        considered a match (default: `0.55`).\n
+        :param `scores`: the best distances and votes already computed by
+        `match`, if any (default: `None`).\n
+        :return The list of `names` recognized (`"Unknown"` for the faces
+        without any match).
+        '''
+        best, votes = scores or self.match(encodings, tolerance)
+        if votes.shape[1] == 0:
+            return ["Unknown"] * votes.shape[0]
+        top_votes = votes.max(axis=1)
+        best = np.where(votes == top_votes[:, None], best, np.inf)
+        winners = best.argmin(axis=1)
+        return [self.identities[w] if v > 0 else "Unknown"
+            for (w, v) in zip(winners, top_votes)]
+
+    def identity(self, cwid):
+        '''
+        Get the identity (folder name) of the subject with the given CWID.
+
+        :param `cwid`: CWID of the subject.\n
+        :return The `identity`, or `None` if the subject isn't known.
+        '''
+        rows = self.cwid_rows.get(cwid)
+        if rows is None:
+            return None
+        return self.identities[self.labels[rows[0]]]
+
+    def verify_scores(self, encodings, cwid, tolerance=0.55):
+        '''
+        Match each face encoding only against the encodings of the subject
+        with the given CWID (and against the background impostor set, if
+        any).
+
+        :param `encodings`: list (or F x 128 array) of facial encodings.\n
+        :param `cwid`: CWID of the subject claimed by the swiped card.\n
+        :param `tolerance`: max distance between two encodings for them to be
+        considered a match (default: `0.55`).\n
+        :return The `best distance` to the subject, the number of `votes` for
+        the subject and the best distance to the `impostors` (`inf` if there
+        isn't any) of each face, as arrays of length F.
+        '''
+        n_faces = len(encodings)
+        best = np.full(n_faces, np.inf, dtype=np.float32)
+        votes = np.zeros(n_faces, dtype=np.int64)
+        impostor = np.full(n_faces, np.inf, dtype=np.float32)
+        rows = self.cwid_rows.get(cwid)
+        if n_faces == 0 or rows is None:
+            return best, votes, impostor
+        query = self._query(encodings)
+        distances = self._distances(query, rows)
+        best = distances.min(axis=1)
+        votes = (distances <= tolerance).sum(axis=1)
+        impostor_rows = self.impostor_rows[
+            ~np.isin(self.impostor_rows, rows)]
+        if len(impostor_rows):
+            impostor = self._distances(query, impostor_rows).min(axis=1)
+        return best, votes, impostor
+
+    def verify(self, encodings, cwid, tolerance=0.55, scores=None):
+        '''
+        Verify each face encoding against the subject with the given CWID. A
+        face is verified if it matches any of the encodings of the subject,
+        and it is closer to them than to any of the background impostors.
+
+        :param `encodings`: list (or F x 128 array) of facial encodings.\n
+        :param `cwid`: CWID of the subject claimed by the swiped card.\n
+        :param `tolerance`: max distance between two encodings for them to be
+        considered a match (default: `0.55`).\n
+        :param `scores`: the scores already computed by `verify_scores`, if
+        any (default: `None`).\n
+        :return The list of `names`: the identity (folder name) of the subject
+        for the faces verified, `"Unknown"` for the rest.
+        '''
+        best, votes, impostor = scores or self.verify_scores(encodings, cwid,
+            tolerance)
+        name = self.identity(cwid)
+        if name is None:
+            return ["Unknown"] * len(best)
+        return [name if (v > 0 and b < i) else "Unknown"
+            for (b, v, i) in zip(best, votes, impostor)]
@@ -5,25 +5,35 @@ This module can also be runned as an independent script.
 
 Usage examples:
     python faceRecon.py
-    python faceRecon.py --encodings myEncodings.pickle --display 0 \
+    python faceRecon.py --encodings myEncodings.bin --display 0 \
 --detection-method cnn
-Default params are '--encodings encodings.pickle --display 1 \
+Default params are '--encodings encodings.bin --display 1 \
 --detection-method hog'
 '''
 
 # Import the necessary packages
 from datetime import datetime
 from argparse import RawTextHelpFormatter
-from imutils.video import VideoStream
 from gooey import Gooey, GooeyParser
 import cv2
 import face_recognition
 import argparse
 import os
 import sys
-import pickle
+import threading
 import time
 import imutils
+import numpy as np
+import captureWriter
+import faceDecision
+import faceIndex
+import faceMatch
+import faceTrack
+import motionGate
+import encodingStore
+import framePipeline
+import frameSource
+import metrics
 
 
 # Initialize some variables
@@ -36,16 +46,37 @@ known_count = {}        # Dictionnary to count the number of times each known
 unknown_count = 0       # Number of times an unknown subject is detected
 unknown_count_max = 15  # Max number of pictures taken of an unknown subject
 unknown_max_reached = False # Boolean: 
+faces_count = 0         # Number of distinct faces seen during the session
 granted = []            # List of subject with granted access
 grantedCWIDs = []       # List of the CWIDs from subject with granted access
 now = datetime.now()    # For the unknown folder path name
 maxElapsedTime = 15     # Max number of seconds with recognition mode on
+votes_updated = threading.Condition()   # Notified by the recognition each
+                        # time the counts of known/unknown subjects change
+tolerance = 0.55        # Max distance between two encodings to be a match
+
+# Metrics of the video pipeline (served by faceSec on '/metrics')
+stage_seconds = dict((stage, metrics.histogram("facesec_stage_seconds",
+    "Latency of each stage of the processing of a frame", stage=stage))
+    for stage in ("motion", "convert", "detect", "track", "encode", "match",
+    "unknown", "annotate", "jpeg"))
+frames_captured = metrics.counter("facesec_frames_captured_total",
+    "Frames read from the camera")
+frames_processed = metrics.counter("facesec_frames_processed_total",
+    "Frames processed by the recognition")
+frames_dropped = metrics.counter("facesec_frames_dropped_total",
+    "Frames dropped (captured while the recognition was busy)")
+frames_skipped = metrics.counter("facesec_frames_skipped_total",
+    "Frames skipped by the motion gate")
+faces_per_frame = metrics.histogram("facesec_faces_per_frame",
+    "Faces on each frame processed", buckets=(0, 1, 2, 3, 5, 10))
 
 def startup():
-    global known_count, unknown_count, unknown_max_reached
+    global known_count, unknown_count, unknown_max_reached, faces_count
     global granted, grantedCWIDs, now
     known_count = {}
     unknown_count = 0
+    faces_count = 0
     unknown_max_reached = False
     granted = []
     grantedCWIDs = [] 
@@ -54,6 +85,14 @@ def startup():
 class VideoCamera(object):
     '''
     Creates a VideoCamera object.
+
+    Once started, the frames are processed by independent stages connected by
+    "latest-frame-wins" slots: a capture thread reading the frames from the
+    camera, a recognition thread always working on the newest frame (the
+    stale ones are dropped), and the annotation and encoding of the frames
+    for the video stream (see `get_frame`), which draws the most recent
+    recognition results. So a slow recognition never stalls the video stream,
+    and a slow viewer never stalls the recognition.
     
     :param `encodings`: input path to serialized db of facial encodings.\n
     :param `recon_detection_method`: face detection model to use for live 
@@ -63,17 +102,48 @@ class VideoCamera(object):
     halved if `'cnn'` is used) (default: `15`).\n
     :param `doRecon`: whether or not to the program is on recognition mode 
     (and frames should be processed) (default: `False`).\n
+    :param `impostors`: number of encodings kept as background impostor set
+    for the score normalization of the 1:1 verification (default: `0`).\n
+    :param `detect_every`: run the face detection every N frames, and track
+    the faces in between, encoding each face only when it is new or its
+    quality improves (default: `1`, detect and encode on every frame).\n
+    :param `motion_sensitivity`: min fraction of the pixels that must change
+    for a frame to be processed, when there weren't faces on the previous
+    one. The frames without motion are skipped (default: `0`, process all
+    the frames).\n
+    :param `decision`: SequentialDecision object granting the access as soon
+    as the evidence of the match distances is enough, instead of waiting for
+    `known_count_max` matches (default: `None`, grant by the count only).\n
+    :param `sessions`: output path to the file where the recognition sessions
+    are recorded, to calibrate the decision (default: `None`, not recorded).\n
+    :param `sequential`: whether or not the `decision` grants (or refuses)
+    the access. If not, it only records the sessions, to calibrate it before
+    enabling it (default: `True`).\n
+    :param `full_frame`: whether or not to store the whole frame of each
+    capture of an unknown subject, besides the crop of the face (default:
+    `False`).\n
+    :param `source`: source of the frames: index of a camera, `'synthetic'`,
+    path to a folder of images or path to a video file (default: `0`, the
+    default camera).\n
+    :param `source_rate`: frames per second of the replayed sources (default:
+    `None`, free-running).\n
+    :param `nprobe`: number of lists of the approximate index of the gallery
+    (if any, see faceIndex) probed per face. The higher, the higher the
+    recall (default: `8`, `0` to always scan the whole gallery).\n
+    :param `watch_interval`: number of seconds between the checks of the
+    store of encodings (and of its index): when it's replaced, the encodings
+    are reloaded in the background (default: `5`, `0` to not watch it).\n
     '''
 
     def __init__(self, pathToUnknown, encodings, detection_method,
-        known_count_max=15, doRecon=False):
+        known_count_max=15, doRecon=False, impostors=0, detect_every=1,
+        motion_sensitivity=0, decision=None, sessions=None, full_frame=False,
+        source=0, source_rate=None, nprobe=8, watch_interval=5,
+        sequential=True):
         print("############### OPEN CAMERA ###############")
-        ## NOTE: If using pure OpenCV (instead of 'VideoStream' from
-        ## imutils.video), uncomment the following line and comment the one
-        ## from the 'start' function saying "self.stream = VideoStream(src=0)".
-        ## Also, in the 'def __del__(self):' function, uncomment the first line
-        ## and comment the second one
-        # self.video_stream = cv2.VideoCapture(0)
+        ## NOTE: The frames are read from the source (a camera, with pure
+        ## OpenCV, or a replayed video, see frameSource) on a dedicated capture
+        ## thread, launched by the 'start' function
 
         # Check if the input path for the dataset folder has "/" at the end, and
         # add it if doesn't
@@ -85,67 +155,297 @@ class VideoCamera(object):
         self.detection_method = detection_method
         self.known_count_max = known_count_max
         self.doRecon = doRecon
+        self.impostors = impostors
+        self.nprobe = nprobe
+        # CWID of the subject to verify (1:1) during the recognition session.
+        # If None, the faces are identified against the whole gallery (1:N)
+        self.expected_CWID = None
+        # Function called once the first frame of the recognition session is
+        # processed (e.g. to show that the recognition started)
+        self.on_start = None
+        # Tracker of the faces between detections (if enabled)
+        self.tracker = None
+        if detect_every > 1:
+            self.tracker = faceTrack.FaceTracker(detect_every)
+        # Detector of motion to skip the static frames (if enabled), and
+        # number of faces found on the last frame processed
+        self.motion_gate = None
+        if motion_sensitivity > 0:
+            self.motion_gate = motionGate.MotionGate(motion_sensitivity)
+        self.faces_seen = 0
+        # Writer of the captures of unknown subjects (on its own thread),
+        # skipping the near-duplicates, and whether or not to also store the
+        # whole frame of each capture
+        self.capture_writer = captureWriter.CaptureWriter()
+        self.capture_dedup = captureWriter.CaptureDeduplicator()
+        self.full_frame = full_frame
+        # Sequential decision of the access (if enabled), and file of the
+        # recorded sessions
+        self.decision = decision
+        self.sessions = sessions
+        self.sequential = sequential
+        # Matcher of the current encodings, replaced as a whole when they are
+        # reloaded, and signature of the files it was loaded from
+        self.reload_lock = threading.Lock()
+        self.watch_interval = watch_interval
         self.load_encodings()
+        self.files_signature = self._files_signature()
+
+        # Slots connecting the stages of the pipeline: the latest frame
+        # captured and the latest faces recognized
+        self.frames = framePipeline.LatestSlot()
+        self.overlay = framePipeline.LatestSlot()
+        self.source = source
+        self.source_rate = source_rate
+        self.stream = None
+        self.threads = []
+        self.stop_event = threading.Event()
+        # Sequence number of the last frame returned to each thread
+        self.local = threading.local()
     
     def __del__(self):
-        # self.video_stream.release()
-        self.stream.stop()
-
-    def start(self):
-		# Start capturing the video stream from device 0
+        self.stop()
+
+    def start(self, recognition=True):
+        '''
+        Start capturing the video stream from the source and, if
+        `recognition` is set, the recognition thread (otherwise the frames are
+        only processed when calling `get_frame_local`). If the capture has
+        ended (e.g. the camera was disconnected, or the video source has no
+        more frames), the source is opened again and the capture restarted.
+        Nothing is done if it's still running.
+        '''
+        if self.running:
+            return self
         print("[INFO] starting video stream...", end =" ")
-        self.stream = VideoStream(src=0)
+        # Wait for the stages of the previous capture (if any) to end: they
+        # stop once the slot of frames is closed (when the capture ends), so
+        # they must be done before it's opened again. The watcher of the
+        # encodings keeps running. Then release the source to open it again
+        watchers = []
+        for thread in self.threads:
+            if thread.name == "EncodingsWatcher" and thread.is_alive():
+                watchers.append(thread)
+            elif thread is not threading.current_thread():
+                thread.join()
+        if self.stream is not None:
+            self.stream.release()
+        self.frames.reopen()
+        self.stream = frameSource.open_source(self.source, self.source_rate)
+        threads = [threading.Thread(name="Capture", target=self.capture)]
+        if self.watch_interval > 0 and not watchers:
+            threads.append(threading.Thread(name="EncodingsWatcher",
+                target=self.watch_encodings))
+        if recognition:
+            threads.append(threading.Thread(name="Recognition",
+                target=self.recognize_frames))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self.threads = watchers + threads
         print("DONE")
-        return self.stream.start()
-    
+        return self
+
+    @property
+    def running(self):
+        '''
+        Whether or not the frames are being captured from the source.
+        '''
+        return self.stream is not None and not self.frames.closed
+
+    def stop(self):
+        '''
+        Stop the threads of the pipeline and release the camera.
+        '''
+        self.stop_event.set()
+        self.frames.close()
+        self.overlay.close()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=1)
+        if self.stream is not None:
+            self.stream.release()
+            self.stream = None
+        self.capture_writer.close()
+
+    def capture(self):
+        # Capture stage: read the frames from the camera at its own rate, and
+        # publish each one as the latest frame
+        while not self.stop_event.is_set():
+            (grabbed, frame) = self.stream.read()
+            if not grabbed:
+                if self.stream.finished:
+                    print("[INFO] end of the video source")
+                else:
+                    print("[ERROR] camera could not be read. Please check if "
+                        +"it's accesible")
+                break
+            self.frames.put(frame)
+            frames_captured.inc()
+        self.frames.close()
+
+    def recognize_frames(self):
+        # Recognition stage: process the newest frame captured (the frames
+        # captured in the meantime are dropped) while on recognition mode
+        seq = 0
+        last_seq = 0    # Sequence number of the last frame processed
+        while not self.stop_event.is_set():
+            seq, frame = self.frames.get(seq, timeout=0.5)
+            if frame is None:
+                if self.frames.closed:
+                    break
+                continue
+            if not self.doRecon:
+                last_seq = 0
+                self.overlay.clear()
+                if self.tracker is not None:
+                    self.tracker.reset()
+                if self.motion_gate is not None:
+                    self.motion_gate.reset()
+                self.capture_dedup.reset()
+                self.faces_seen = 0
+                continue
+            if last_seq:
+                # The frames captured while the last one was processed
+                frames_dropped.inc(seq - last_seq - 1)
+            last_seq = seq
+            faces = self.recognize(frame)
+            if self.doRecon:
+                self.overlay.put(faces)
+            else:
+                self.overlay.clear()
+
     def read(self):
-		# Return the current frame
-        return self.stream.read()
+        # Return the next frame captured (newer than the last one returned
+        # to the calling thread)
+        last_seq = getattr(self.local, "seq", 0)
+        frame = None
+        while frame is None:
+            seq, frame = self.frames.get(last_seq, timeout=1)
+            if frame is None and self.frames.closed:
+                return None
+        self.local.seq = seq
+        return frame
+
+    def _files_signature(self):
+        # Signature of the store of encodings and of its index: it changes
+        # whenever one of them is replaced
+        signature = []
+        for path in (self.encodings, faceIndex.index_path(self.encodings)):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_ino, stat.st_size, stat.st_mtime))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _build_matcher(self):
+        # Map the store of encodings in memory (the matrix of encodings is
+        # not copied), load the approximate index of the gallery (if any, and
+        # if it matches the store), and build the matcher holding the gallery
+        # of known encodings. Raise IOError or ValueError if the store can't
+        # be loaded
+        store = encodingStore.load(self.encodings)
+        index = None
+        if self.nprobe > 0:
+            index = faceIndex.load(faceIndex.index_path(self.encodings),
+                store.encodings)
+        return faceMatch.FaceMatcher.from_store(store, self.impostors,
+            index=index, nprobe=self.nprobe)
 
     def load_encodings(self):
-        # Load encodings from the known faces
-        print("############### ENCODING RELOADED ###############")
+        # Load encodings from the known faces (at startup: the program can't
+        # run without them)
+        print("############### ENCODING LOADED ###############")
+        # On a fresh checkout there is only the pickle file of encodings:
+        # convert it once into the store of encodings
+        pickle_path = os.path.splitext(self.encodings)[0] + ".pickle"
+        if not os.path.exists(self.encodings) and os.path.exists(pickle_path):
+            print("[INFO] converting '%s' into '%s'..." % (pickle_path,
+                self.encodings), end=" ")
+            try:
+                count = encodingStore.convert(pickle_path, self.encodings)
+                print("DONE (%s encodings)" % count)
+            except Exception as e:
+                print("\n[ERROR] unable to convert '%s': %s"
+                    % (pickle_path, e))
         try:
-            with open(self.encodings, "rb") as file:
-                # self.known_encodings = pickle.loads(file.read())
-                pass
+            self.matcher = self._build_matcher()
         except IOError as e:
             # Does not exist or no read permissions for the encodings file
             print("\n[ERROR] Unable to open file")
             sys.exit(1)
-            # import faceSec, faceEncode, multiprocessing
-            # no_encodings_process = multiprocessing.Process(
-            #     name='Encodings',
-            #     target = faceEncode.main,
-            #     args=(faceSec.args["dataset"], faceSec.args["encodings"],
-            #         faceSec.args["encode_detection_method"]))
-            # no_encodings_process.daemon = True
-            # no_encodings_process.start()
-            # no_encodings_process.join()
-            # faceEncode.main(faceSec.args["dataset"],
-            #     faceSec.args["encodings"], 
-            #     faceSec.args["encode_detection_method"])
-            # time.sleep(1)
-            # faceSec.videoCamera.encodings = faceSec.args["encodings"]
-        self.known_encodings = pickle.loads(open(self.encodings, "rb").read())
+        except ValueError as e:
+            # Not a store of encodings (e.g. an old pickle file)
+            print("\n"+str(e))
+            sys.exit(1)
+        print("[INFO] encodings version '%s' (%s encodings)"
+            % (self.matcher.version, len(self.matcher)))
+
+    def reload_encodings(self, wait=False):
+        '''
+        Reload the encodings in the background: the new matcher is built on
+        its own thread and then replaces the current one at once, between two
+        frames. If the new encodings can't be loaded, the current ones are
+        kept.
+
+        :param `wait`: whether or not to wait until the encodings are
+        reloaded (default: `False`).\n
+        :return The reload `thread`.
+        '''
+        thread = threading.Thread(name="EncodingsReload",
+            target=self._reload_encodings)
+        thread.daemon = True
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def _reload_encodings(self):
+        # Build the new matcher and swap it in (one reload at a time). The
+        # files are only checked again once they change
+        with self.reload_lock:
+            self.files_signature = self._files_signature()
+            try:
+                matcher = self._build_matcher()
+            except (IOError, ValueError) as e:
+                print("[ERROR] unable to reload the encodings, the current "
+                    +"ones are kept: %s" % e)
+                return
+            self.matcher = matcher
+            print("############### ENCODING RELOADED ###############")
+            print("[INFO] encodings version '%s' (%s encodings)"
+                % (matcher.version, len(matcher)))
+
+    def watch_encodings(self):
+        # Watcher stage: reload the encodings whenever the store (or its
+        # index) is replaced, e.g. by the update of the encodings in another
+        # process
+        while not self.stop_event.wait(self.watch_interval):
+            if self._files_signature() != self.files_signature:
+                self._reload_encodings()
     
     def get_frame(self):
-        # Read a frame from the camera
+        # Annotation and encoding stage: read the next frame captured
         frame = self.read()
         if frame is None:
             raise ValueError("[ERROR] camera could not be read. Please check "
                 +"if it's accesible")
 
         # If program is on recognition mode (self.doRecon is set to True),
-        # process the frame to detect and recognize faces
+        # draw the most recent faces recognized (by the recognition thread)
         if self.doRecon:
-            frame = self.process_frame(frame)
+            faces = self.overlay.peek()[1]
+            if faces:
+                with metrics.Timer(stage_seconds["annotate"]):
+                    frame = self.annotate(frame.copy(), faces)
 
         # The generator uses Motion JPEG, but OpenCV defaults to capture raw
         # images, so we must encode it into JPEG in order to correctly display
         # the video stream.
-        ret, jpeg = cv2.imencode('.jpg', frame)
-        return jpeg.tobytes()
+        with metrics.Timer(stage_seconds["jpeg"]):
+            ret, jpeg = cv2.imencode('.jpg', frame)
+            return jpeg.tobytes()
 
     def get_frame_local(self):
         # Read a frame from the camera
@@ -153,103 +453,228 @@ class VideoCamera(object):
 
         # If program is on recognition mode (self.doRecon is set to True),
         # process the frame to detect and recognize faces
-        if self.doRecon:
+        if frame is not None and self.doRecon:
             frame = self.process_frame(frame)
         return frame
 
     def process_frame(self, frame):
         # Process each received frame from the video stream (on recognition
-        # mode)
+        # mode): recognize the faces and draw them on a copy of the frame (the
+        # frame may be shared with other threads, e.g. the capture writer)
+        faces = self.recognize(frame)
+        if not faces:
+            return frame
+        with metrics.Timer(stage_seconds["annotate"]):
+            return self.annotate(frame.copy(), faces)
+
+    def recognize(self, frame):
+        # Detect and recognize the faces of a frame, and return the list of
+        # faces as ((top, right, bottom, left), name) in the coordinates of
+        # the frame
 
         # Not sure why needed, but programs fails without it
-        global unknown_count
+        global unknown_count, faces_count
+
+        # Skip the frames without motion (e.g. the empty hallway), unless
+        # there were faces on the last frame processed
+        if self.motion_gate is not None:
+            with metrics.Timer(stage_seconds["motion"]):
+                moving = self.motion_gate.check(frame,
+                    force=self.faces_seen > 0)
+            if not moving:
+                frames_skipped.inc()
+                return []
+        frames_processed.inc()
+        (on_start, self.on_start) = (self.on_start, None)
+        if on_start is not None:
+            try:
+                on_start()
+            except Exception as e:
+                print("[WARNING] error when starting the recognition: %s" % e)
 
         # Convert the input frame from BGR color (which OpenCV uses) to
         # RGB (which face_recognition uses), and then resize it to 1/4 size 
         # for faster face recognition processing. The resizing is by default
         # 1/4 of the original image, but it can be set to any size.
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        rgb = imutils.resize(rgb, width=int(rgb.shape[1]/4)) # width=400
+        with metrics.Timer(stage_seconds["convert"]):
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            rgb = imutils.resize(rgb, width=int(rgb.shape[1]/4)) # width=400
         r = frame.shape[1] / float(rgb.shape[1])
 
-        # Detect the (x, y)-coordinates of the bounding face locations
-        # corresponding to each face in the input frame, and then compute the
-        # facial embeddings for each face
-        face_locations = face_recognition.face_locations(rgb,
-            model=self.detection_method)
-        face_encodings = face_recognition.face_encodings(rgb, face_locations)
-        names = []
-        
-        # Loop over the facial embeddings
-        for encoding in face_encodings:
-            # Try to match each face in the input image to our known encodings
-            matches = face_recognition.compare_faces(self.known_encodings["encodings"],
-                encoding, tolerance=0.55)
-            name = "Unknown"
-
-            # Check to see if we have found a match
-            if True in matches:
-                # Find the indexes of all matched faces, and then initialize a
-                # dictionary to count the total number of times each face
-                # was matched
-                matched_indexes = [i for (i, b) in enumerate(matches) if b]
-                matched_counts = {}
-
-                # Loop over the matched indexes and count them for each
-                # recognized face
-                for i in matched_indexes:
-                    name = self.known_encodings["names"][i]
-                    matched_counts[name] = matched_counts.get(name, 0) + 1
-
-                # Determine the recognized face with the largest number
-                # of votes. Note that, in the event of an unlikely tie, Python
-                # will select first entry in the dictionary)
-                name = max(matched_counts, key=matched_counts.get)
-                
-                # For each new known face recognized, add a key with its name
-                # to the dictionary that counts the number of times it has
-                # appeared. If the key already exist, increment the number of
-                # times that subject has been recognized
+        if self.tracker is None:
+            # Detect the (x, y)-coordinates of the bounding face locations
+            # corresponding to each face in the input frame, and then compute
+            # the facial embeddings for each face
+            with metrics.Timer(stage_seconds["detect"]):
+                face_locations = face_recognition.face_locations(rgb,
+                    model=self.detection_method)
+            with metrics.Timer(stage_seconds["encode"]):
+                face_encodings = face_recognition.face_encodings(rgb,
+                    face_locations)
+            with metrics.Timer(stage_seconds["match"]):
+                names, distances = self.match(face_encodings)
+        else:
+            # Detect the faces only when needed (every N frames, or when a
+            # track is lost), and follow them in between. Then only encode
+            # (and match) the faces of the new tracks, or of the tracks whose
+            # face has improved
+            locations = None
+            if self.tracker.needs_detection():
+                with metrics.Timer(stage_seconds["detect"]):
+                    locations = face_recognition.face_locations(rgb,
+                        model=self.detection_method)
+            with metrics.Timer(stage_seconds["track"]):
+                tracks = self.tracker.update(rgb, locations)
+            pending = self.tracker.to_encode()
+            distances = {}
+            encoded = {}
+            if pending:
+                with metrics.Timer(stage_seconds["encode"]):
+                    face_encodings = face_recognition.face_encodings(rgb,
+                        [track.box for track in pending])
+                with metrics.Timer(stage_seconds["match"]):
+                    names, distances = self.match(face_encodings)
+                for (track, name, encoding) in zip(pending, names,
+                    face_encodings):
+                    track.identify(name, self.tracker.frame_index)
+                    encoded[track.id] = encoding
+            # The verified tracks (encoded and matched, at most
+            # `reverify_every` frames ago, see faceTrack) vote for their
+            # identity on every frame, so the access is granted after the
+            # same number of frames as without tracker
+            for track in tracks:
+                if track.encoded:
+                    track.votes += 1
+            face_locations = [track.box for track in tracks]
+            face_encodings = [encoded.get(track.id) for track in tracks]
+            names = [track.name for track in tracks]
+
+        # Loop over the identified faces
+        for (name, box, encoding) in zip(names, face_locations,
+            face_encodings):
+            # For each new known face recognized, add a key with its name
+            # to the dictionary that counts the number of times it has
+            # appeared. If the key already exist, increment the number of
+            # times that subject has been recognized
+            if name != "Unknown":
                 if name in known_count:
                     known_count[name] += 1
                 else:
                     known_count[name] = 1
 
             # If there is any unknown subject, start taking pictures of it, by
-            # saving each frame in which he/she is in, within a folder with
-            # the following path:
+            # saving a crop of the face (and optionally the whole frame) in
+            # each frame in which he/she is in, within a folder with the
+            # following path:
             # '%pathToUnknown%/[currentDate]/[currentTimestamp]'
             # Ex: 'images\unknown_people\2019-06-25\105122.890024
+            # The captures nearly identical to one already taken are skipped
             elif name == "Unknown" and unknown_count < unknown_count_max:
+                face = captureWriter.crop(frame,
+                    tuple(int(v * r) for v in box))
+                if self.capture_dedup.is_duplicate(encoding, face):
+                    continue
                 todayFolder = self.pathToUnknown + now.strftime("%Y-%m-%d")
-                # If folder for current date (today) doesn't exit, create it
-                if not os.path.exists(todayFolder):
-                    os.makedirs(todayFolder)
-                    print(f"[INFO] folder for day {todayFolder[-10:]} created. "
-                        +"Unknown subjects detected will be added there")
                 timestampUnknownSubject = now.strftime("%H%M%S.%f")
                 currentCaptureFolder = todayFolder +"/" + timestampUnknownSubject
-                if not os.path.exists(currentCaptureFolder):
-                    os.makedirs(currentCaptureFolder)
-                    print("[WARNING] unknown subject detected! Folder %s created"
-                        % timestampUnknownSubject)
-                unknown_count += 1
-                print("\__ capturing image %s/%s (%s.jpg)" % (unknown_count,
-                    unknown_count_max, unknown_count))
-                cv2.imwrite(currentCaptureFolder+"/%s.jpg"
-                    % unknown_count, frame)
-            
-            # Update the list of names
-            names.append(name)
+                if unknown_count == 0:
+                    print("[WARNING] unknown subject detected! Capturing "
+                        +"images in folder %s" % currentCaptureFolder)
+                # The folders are created, and the frame encoded and written,
+                # by the capture writer (off the recognition thread). The
+                # frame is handed over to it, so it must not be modified
+                with metrics.Timer(stage_seconds["unknown"]):
+                    queued = self.capture_writer.submit(currentCaptureFolder,
+                        "%s.jpg" % (unknown_count + 1), face)
+                    if queued and self.full_frame:
+                        self.capture_writer.submit(currentCaptureFolder,
+                            "%s_frame.jpg" % (unknown_count + 1), frame)
+                if queued:
+                    unknown_count += 1
+                    print("\__ capturing image %s/%s (%s.jpg)" % (unknown_count,
+                        unknown_count_max, unknown_count))
+
+        # Number of distinct faces seen during the session: the max number of
+        # faces on one frame, or of distinct subjects recognized (a face lost
+        # and detected again starts a new track, so counting the tracks
+        # started would count it twice)
+        faces_count = max(faces_count, len(names), len(known_count))
+
+        # Add the evidence of the frame to the decision, and wake up the
+        # decision loop (see `accessControl`) waiting for the counts of known
+        # and unknown subjects
+        if names:
+            with votes_updated:
+                if self.decision is not None and distances:
+                    self.decision.observe(distances)
+                votes_updated.notify_all()
+
+        # Rescale the face coordinates to the orginal ones
+        self.faces_seen = len(names)
+        faces_per_frame.observe(len(names))
+        return [((int(top * r), int(right * r), int(bottom * r),
+            int(left * r)), name)
+            for ((top, right, bottom, left), name) in zip(face_locations, names)]
+
+    def match(self, face_encodings):
+        # Match all the faces of the frame against the known encodings at
+        # once. If the CWID of the subject is known (card already swiped),
+        # only verify the faces against the encodings of that subject.
+        # Otherwise, each face is identified as the known subject with the
+        # largest number of matches (votes). The faces not matched are
+        # "Unknown". Also return the best distance of the faces to each
+        # candidate subject, as evidence for the decision. The matcher is
+        # read once, so a reload of the encodings only applies to the next
+        # frame
+        matcher = self.matcher
+        if self.expected_CWID:
+            scores = matcher.verify_scores(face_encodings,
+                self.expected_CWID, tolerance=tolerance)
+            names = matcher.verify(face_encodings, self.expected_CWID,
+                tolerance=tolerance, scores=scores)
+            identity = matcher.identity(self.expected_CWID)
+            distances = {}
+            if identity is not None and len(scores[0]):
+                distances[identity] = float(scores[0].min())
+            if self.sessions and self.decision is not None and len(names):
+                # When the sessions are recorded (to calibrate the decision),
+                # also record the distance of the faces to the closest other
+                # subjects, as impostor distances. They don't change the
+                # decision, which only grants the claimed subject
+                best = matcher.match(face_encodings, tolerance=tolerance)[0]
+                if identity is not None and best.size:
+                    best = best.copy()
+                    best[:, matcher.identities.index(identity)] = np.inf
+                if best.size:
+                    closest = best.min(axis=0)
+                    for k in set(best.argmin(axis=1)):
+                        if np.isfinite(closest[k]):
+                            distances[matcher.identities[k]] = float(
+                                closest[k])
+            return names, distances
+        scores = matcher.match(face_encodings, tolerance=tolerance)
+        names = matcher.identify(face_encodings, tolerance=tolerance,
+            scores=scores)
+        best = scores[0]
+        distances = {}
+        if best.size:
+            # Candidates: the closest subject of each face, and the subjects
+            # with evidence from the previous frames
+            candidates = set(best.argmin(axis=1))
+            if self.decision is not None:
+                candidates.update(matcher.identities.index(identity)
+                    for identity in self.decision.candidates()
+                    if identity in matcher.identities)
+            closest = best.min(axis=0)
+            distances = dict((matcher.identities[k], float(closest[k]))
+                for k in candidates)
+        return names, distances
+
+    def annotate(self, frame, faces):
+        # Draw the faces recognized on the frame
 
         # Loop over the recognized faces
-        for ((top, right, bottom, left), name) in zip(face_locations, names):
-            # Rescale the face coordinates to the orginal ones
-            top = int(top * r)
-            right = int(right * r)
-            bottom = int(bottom * r)
-            left = int(left * r)
-
+        for ((top, right, bottom, left), name) in faces:
             # Draw the recognized face name on the image. The name displayed
             # is the name of the folder without the first 10 characters (the
             # CWID and the underscore)
@@ -264,7 +689,17 @@ class VideoCamera(object):
 
 
 # def accessControl(detection_method, known_count_max):
-def accessControl(videoCamera):
+def wake():
+    '''
+    Wake up the recognition waiting in `accessControl`, e.g. after setting
+    its `cancel` event.
+    '''
+    with votes_updated:
+        votes_updated.notify_all()
+
+
+def accessControl(videoCamera, expected_CWID=None, cancel=None,
+    on_start=None, claimed_CWID=None):
     # :param `detection_method`: face detection model that is being used during  
     # the live recognition process: either `'hog'` or `'cnn'`. If it's `cnn`, 
     # the `known_count_max` will be divided by 2 to speed up the process.\n
@@ -278,6 +713,16 @@ def accessControl(videoCamera):
     paramenter is divided by 2 to speed up the process.
 
     :param `videoCamera`: the VideoCamera type object.\n
+    :param `expected_CWID`: CWID of the swiped card. If given, the faces are
+    only verified against the encodings of that subject (1:1) instead of
+    being identified against all the known subjects (1:N) (default: `None`).\n
+    :param `cancel`: event set to cancel the recognition (e.g. a new card
+    swipe preempting it), followed by a call to `wake` (default: `None`).\n
+    :param `on_start`: function called (from the recognition thread) once
+    the first frame is processed (default: `None`).\n
+    :param `claimed_CWID`: CWID of the owner of the swiped card, claimed for
+    the decision and the recorded session, whichever the matching mode
+    (default: `None`, `expected_CWID`).\n
     :return The list of `granted CWIDs` of the subjects that have been
     recognized `known_count_max` or more times during the live recognition
     phase.
@@ -287,29 +732,54 @@ def accessControl(videoCamera):
     global granted, grantedCWIDs, maxElapsedTime
 
     # Lower value since CNN is slower
+    threshold = videoCamera.known_count_max
     if videoCamera.detection_method == "cnn":
-        videoCamera.known_count_max = int(known_count_max/2)
+        threshold = max(1, int(threshold/2))
 
     # Start the facial recognition (the processing of the frames)
+    decision = videoCamera.decision
+    # Whether or not the decision grants (or refuses) the access, or only
+    # records the session
+    deciding = decision is not None and videoCamera.sequential
+    claimed_CWID = claimed_CWID or expected_CWID
+    if decision is not None:
+        with votes_updated:
+            decision.reset(videoCamera.matcher.identity(claimed_CWID)
+                if claimed_CWID else None)
+    videoCamera.expected_CWID = expected_CWID
+    videoCamera.on_start = on_start
     videoCamera.doRecon = True
 
-    # Start the time counter
-    startTime = datetime.now()
-    elapsedTime = (datetime.now() - startTime).total_seconds()
-
-    # Loop over frames from the video stream for up to `maxElapsedTime`
-    # seconds
-    while elapsedTime < maxElapsedTime:
-        if unknown_count == unknown_count_max and not unknown_max_reached:
-            print("[WARNING] %s pictures taken from an unknow subject."
-                % unknown_count_max)
-            unknown_max_reached = True
-        
-        # If the dictionary of known face recognized is has keys (names), and
-        # any of them has reached a count of 5, grant access to that subject
-        if bool(known_count):
-            granted = [k for k,v in known_count.items()
-                if float(v) == videoCamera.known_count_max]
+    # Deadline of the recognition
+    deadline = time.monotonic() + maxElapsedTime
+
+    # Wait (without using the CPU) until a known subject is recognized
+    # `threshold` or more times, or until the deadline (or the cancellation).
+    # The recognition wakes up this loop each time the counts change
+    cancelled = False
+    with votes_updated:
+        while True:
+            if cancel is not None and cancel.is_set():
+                print("[CANCELLED] Recognition cancelled by a new card swipe")
+                cancelled = True
+                break
+            if unknown_count >= unknown_count_max and not unknown_max_reached:
+                print("[WARNING] %s pictures taken from an unknow subject."
+                    % unknown_count_max)
+                unknown_max_reached = True
+
+            # If any known subject recognized has reached the threshold, or the
+            # evidence of the match distances is enough, grant access to that
+            # subject. If the evidence clearly points to someone else, refuse
+            # it without waiting for the deadline
+            granted = [k for k,v in known_count.items() if v >= threshold]
+            if deciding:
+                if decision.state == faceDecision.REFUSE:
+                    print("[REFUSED] The face doesn't match. Please, swipe "+
+                        "your card again")
+                    break
+                if decision.state == faceDecision.GRANT:
+                    granted = sorted(set(granted) | set(decision.granted))
             if granted:
                 for subject in granted:
                     subject_name = subject[10:].replace("_", " ")
@@ -318,15 +788,27 @@ def accessControl(videoCamera):
                     print("Face recognized! Access granted to %s (CWID: %s)"
                         % (subject_name, subject_CWID))
                 break
-        
-        # Update the elapsed time it has been running
-        elapsedTime = (datetime.now() - startTime).total_seconds()
-    
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            votes_updated.wait(remaining)
+
     # Stop the facial recognition (the processing of the frames)
     videoCamera.doRecon = False
+    videoCamera.expected_CWID = None
+    videoCamera.on_start = None
+    if decision is not None and videoCamera.sessions:
+        with votes_updated:
+            session = decision.session()
+        faceDecision.record_session(videoCamera.sessions, session)
+    if videoCamera.motion_gate is not None:
+        print("[INFO] frames without motion skipped: %s (processed: %s)"
+            % (videoCamera.motion_gate.skipped, videoCamera.motion_gate.passed))
     
     # Return the list of granted subjects
-    if not granted:
+    if not granted and not cancelled and (not deciding
+        or decision.state != faceDecision.REFUSE):
         print("[TIMEOUT] No known subjects recognized. Please, swipe your "+
             "card again")
     return grantedCWIDs
@@ -339,12 +821,14 @@ def accessControl(videoCamera):
 ############################################################################
 ############################################################################
 
-def main(encodings, display, detection_method, known_count_max):
+def main(encodings, display, detection_method, known_count_max,
+    expected_CWID=None, source=0, on_start=None):
     '''
-    Performs live facial recognition on a videostream from the default camera.
+    Performs live facial recognition on a videostream from the default camera
+    (or from another source of frames).
 
     :param `encodings`: input path to serialized db of facial encodings 
-    (default: `'encodings.pickle'`).\n
+    (default: `'encodings.bin'`).\n
     :param `display`: whether or not to display output frame to screen during 
     live recognition (default: `1` (yes)).\n
     :param `recon_detection_method`: face detection model to use for live 
@@ -352,6 +836,12 @@ def main(encodings, display, detection_method, known_count_max):
     :param `known_count_max`: number of times a subject must be recogised 
     before granting access while using `'hog'` detection method (the number is
     halved if `'cnn'` is used) (default: `15`).\n
+    :param `expected_CWID`: CWID of the swiped card. If given, the faces are
+    only verified against the encodings of that subject (default: `None`).\n
+    :param `source`: source of the frames: index of a camera, `'synthetic'`,
+    path to a folder of images or path to a video file (default: `0`).\n
+    :param `on_start`: function called once the first frame is processed
+    (default: `None`).\n
     :return The list of `granted CWIDs` of the subjects that have been
     recognized `known_count_max` or more times during the live recognition
     phase.
@@ -370,10 +860,12 @@ def main(encodings, display, detection_method, known_count_max):
     # process_this_frame = True
     videoCam_started = False
     videoCamera = VideoCamera("images/unknown_people/", encodings,
-        detection_method, known_count_max, True)
+        detection_method, known_count_max, True, source=source)
+    videoCamera.expected_CWID = expected_CWID
+    videoCamera.on_start = on_start
     if not videoCam_started:
         videoCam_started = True
-        videoCamera.start()
+        videoCamera.start(recognition=False)
 
     # Start the time counter
     startTime = datetime.now()
@@ -385,6 +877,9 @@ def main(encodings, display, detection_method, known_count_max):
         # Grab a frame from the threaded video stream
         frame = videoCamera.get_frame_local()
         videoCamera.doRecon = True
+        if frame is None:
+            # End of the video source
+            break
 
         # Check to see if the output frame must be displayed to the screen
         if display > 0:
@@ -406,7 +901,7 @@ def main(encodings, display, detection_method, known_count_max):
         if bool(known_count):
             # print("known_count =", end = " ")
             granted = [k for k,v in known_count.items()
-                if float(v) == known_count_max]
+                if v >= known_count_max]
             if granted:
                 for subject in granted:
                     subject_name = subject[10:].replace("_", " ")
@@ -421,8 +916,9 @@ def main(encodings, display, detection_method, known_count_max):
 
     # Release handle to the webcam
     videoCamera.doRecon = False
-    videoCamera.__del__()
-    cv2.destroyAllWindows()
+    videoCamera.stop()
+    if display > 0:
+        cv2.destroyAllWindows()
 
     # Return the list of granted subjects
     if not granted:
@@ -437,9 +933,9 @@ def argParser():
     # ap = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
     ap = GooeyParser(formatter_class=RawTextHelpFormatter)
     ap.add_argument("-e", "--encodings", widget="FileChooser", type=str,
-        default="encodings.pickle",
+        default="encodings.bin",
         help="input path to serialized db of facial encodings "+
-        "\ndefault: 'encodings.pickle'")
+        "\ndefault: 'encodings.bin'")
     ap.add_argument("-u", "--unknown",  type=str, default="images/unknown_people",
         help="path to output directory of unknown face images.\ndefault: "+
         "'images/unknown_people'")
@@ -453,6 +949,10 @@ def argParser():
     ap.add_argument("-Y", "--display", type=int, default=1,
         help="whether or not to display output frame to screen during live "+
         "recognition\ndefault: `1` (yes)")
+    ap.add_argument("-s", "--source", type=str, default="0",
+        help="source of the frames: index of a camera, 'synthetic', path to a "+
+        "folder of images or path to a video file\ndefault: '0' (default "+
+        "camera)")
     global args
     args = vars(ap.parse_args())
     return args
@@ -464,4 +964,4 @@ if __name__ == "__main__":
     
     # Call the 'main' function with the parsed arguments
     main(args["encodings"], args["display"], args["detection_method"],
-        args["count_recon"])
+        args["count_recon"], source=args["source"])
@@ -1,14 +1,12 @@
 # Import the necessary packages
 from datetime import datetime
 from argparse import RawTextHelpFormatter
-from threading import Thread, Event
 # from flask import Flask, flash, redirect, render_template, request, send_file, session, abort
 from flask import *
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 import argparse
+import atexit
 import threading
-import multiprocessing
-import schedule
 import time
 import sys
 import logging
@@ -19,8 +17,17 @@ import base64
 # import googleapiclient.discovery
 
 import faceEncode
+import captureWriter
+import cardQueue
+import encodeJobs
+import kioskState
+import faceDecision
 import faceRecon
+import framePipeline
+import metrics
+import accessEvents
 import accessmanager
+import accessStore
 import google_auth
 
 # import functools
@@ -36,15 +43,21 @@ ap.add_argument("-i", "--dataset",  type=str, default="images/known_people",
 ap.add_argument("-u", "--unknown",  type=str, default="images/unknown_people",
     help="path to output directory of unknown face images.\ndefault: "+
         "'images/unknown_people'")
-ap.add_argument("-e", "--encodings", type=str, default="encodings.pickle",
+ap.add_argument("-e", "--encodings", type=str, default="encodings.bin",
     help="path to serialized db of facial encodings "+
-        "\ndefault: 'encodings.pickle'")
+        "\ndefault: 'encodings.bin'")
 ap.add_argument("-t", "--encodings-update-time", type=str, default="01:00:00",
     help="time when the encoding will be updated daily "+
         "\ndefault: '01:00:00'")
 ap.add_argument("-d", "--encode-detection-method", type=str, default="hog",
     help="face detection model to use for encodings: either 'hog' or 'cnn'"+
         "\ndefault: 'hog'")
+ap.add_argument("-w", "--workers", type=int, default=1,
+    help="number of worker processes encoding the images in parallel "+
+        "('0' to use one per available core)\ndefault: '1'")
+ap.add_argument("-k", "--compact", type=int, default=0,
+    help="max number of prototypes kept per identity when updating the "+
+        "encodings (see faceCompact)\ndefault: '0' (keep all the encodings)")
 ap.add_argument("-r", "--recon-detection-method", type=str, default="hog",
     help="face detection model to use for live recognition: either 'hog' "+
         "or 'cnn'\ndefault: 'hog'")
@@ -52,6 +65,77 @@ ap.add_argument("-c", "--count-recon", type=int, default=15,
         help="number of times a subject must be recogised before granting "+
         "access while using `hog` detection method (it will be halved for "+
         "`cnn`. Test to adjust manually\ndefault: 15")
+ap.add_argument("-N", "--detect-every", type=int, default=1,
+    help="run the face detection every N frames during live recognition, "+
+        "tracking the faces in between and encoding each face only when it "+
+        "is new or its quality improves.\ndefault: '1' (detect and encode "+
+        "on every frame)")
+ap.add_argument("-M", "--motion-sensitivity", type=float, default=0,
+    help="min fraction of the pixels that must change for a frame to be "+
+        "processed during live recognition, when there weren't faces on "+
+        "the previous one (e.g. '0.005').\ndefault: '0' (process all the "+
+        "frames)")
+ap.add_argument("-V", "--verify", type=int, default=0,
+    help="whether or not to verify the faces only against the encodings of "+
+        "the owner of the swiped card (1:1), instead of identifying them "+
+        "against all the known subjects (1:N). With '1', a face of another "+
+        "known subject is never recognized, so the refusals are all 'no "+
+        "face detection'.\ndefault: '0' (no)")
+ap.add_argument("-I", "--impostors", type=int, default=0,
+    help="number of encodings from other subjects kept as background "+
+        "impostor set to normalize the scores of the 1:1 verification.\n"+
+        "default: '0' (no normalization)")
+ap.add_argument("-S", "--sequential", type=int, default=0,
+    help="whether or not to grant the access as soon as the evidence of the "+
+        "match distances across the frames is enough (and refuse it early "+
+        "when it clearly points to someone else), instead of waiting for "+
+        "'--count-recon' matches. Only enable it once the parameters have "+
+        "been calibrated ('--decision') from sessions recorded with "+
+        "'--record-sessions' (they are recorded with '0' too).\ndefault: "+
+        "'0' (no)")
+ap.add_argument("-D", "--decision", type=str, default="decision.json",
+    help="path to the parameters of the sequential decision, calibrated by "+
+        "replaying the recorded sessions with 'faceDecision.py' (the default "+
+        "parameters are used if it doesn't exist)\ndefault: 'decision.json'")
+ap.add_argument("-R", "--record-sessions", type=str, default="",
+    help="path to the file where the recognition sessions are recorded, to "+
+        "calibrate the sequential decision\ndefault: '' (not recorded)")
+ap.add_argument("-F", "--full-frame", type=int, default=0,
+    help="whether or not to store the whole frame of each capture of an "+
+        "unknown subject, besides the crop of the face.\ndefault: '0' (no)")
+ap.add_argument("-K", "--keep-days", type=int, default=7,
+    help="number of days the folders of unknown subjects are kept as they "+
+        "are, before compacting them into a ZIP archive (daily, at the "+
+        "encodings update time)\ndefault: '7'")
+ap.add_argument("-X", "--delete-days", type=int, default=0,
+    help="number of days the archives of unknown subjects are kept before "+
+        "deleting them\ndefault: '0' (never deleted)")
+ap.add_argument("-P", "--nprobe", type=int, default=8,
+    help="number of lists of the approximate index of the encodings probed "+
+        "per face during live recognition (only for large galleries, see "+
+        "faceIndex). The higher, the higher the recall.\ndefault: '8' ('0' "+
+        "to always scan all the encodings)")
+ap.add_argument("-s", "--source", type=str, default="0",
+    help="source of the frames: index of a camera, 'synthetic', path to a "+
+        "folder of images or path to a video file (replayed)\ndefault: '0' "+
+        "(default camera)")
+ap.add_argument("-W", "--swipe-policy", type=str, default="drop",
+    help="what to do with the card swipes received during a recognition: "+
+        "'queue' (handled after it), 'drop' (discarded) or 'preempt' (the "+
+        "recognition is cancelled and the new swipe handled)\ndefault: "+
+        "'drop'")
+ap.add_argument("-G", "--swipe-window", type=float, default=2,
+    help="number of seconds during which the repeated swipes of the same "+
+        "card are coalesced into one\ndefault: '2'")
+ap.add_argument("-A", "--access-log", type=str, default="accesslog.jsonl",
+    help="path to the structured log of the access decisions (one JSON "+
+        "object per line, rotated daily and by size, old segments "+
+        "compressed)\ndefault: 'accesslog.jsonl'")
+ap.add_argument("-B", "--access-db", type=str, default="access.db",
+    help="path to the SQLite store of the access decisions, queried by the "+
+        "admin endpoints '/admin/events' and '/admin/events/counts'. The "+
+        "events already logged (and the legacy 'accesslog.txt') are "+
+        "imported into it at startup\ndefault: 'access.db'")
 ap.add_argument("-L", "--local", type=int, default=0,
     help="whether or not to run the script in local computer (without web "+
         "server).\ndefault: '0' (no)")
@@ -83,96 +167,143 @@ log.setLevel(logging.ERROR)
 ############################## GENERAL VARIABLES #############################
 
 # Some basic variables
-received_card_number = ""   # Empty string to store the card number received
-received_card_event = threading.Event() # Event for when a card number is
-                                        # received
-granted_cards = accessmanager.getAllGrantedCardIDs()# List of cards allowed
+received_card_number = ""   # Card number of the swipe being handled
+# Queue of the card swipes received, waiting to be handled
+swipes = cardQueue.SwipeQueue(window=args["swipe_window"],
+    policy=args["swipe_policy"], on_preempt=faceRecon.wake)
+granted_cards = set(accessmanager.getAllGrantedCardIDs())# Cards allowed
 # granted_CWIDs = accessmanager.getAllGrantedCWIDs()  # List of CWIDs allowed
 admin_users = accessmanager.getAllAdminIDs()        # List of admin Google IDs
+# Log of the access decisions, written in the background, and indexed store
+# of the decisions (fed by the writer of the log)
+accessDB = accessStore.AccessStore(args["access_db"])
+accessLogger = accessEvents.AccessLogger(args["access_log"],
+    sinks=[accessDB.add])
+atexit.register(accessLogger.close)
 # accessData = accessmanager.loadJsonAccessFile("access.json")
 
 # Create the videoCamera object with the parsed arguments
 if not args["local"]:
     videoCamera = faceRecon.VideoCamera(args["unknown"], args["encodings"],
-                args["recon_detection_method"], int(args["count_recon"]))
-    videoCam_started = False
-
-
-####################### 'UPDATE WELCOME MESSAGE' CLASS #######################
-
-updateWelcome_thread = threading.Thread()
-# thread_stop_event = threading.Event()
-thread_display_name = threading.Event()
-thread_display_name.set()
-class updateWelcomeThread(Thread):
-    '''
-    Updates the name of the person who has swiped the card (if any),
-    otherwise it shows "Waiting for user...".
-    '''
-    def __init__(self):
-        self.delay = 1 # delay between the checks for new received messages
-        super(updateWelcomeThread, self).__init__()
-    def updateWelcomeGenerator(self):
-        while True:
-            # Default message for waiting
-            msg = "Waiting for user..."
-
-            # Update name only if it has changed (someone has swiped the card)
-            if received_card_number in granted_cards:
-                name = accessmanager.getGrantedName(received_card_number)
-                msg = f"Hello {name}!<br/>Please now place yourself in front of "\
-                    "the camera for face recognition."
-            if thread_display_name.isSet():
-                socketio.emit('newMessage', {'message': msg})
-                # thread_display_name.clear()
-
-            # Restore to default messsage when live recon is finised
-            if not videoCamera.doRecon:
-                thread_display_name.clear()
-            # if videoCamera.doRecon:
-            #     thread_display_name.set()
-            time.sleep(self.delay)
-    def run(self):
-        self.updateWelcomeGenerator()
+                args["recon_detection_method"], int(args["count_recon"]),
+                impostors=args["impostors"],
+                detect_every=args["detect_every"],
+                motion_sensitivity=args["motion_sensitivity"],
+                decision=faceDecision.load(args["decision"])
+                    if args["sequential"] or args["record_sessions"] else None,
+                sequential=bool(args["sequential"]),
+                sessions=args["record_sessions"] or None,
+                full_frame=bool(args["full_frame"]),
+                source=args["source"],
+                nprobe=args["nprobe"])
+    # Each frame of the video stream is annotated and encoded only once, and
+    # sent to all the clients of '/video_feed'. The camera is started with
+    # the first client, and started again with the next client if the
+    # capture has ended (e.g. the camera was disconnected)
+    videoBroadcaster = framePipeline.FrameBroadcaster(videoCamera.get_frame,
+        start=videoCamera.start)
+
+
+################################# KIOSK STATE ################################
+
+def kioskChanged(state):
+    '''
+    Push a transition of the kiosk state (waiting, card accepted,
+    recognizing, granted or refused) to all the clients, once, when it
+    happens.
+    '''
+    if not args["local"]:
+        socketio.emit('newMessage', state)
+
+# State of the kiosk, with the message shown to the user
+kiosk = kioskState.KioskState(on_change=kioskChanged)
 
 
 ############################ FUNCTIONS DEFINITION ############################
 
-def launchUpdateEncodings():
+def jobUpdated(status):
     '''
-    Launch the scheduler to update the encodings at the specified time.
+    Push the status of the jobs (see 'encodeJobs.JobManager.status') to the
+    admin clients.
     '''
-    try:
-        print("[INFO] process to update encodings launched and running "+
-            "in background. It will update encodings everyday at %s"
-            % args["encodings_update_time"])
-        schedule.every().day.at(args["encodings_update_time"]).do(updateEncodings,
-            args["dataset"], args["encodings"], args["encode_detection_method"])
-        while True:
-            schedule.run_pending()
-    except KeyboardInterrupt:
-        print("\nKeyboardInterrupt: stopping encodings update process and "
-            +"ending...", end=" ")
-        schedule.clear()
-        print("DONE")
-        print("PROGRAM KILLED")
+    if not args["local"]:
+        socketio.emit('jobStatus', status, room='admins')
+
+
+def jobFinished(job):
+    '''
+    Reload the encodings in the live camera once an encodings update is done
+    (without waiting for the watcher to notice the new store).
+    '''
+    if job.target is updateEncodings and job.status == encodeJobs.DONE:
+        print("==> Encodings updated: %s" % job.result)
+        if not args["local"]:
+            videoCamera.reload_encodings()
 
 
-def updateEncodings(dataset, encodings, encode_detection_method):
+def submitEncodings(detection_method, reason):
+    '''
+    Queue an encodings update, without waiting for it.
+
+    :param `detection_method`: face detection model to use for encodings:
+    either `'hog'` or `'cnn'`.\n
+    :param `reason`: why the update is requested (e.g. `'admin'`).\n
+    :return The `Job` object.
+    '''
+    return jobs.submit("encodings (%s)" % detection_method, updateEncodings,
+        encodingsJobArgs(detection_method), reason=reason)
+
+
+def encodingsJobArgs(detection_method):
+    # Keyword arguments of updateEncodings from the parsed arguments
+    return {"dataset": args["dataset"], "encodings": args["encodings"],
+        "encode_detection_method": detection_method,
+        "workers": args["workers"], "compact": args["compact"]}
+
+
+def launchUpdateEncodings():
+    '''
+    Start the manager of the jobs, which updates the encodings (and compacts
+    the old captures of unknown subjects) everyday at the specified time.
+    '''
+    print("[INFO] encodings update jobs running in background. The "
+        +"encodings will be updated everyday at %s"
+        % args["encodings_update_time"])
+    jobs.every_day(args["encodings_update_time"],
+        "encodings (%s)" % args["encode_detection_method"], updateEncodings,
+        encodingsJobArgs(args["encode_detection_method"]))
+    jobs.every_day(args["encodings_update_time"], "compact captures",
+        captureWriter.compact, {"path": args["unknown"],
+        "keep_days": args["keep_days"], "delete_days": args["delete_days"]},
+        process=False)
+    jobs.start()
+    atexit.register(jobs.stop)
+
+
+def updateEncodings(dataset, encodings, encode_detection_method, workers=1,
+    compact=0, progress=None):
     '''
     Performs the encodings update.
 
     :param `dataset`: path to input directory of face images to encode 
     (default: `'images/known_people'`).\n
     :param `encodings`: output path to serialized db of facial encodings 
-    (default: `'encodings.pickle'`).\n
+    (default: `'encodings.bin'`).\n
     :param `encode_detection_method`: face detection model to use for 
-    encodings: either `'hog'` or `'cnn'` (default: `'hog'`).
+    encodings: either `'hog'` or `'cnn'` (default: `'hog'`).\n
+    :param `workers`: number of worker processes encoding the images in
+    parallel, or `0` to use one per available core (default: `1`).\n
+    :param `compact`: max number of prototypes kept per identity (default:
+    `0`, keep all the encodings).\n
+    :param `progress`: function called with the number of images encoded and
+    the number of images to encode (default: `None`).\n
+    :return The `statistics` of the update (see 'faceEncode.main').
     '''
     # python faceEncode.py
     #   --dataset images/known_people
-    #   --encodings encodings.pickle
+    #   --encodings encodings.bin
     #   --encode-detection-method hog
+    #   --workers 1
     print("-"*60)
     print("Updating encodings...")
 
@@ -183,8 +314,11 @@ def updateEncodings(dataset, encodings, encode_detection_method):
     print("[INFO] dataset: '%s'" % dataset)
     print("[INFO] encodings output path: '%s'" % encodings)
     print("[INFO] face detection method: '%s'" % encode_detection_method)
+    print("[INFO] workers: '%s'" % workers)
+    print("[INFO] prototypes per identity: '%s'" % (compact or "all"))
     # Update the encodings
-    faceEncode.main(dataset, encodings, encode_detection_method)
+    statistics = faceEncode.main(dataset, encodings, encode_detection_method,
+        workers=workers, compact=compact, progress=progress)
     endTime = datetime.now()
     print("==> Encodings successfully updated on "+
         endTime.strftime("%Y-%m-%d at %H:%M:%S"))
@@ -193,19 +327,19 @@ def updateEncodings(dataset, encodings, encode_detection_method):
     elapsedTime = (endTime - startTime)
     print(f"[FINISHED] encoding time: {elapsedTime} ({elapsedTime.total_seconds()}s)")
 
-    if not args["local"]:
-        # Force reload of the encodings in the videoCamera object
-        # videoCamera.encodings = args["encodings"]
-        videoCamera.load_encodings()
+    # The live camera (in the main process) reloads the encodings once the
+    # job is finished (see 'jobFinished')
     print("-"*60)
+    return statistics
 
 
-def liveFaceRecon(encodings, display, recon_detection_method, count_recon):
+def liveFaceRecon(encodings, display, recon_detection_method, count_recon,
+    expected_CWID=None, on_start=None, claimed_CWID=None):
     '''
     Performs the live face recognition.
 
     :param `encodings`: input path to serialized db of facial encodings 
-    (default: `'encodings.pickle'`).\n
+    (default: `'encodings.bin'`).\n
     :param `display`: whether or not to display output frame to screen during 
     live recognition (default: `1` (yes)).\n
     :param `recon_detection_method`: face detection model to use for live 
@@ -213,11 +347,18 @@ def liveFaceRecon(encodings, display, recon_detection_method, count_recon):
     :param `count_recon`: number of times a subject must be recogised before
     granting access while using `'hog'` detection method (the number is halved
     if `'cnn'` is used) (default: `15`).\n
+    :param `expected_CWID`: CWID of the swiped card, to verify the faces only
+    against the encodings of that subject (default: `None`, identify them
+    against all the known subjects).\n
+    :param `on_start`: function called once the recognition processes its
+    first frame (default: `None`).\n
+    :param `claimed_CWID`: CWID of the owner of the swiped card, claimed for
+    the decision and the recorded session (default: `None`).\n
     :return The list of `granted` subject received from the live recognition 
     module
     '''
     # python faceRecon.py
-    #     --encodings encodings.pickle
+    #     --encodings encodings.bin
     #     --display 0
     #     --recon-detection-method hog
     print("-"*60)
@@ -227,6 +368,8 @@ def liveFaceRecon(encodings, display, recon_detection_method, count_recon):
         print("[INFO] display frame: '%s'" % display)
     print("[INFO] face detection method: '%s'" % recon_detection_method)
     print("[INFO] times before recognition success (for HOG): '%s'" % count_recon)
+    if expected_CWID:
+        print("[INFO] verifying subject with CWID: '%s'" % expected_CWID)
 
     if not args["local"]:
         # Reset faceRecon variables to default and start facial recognition
@@ -236,69 +379,64 @@ def liveFaceRecon(encodings, display, recon_detection_method, count_recon):
         # videoCamera.doRecon = True
         # granted = faceRecon.accessControl(videoCamera.detection_method, 
         #     videoCamera.known_count_max)
-        granted = faceRecon.accessControl(videoCamera)
+        granted = faceRecon.accessControl(videoCamera, expected_CWID,
+            cancel=swipes.preempted, on_start=on_start,
+            claimed_CWID=claimed_CWID)
         # videoCamera.doRecon = False
     else: # Running in local
         granted = faceRecon.main(encodings, display, recon_detection_method,
-            count_recon)
+            count_recon, expected_CWID, source=args["source"],
+            on_start=on_start)
     print("-"*60)
     return granted
 
 
-def accesslog(received_card_number, onDB, faceRecognized, granted):
+def accesslog(received_card_number, onDB, faceRecognized, granted,
+    CWID=None, latency=None, faces=None):
     '''
     Log for the door access. Keeps record of whether the attemp was successful
-    or unsuccessful, and the reason for it in the latter case.
+    or unsuccessful, and the reason for it in the latter case. The event is
+    queued to the access log, without waiting for the disk.
 
     :param `received_card_number`: number of the card swiped at the door.\n
     :param `onDB`: boolean of whether or not the card number is on the list 
     of accepted cards.\n
     :param `faceRecognized`: boolean of whether or not at least one face has  
     been recognized during the live recognition process.\n
-    :param `granted`: boolean of whether the access was granted or denied.
+    :param `granted`: boolean of whether the access was granted or denied.\n
+    :param `CWID`: CWID of the owner of the card (default: `None`).\n
+    :param `latency`: seconds taken by the live recognition (default:
+    `None`).\n
+    :param `faces`: number of distinct faces seen during the live
+    recognition (default: `None`).
     '''
-    # Save a different message depending if the user attempt to access was 
+    # Save a different reason depending if the user attempt to access was 
     # successful or not
+    reason = ""
     if faceRecognized:
-        if granted:
-            with open("accesslog.txt", "a") as accesslogfile:
-                print(f"Access granted on: {datetime.now()} "
-                    +f"for card ID '{received_card_number}'", 
-                    file=accesslogfile)
-        else:
-            with open("accesslog.txt", "a") as accesslogfile:
-                print(f"Access refused on: {datetime.now()} "
-                    +f"for card ID '{received_card_number}' "
-                    +"(not recognized on camera)", 
-                    file=accesslogfile)
+        if not granted:
+            reason = "not recognized on camera"
     elif (not granted) and onDB:
-        with open("accesslog.txt", "a") as accesslogfile:
-            print(f"Access refused on: {datetime.now()} "
-                +f"for card ID '{received_card_number}' "
-                +"(no face detection)", 
-                file=accesslogfile)
-    else: 
-        with open("accesslog.txt", "a") as accesslogfile:
-            print(f"Access refused on: {datetime.now()} "
-                +f"for card ID '{received_card_number}' "
-                +"(card ID not accepted)",  
-                file=accesslogfile)
+        reason = "no face detection"
+    elif not granted:
+        reason = "card ID not accepted"
+    accessLogger.log(accessEvents.event(received_card_number, CWID,
+        accessEvents.GRANTED if granted else accessEvents.REFUSED, reason,
+        latency, faces))
 
 
 def getCardNumber():
     '''
     Receive from the Raspberry Pi the number of the card that the user has 
-    swiped on the reader.
+    swiped on the reader, waiting (without using the CPU) for the next swipe
+    of the queue.
 
     :return The `card number`.
     '''
-    global received_card_number
-    while True:
-        # If a card number has been received (flag set to True), clear the
-        # flag and return the card number
-        if received_card_event.isSet():
-            received_card_event.clear()
-            return received_card_number
+    swipe = swipes.get()
+    print("[INFO] handling swipe of card ID %s (swiped on %s)" % (swipe.card,
+        datetime.fromtimestamp(swipe.timestamp).strftime("%H:%M:%S")))
+    return swipe.card
 
 
 def waitForCard():
@@ -316,33 +454,62 @@ def waitForCard():
         if received_card_number not in granted_cards:
             print("[ERROR] swiped card is not on the DB")
             print("[FAIL] [ACCESS REFUSED]\n")
+            kiosk.set(kioskState.REFUSED, reason="card ID not accepted")
             accesslog(received_card_number, False, False, False)
         else:
-            # Trigger the tread event to show the name of the person who
-            # swipped the card on the website
-            thread_display_name.set()
+            # Show the name of the person who swiped the card on the website
             name = accessmanager.getGrantedName(received_card_number)
+            kiosk.set(kioskState.CARD_ACCEPTED, name)
             print(f"Card for {name} accepted. Please now place yourself in "+
                 "front of the camera for facial recognition")
-            granted = liveFaceRecon(args["encodings"], args["display"],
-                args["recon_detection_method"], args["count_recon"])
             received_CWID = accessmanager.getCWIDFromCardID(received_card_number)
+            startTime = time.monotonic()
+            # The card stays accepted on the kiosk until the recognition
+            # processes its first frame
+            granted = liveFaceRecon(args["encodings"], args["display"],
+                args["recon_detection_method"], args["count_recon"],
+                received_CWID if args["verify"] else None,
+                on_start=lambda: kiosk.set(kioskState.RECOGNIZING, name),
+                claimed_CWID=received_CWID)
+            # Latency of the recognition and number of distinct faces seen,
+            # for the access log
+            recognition = {"CWID": received_CWID,
+                "latency": time.monotonic() - startTime,
+                "faces": faceRecon.faces_count}
             # myindexes = [i for (i, cwid) in enumerate(granted) if cwid == received_CWID]
             if received_CWID in granted:
                 print("[SUCCESS] face recognition and swiped card match")
                 print("[SUCCESS] [ACCESS GRANTED] you can now enter the lab\n")
+                kiosk.set(kioskState.GRANTED, name)
                 accessmanager.setGrantedLastAccess(received_card_number, 
                     datetime.now())
-                accesslog(received_card_number, True, True, True)
+                accesslog(received_card_number, True, True, True,
+                    **recognition)
+            elif not args["local"] and swipes.preempted.is_set():
+                # The recognition was cancelled by the swipe of another card,
+                # which is handled next (and sets the kiosk state)
+                print("[INFO] recognition cancelled by a new card swipe\n")
+                accessLogger.log(accessEvents.event(received_card_number,
+                    received_CWID, accessEvents.CANCELLED,
+                    "preempted by a new card swipe", recognition["latency"],
+                    recognition["faces"]))
             elif granted and not received_CWID in granted:
                 print("[ERROR] face recognition and swiped card don't match!")
                 print("[FAIL] [ACCESS REFUSED]\n")
-                accesslog(received_card_number, True, True, False)
+                kiosk.set(kioskState.REFUSED, name,
+                    "not recognized on camera")
+                accesslog(received_card_number, True, True, False,
+                    **recognition)
             elif not granted:
                 print("[ERROR] no known subject has been recognized")
                 print("[FAIL] [ACCESS REFUSED]\n")
-                accesslog(received_card_number, True, False, False)
-            received_card_number = ""
+                kiosk.set(kioskState.REFUSED, name, "no face detection")
+                accesslog(received_card_number, True, False, False,
+                    **recognition)
+        received_card_number = ""
+        if not args["local"]:
+            # Ready for the next swipe of the queue
+            swipes.done()
 
 
 ############################### FLASK FUNCTIONS ##############################
@@ -371,10 +538,8 @@ def receiveCardData():
     Receive data from the Raspberry Pi containing the information from the
     card that the user has swiped on the reader.
     '''
-    global received_card_number, videoCamera
-    # Wait for a JSON in the request, and check if it's not already in
-    # recognition mode (i.e. if a known card hasn't already been swiped)
-    if request.is_json and not videoCamera.doRecon:
+    # Wait for a JSON in the request
+    if request.is_json:
         # Get the JSON and obtain the data in bits
         data = request.get_json()
         cardID_encoded = data.get('cardID', None)
@@ -382,28 +547,31 @@ def receiveCardData():
         cardCode_encoded = data.get('cardCode', None)
 
         # Decode the data and get the string of bits
-        received_card_number = base64.b64decode(cardID_encoded).decode()
+        cardID = base64.b64decode(cardID_encoded).decode()
         facilityCode = base64.b64decode(facilityCode_encoded).decode()
         cardCode = base64.b64decode(cardCode_encoded).decode()
 
         infoMessage = "[INFO] swiped card with:\n"\
-            f"\tID = {received_card_number}\n"\
+            f"\tID = {cardID}\n"\
             f"\tFC = {facilityCode}\n"\
             f"\tCC = {cardCode}"
         print(infoMessage)
 
-        # Set the received_card_event flag to True, so the card number is sent
-        # to the waitForCard() function
-        received_card_event.set()
-        return Response('{"result": "ok", "error": ""}',
-            status=200, mimetype='application/json')
-    # If it's already in recognition mode, don't process the request (discard
-    # it)
-    elif videoCamera.doRecon:
-        print("[WARNING] recognition from previous card swipe is still in "
-            +"progress, please wait")
-        return Response('{"result": "ok", "error": ""}',
-            status=200, mimetype='application/json')
+        # Queue the swipe for the waitForCard() function. The swipes received
+        # during a recognition follow the swipe policy
+        result = swipes.put(cardQueue.SwipeEvent(cardID, facilityCode,
+            cardCode))
+        if result == cardQueue.DUPLICATE:
+            print("[INFO] repeated swipe of the same card, ignored")
+        elif result == cardQueue.DROPPED:
+            print("[WARNING] recognition from previous card swipe is still in "
+                +"progress, please wait")
+        elif result == cardQueue.FULL:
+            print("[WARNING] too many card swipes waiting, swipe discarded")
+        elif result == cardQueue.PREEMPTED:
+            print("[INFO] recognition in progress cancelled for the new swipe")
+        return Response('{"result": "ok", "error": "", "swipe": "%s"}'
+            % result, status=200, mimetype='application/json')
     else:
         print("Nothing received")
         return Response('{"result": "error", "error": "JSON not found"}',
@@ -426,54 +594,42 @@ def admin():
         if user_info['id'] in accessmanager.getAllAdminIDs():
             # Update timestamp of last access for the logged in administrator
             accessmanager.setAdminLastAccess(user_info['id'], datetime.now())
-            global encodings_process
-            # Actions on each button pressed
+            # Actions on each button pressed. The encodings updates are
+            # queued, the page doesn't wait for them (their progress is pushed
+            # on the 'jobStatus' socket.io event)
             if request.method == 'POST':
                 # Force encodings update with 'HOG'
                 if "forceUpdateHOG" in request.form:
-                    forced_encodings_HOG_process = multiprocessing.Process(
-                        name='Encodings',
-                        target = updateEncodings,
-                        args=(args["dataset"], args["encodings"], "hog"))
-                    forced_encodings_HOG_process.daemon = True
-                    forced_encodings_HOG_process.start()
-                    forced_encodings_HOG_process.join()
-                    flash("Encodings succesfully updated with 'HOG'", 'success')
+                    job = submitEncodings("hog", "admin")
+                    flash("Encodings update with 'HOG' queued (job %s)"
+                        % job.id, 'info')
                 # Force encodings update with 'CNN'
                 elif "forceUpdateCNN" in request.form:
-                    forced_encodings_CNN_process = multiprocessing.Process(
-                        name='Encodings',
-                        target = updateEncodings,
-                        args=(args["dataset"], args["encodings"], "cnn"))
-                    forced_encodings_CNN_process.daemon = True
-                    forced_encodings_CNN_process.start()
-                    forced_encodings_CNN_process.join()
-                    flash("Encodings succesfully updated with 'CNN'", 'success')
-                # Start the automatic encodings update process, if it's not 
-                # already running
+                    job = submitEncodings("cnn", "admin")
+                    flash("Encodings update with 'CNN' queued (job %s)"
+                        % job.id, 'info')
+                # Enable the daily encodings update, if it's not already
+                # enabled
                 elif "startProcess" in request.form:
-                    if not encodings_process.is_alive():
+                    if not jobs.scheduled:
                         message = "[INFO] Encodings update process is "\
                             "started and running"
                         flash(message[6:], 'info')
                         print(message)
-                        encodings_process = multiprocessing.Process(
-                            target = launchUpdateEncodings)
-                        encodings_process.start()
+                        jobs.set_scheduled(True)
                     else:
                         message = "[WARNING] Encodings update process is "\
                             "already running"
                         flash(message[9:], 'warning')
                         print(message)
-                # Stop the automatic encodings update process, if it's not 
-                # already stopped
+                # Disable the daily encodings update (a job already running
+                # still finishes), if it's not already disabled
                 elif "stopProcess" in request.form:
-                    if encodings_process.is_alive():
+                    if jobs.scheduled:
                         message = "[INFO] Encodings update process is stopped"
                         flash(message[6:], 'info')
                         print(message)
-                        encodings_process.terminate()
-                        time.sleep(0.1)
+                        jobs.set_scheduled(False)
                     else:
                         message = "[WARNING] Encodings update process is "\
                             "been stopped"
@@ -481,12 +637,10 @@ def admin():
                         print(message)
                 # Shutdown the webserver and end the program
                 elif "quit" in request.form:
-                    if encodings_process.is_alive():
-                        print("[INFO] stopping encodings update process "
-                            +"before exiting...", end=" ")
-                        encodings_process.terminate()
-                        time.sleep(0.1)
-                        print("DONE")
+                    print("[INFO] stopping encodings update jobs before "
+                        +"exiting...", end=" ")
+                    jobs.stop()
+                    print("DONE")
                     print("[FINISHED] program existing")
                     shutdown_server()
                     return '<h3>Server shutted down</h3>'
@@ -503,47 +657,109 @@ def admin():
     return redirect('/', code=302)
 
 
-@socketio.on('newMessage')
-def updateWelcome():
+def isAdmin():
     '''
-    Launch thread that will manage the real-time update of the welcome message
-    shown to the user (default one and on card swipe)
+    Whether or not the user logged in (if any) is an administrator.
     '''
-    global updateWelcome_thread
-    if not updateWelcome_thread.isAlive():
-        updateWelcome_thread = updateWelcomeThread()
-        updateWelcome_thread.setDaemon(True)
-        updateWelcome_thread.start()
+    return google_auth.is_logged_in() and (google_auth.get_user_info()['id']
+        in accessmanager.getAllAdminIDs())
+
+
+def eventFilters():
+    # Filters of the access events from the query string (the dates are
+    # parsed as local time)
+    filters = {"card": request.args.get("card"),
+        "CWID": request.args.get("cwid"),
+        "decision": request.args.get("decision")}
+    for key in ("start", "end"):
+        filters[key] = accessStore.parse_time(request.args[key]) \
+            if request.args.get(key) else None
+    return filters
 
 
-def gen(camera):
+@app.route("/admin/events")
+def adminEvents():
+    '''
+    Page of the access decisions (JSON), the most recent first. Query string:
+    `start` and `end` (dates, e.g. '2019-06-01' or '2019-06-01T08:00'),
+    `card`, `cwid`, `decision` ('granted', 'refused' or 'cancelled'), `limit`
+    (max 500) and `cursor` (returned with the previous page).
+    '''
+    if not isAdmin():
+        return jsonify(result="error", error="admin rights required"), 403
+    try:
+        page = accessDB.events(limit=request.args.get("limit", 50),
+            cursor=request.args.get("cursor"), **eventFilters())
+    except ValueError as e:
+        return jsonify(result="error", error=str(e)), 400
+    return jsonify(page)
+
+
+@app.route("/admin/events/counts")
+def adminEventCounts():
+    '''
+    Number of access decisions per time bucket (JSON). Query string:
+    `bucket` ('hour', 'day' or 'month'), `by` ('decision', 'reason', 'card'
+    or 'CWID') and the filters of '/admin/events'.
+    '''
+    if not isAdmin():
+        return jsonify(result="error", error="admin rights required"), 403
+    try:
+        counts = accessDB.counts(request.args.get("bucket", "day"),
+            request.args.get("by", "decision"), **eventFilters())
+    except ValueError as e:
+        return jsonify(result="error", error=str(e)), 400
+    return jsonify(counts)
+
+
+@socketio.on('connect')
+def sendKioskState():
+    '''
+    Send the current state of the kiosk to a client when it connects (the
+    next transitions are pushed to all the clients, see 'kioskChanged').
+    '''
+    emit('newMessage', kiosk.current())
+
+
+@socketio.on('jobStatus')
+def sendJobStatus():
+    '''
+    Send the status of the encodings update jobs to an admin client, and
+    subscribe it to the next updates.
+    '''
+    if isAdmin():
+        join_room('admins')
+        emit('jobStatus', jobs.status())
+
+
+def gen(broadcaster):
     '''
     The generator to display the video stream from the camera on the website.
 
-        :param camera: the videoCamera object
+        :param broadcaster: the broadcaster of the frames of the videoCamera
+        object
     '''
-    while True:
-        try:
-            frame = camera.get_frame()
-        except ValueError as error:
-            print(error)
-            break
+    for frame in broadcaster.subscribe():
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
 
 
 @app.route('/video_feed')
 def video_feed():
-    global videoCam_started
-    if not videoCam_started:
-        videoCam_started = True
-        videoCamera.start()
-    return Response(gen(videoCamera),
+    return Response(gen(videoBroadcaster),
         mimetype='multipart/x-mixed-replace; boundary=frame')
     # else:
         # return send_file("static/img/faceSec.png", mimetype='image/png', cache_timeout=0)
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    # Latency of each stage of the video pipeline, frames processed/dropped
+    # and faces per frame, in the Prometheus text format
+    return Response(metrics.render(),
+        mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.after_request
 def add_header(r):
     """
@@ -573,10 +789,16 @@ if __name__ == "__main__":
         waitForCard_thread.setDaemon(True)
         waitForCard_thread.start()
         print("[START] running main program, waiting for card reading")
-        encodings_process = multiprocessing.Process(name='Encodings',
-            target = launchUpdateEncodings)
-        encodings_process.daemon = True
-        encodings_process.start()
+        # Manager of the encodings update jobs (one at a time, in a child
+        # process each)
+        jobs = encodeJobs.JobManager(on_update=jobUpdated,
+            on_finished=jobFinished)
+        # Import the events logged before the store existed (or that it
+        # missed), in the background
+        jobs.submit("backfill access store", accessDB.backfill,
+            {"path": args["access_log"], "legacy": "accesslog.txt"},
+            process=False, reason="startup")
+        launchUpdateEncodings()
         
         if not args["local"]: # Start as Fask/socket.io app, with webserver
             # app.run(host='0.0.0.0', port=3000)#, debug=True)
@@ -594,26 +816,20 @@ if __name__ == "__main__":
                 cv2.imshow('img',cv2.imread('static/img/faceSec.png'))
                 key = cv2.waitKey(0)
                 if key == ord("q"):    # Esc key to stop
-                    if encodings_process.is_alive():
-                        print("[INFO] stopping encodings update process before "
-                            +"exiting...", end=" ")
-                        encodings_process.terminate()
-                        time.sleep(0.1)
-                        print("DONE")
+                    print("[INFO] stopping encodings update jobs before "
+                        +"exiting...", end=" ")
+                    jobs.stop()
+                    print("DONE")
                     break
                 elif key == ord("f"):
-                    updateEncodings(args["dataset"], args["encodings"],
-                        args["encode_detection_method"])
+                    submitEncodings(args["encode_detection_method"], "local")
                 elif key == ord("n"): # 14 = CTRL + n ?
                     print("[INFO] Encodings update process stopped")
-                    encodings_process.terminate()
-                    time.sleep(0.1)
+                    jobs.set_scheduled(False)
                 elif key == ord("m"): # 13 = CTRL + m ?
-                    if not encodings_process.is_alive():
+                    if not jobs.scheduled:
                         print("[INFO] Encodings update process started")
-                        encodings_process = multiprocessing.Process(
-                            target = launchUpdateEncodings)
-                        encodings_process.start()
+                        jobs.set_scheduled(True)
                     else:
                         print("[WARNING] Encodings update process already running")
             cv2.destroyAllWindows()
@@ -625,7 +841,6 @@ if __name__ == "__main__":
         # Destray cv2 windows (if script is run in local)
         if args["local"]:
             cv2.destroyAllWindows()
-        # Terminate encodings process and exit
-        encodings_process.terminate()
-        time.sleep(0.1)
+        # Stop the encodings update jobs and exit
+        jobs.stop()
         sys.exit(1)
@@ -0,0 +1,187 @@
+'''
+Tracking of the faces across the frames of the video stream, so the faces
+don't have to be detected and encoded on every frame.
+
+The full face detection is only run every N frames, or when a track is lost.
+In between, each face is followed with a correlation tracker (from dlib). The
+detections are associated with the existing tracks by the overlap of their
+boxes (IoU), and a face is only encoded (and matched) when its track is new,
+when the quality of the face (its size) has improved enough since the last
+time it was encoded, or when it hasn't been encoded for a few frames (so the
+identity of each track keeps being verified, as a track recognizes its face
+on every frame it's followed).
+'''
+
+# Import the necessary packages
+import dlib
+
+
+def iou(a, b):
+    '''
+    Compute the intersection over union of two boxes.
+
+    :param `a`, `b`: the boxes, as (top, right, bottom, left).\n
+    :return The `IoU` of the boxes (between 0 and 1).
+    '''
+    (top, right) = (max(a[0], b[0]), min(a[1], b[1]))
+    (bottom, left) = (min(a[2], b[2]), max(a[3], b[3]))
+    inter = max(0, right - left) * max(0, bottom - top)
+    union = area(a) + area(b) - inter
+    return inter / float(union) if union > 0 else 0.0
+
+
+def area(box):
+    # Area of a (top, right, bottom, left) box
+    return max(0, box[1] - box[3]) * max(0, box[2] - box[0])
+
+
+class Track(object):
+    '''
+    Creates a Track object, following a face across the frames.
+
+    :param `track_id`: identifier of the track.\n
+    :param `box`: box of the face, as (top, right, bottom, left).\n
+    '''
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.name = "Unknown"   # Identity of the face (once encoded)
+        self.encoded = False    # Whether or not the face has been encoded
+        self.quality = 0        # Quality (area) of the face when encoded
+        self.encoded_at = 0     # Index of the frame when it was encoded
+        self.votes = 0          # Number of frames with the track recognized
+        self.correlation = None # Correlation tracker following the face
+
+    def follow(self, rgb, box):
+        # (Re)start the correlation tracker on the given box of the frame
+        (top, right, bottom, left) = box
+        self.box = box
+        self.correlation = dlib.correlation_tracker()
+        self.correlation.start_track(rgb,
+            dlib.rectangle(int(left), int(top), int(right), int(bottom)))
+
+    def identify(self, name, frame_index=0):
+        # Set the identity of the face, encoded with the current quality on
+        # the given frame
+        self.name = name
+        self.encoded = True
+        self.quality = area(self.box)
+        self.encoded_at = frame_index
+
+
+class FaceTracker(object):
+    '''
+    Creates a FaceTracker object.
+
+    :param `detect_every`: run the face detection every N frames (default:
+    `5`).\n
+    :param `iou_threshold`: min IoU between a detection and a track to
+    associate them (default: `0.3`).\n
+    :param `min_psr`: min peak-to-sidelobe ratio of a correlation tracker to
+    keep following the face. Below it, the track is lost (default: `7`).\n
+    :param `quality_gain`: factor by which the quality (area) of a face must
+    improve to encode it again (default: `1.25`).\n
+    :param `reverify_every`: max number of frames a face is followed without
+    encoding it again (default: `None`, `detect_every`).\n
+    '''
+
+    def __init__(self, detect_every=5, iou_threshold=0.3, min_psr=7,
+        quality_gain=1.25, reverify_every=None):
+        self.detect_every = detect_every
+        self.reverify_every = reverify_every or detect_every
+        self.iou_threshold = iou_threshold
+        self.min_psr = min_psr
+        self.quality_gain = quality_gain
+        self.reset()
+
+    def reset(self):
+        '''
+        Drop all the tracks (e.g. at the end of a recognition session).
+        '''
+        self.tracks = []
+        self.frame_index = 0
+        self.next_id = 1
+        self.lost = False
+
+    def needs_detection(self):
+        '''
+        Whether or not the faces must be detected on the next frame: every
+        `detect_every` frames, when there aren't tracks, or when a track has
+        been lost.
+        '''
+        return (not self.tracks or self.lost
+            or self.frame_index % self.detect_every == 0)
+
+    def update(self, rgb, locations=None):
+        '''
+        Update the tracks with the faces detected on the frame or, if there
+        aren't detections, follow them with the correlation trackers.
+
+        :param `rgb`: the RGB frame.\n
+        :param `locations`: list of face boxes detected on the frame, as
+        (top, right, bottom, left), or `None` if the detection wasn't run.\n
+        :return The list of `tracks` on the frame.
+        '''
+        self.frame_index += 1
+        if locations is None:
+            self._follow(rgb)
+        else:
+            self._associate(rgb, locations)
+        return self.tracks
+
+    def _associate(self, rgb, locations):
+        # Greedily associate each detection with the track with the largest
+        # overlap. The detections without track start new tracks, and the
+        # tracks without detection are dropped
+        pairs = sorted(((iou(track.box, box), t, d)
+            for (t, track) in enumerate(self.tracks)
+            for (d, box) in enumerate(locations)), reverse=True)
+        matched_tracks = {}
+        for (overlap, t, d) in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if t not in matched_tracks and d not in matched_tracks.values():
+                matched_tracks[t] = d
+        tracks = []
+        for (t, d) in matched_tracks.items():
+            self.tracks[t].follow(rgb, tuple(locations[d]))
+            tracks.append(self.tracks[t])
+        for (d, box) in enumerate(locations):
+            if d not in matched_tracks.values():
+                track = Track(self.next_id, tuple(box))
+                track.follow(rgb, track.box)
+                self.next_id += 1
+                tracks.append(track)
+        self.tracks = sorted(tracks, key=lambda track: track.id)
+        self.lost = False
+
+    def _follow(self, rgb):
+        # Follow each face with its correlation tracker. The tracks with a
+        # low confidence are lost (and the faces will be detected again)
+        (height, width) = rgb.shape[:2]
+        tracks = []
+        for track in self.tracks:
+            psr = track.correlation.update(rgb)
+            if psr < self.min_psr:
+                self.lost = True
+                continue
+            position = track.correlation.get_position()
+            track.box = (max(0, int(position.top())),
+                min(width, int(position.right())),
+                min(height, int(position.bottom())),
+                max(0, int(position.left())))
+            tracks.append(track)
+        self.tracks = tracks
+
+    def to_encode(self):
+        '''
+        Get the tracks whose face must be encoded: the new ones, the ones
+        whose quality has improved by `quality_gain` since they were encoded,
+        and the ones not encoded for `reverify_every` frames.
+
+        :return The list of `tracks` to encode.
+        '''
+        return [track for track in self.tracks if not track.encoded
+            or area(track.box) >= track.quality * self.quality_gain
+            or self.frame_index - track.encoded_at >= self.reverify_every]
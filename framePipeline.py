@@ -0,0 +1,179 @@
+'''
+Building blocks to connect the stages of the video pipeline (capture,
+recognition, annotation and encoding of the frames) running on different
+threads.
+
+The stages are connected by "latest-frame-wins" slots: a slot only holds the
+most recent item put into it, so a slow consumer always gets the newest frame
+and the stale ones are dropped, instead of slowing down the producer.
+'''
+
+# Import the necessary packages
+import threading
+
+
+class LatestSlot(object):
+    '''
+    Creates a LatestSlot object: a bounded buffer of size one, where each new
+    item replaces the previous one. Every item is numbered with a sequence
+    number, so each consumer can wait for an item newer than the last one it
+    has seen.
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._seq = 0
+        self._closed = False
+
+    def put(self, item):
+        '''
+        Put a new item in the slot (replacing the previous one, if it hasn't
+        been consumed yet) and wake up the consumers waiting for it.
+
+        :param `item`: the item to put.\n
+        :return The `sequence number` of the item.
+        '''
+        with self._condition:
+            self._item = item
+            self._seq += 1
+            self._condition.notify_all()
+            return self._seq
+
+    def get(self, last_seq=0, timeout=None):
+        '''
+        Get the most recent item of the slot, waiting for one newer than
+        `last_seq` if needed.
+
+        :param `last_seq`: sequence number of the last item seen by the
+        consumer (default: `0`, any item).\n
+        :param `timeout`: max number of seconds to wait (default: `None`,
+        wait forever).\n
+        :return The `sequence number` and the `item`. If the timeout expires
+        or the slot is closed, the item is `None` and the sequence number is
+        `last_seq`.
+        '''
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._seq > last_seq or self._closed, timeout)
+            if self._seq > last_seq:
+                return self._seq, self._item
+            return last_seq, None
+
+    def peek(self):
+        '''
+        Get the most recent item of the slot without waiting.
+
+        :return The `sequence number` and the `item` (`None` if empty).
+        '''
+        with self._condition:
+            return self._seq, self._item
+
+    def clear(self):
+        '''
+        Remove the item of the slot (without changing the sequence number).
+        '''
+        with self._condition:
+            self._item = None
+
+    def close(self):
+        '''
+        Close the slot, waking up all the consumers waiting for an item.
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def reopen(self):
+        '''
+        Open again a closed slot, empty (the sequence numbers keep growing, so
+        the consumers can keep waiting for the items newer than the last one
+        they have seen).
+        '''
+        with self._condition:
+            self._item = None
+            self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+class FrameBroadcaster(object):
+    '''
+    Creates a FrameBroadcaster object, which produces each frame (e.g. each
+    annotated JPEG of the video stream) exactly once, on its own thread, and
+    fans out the same frame to all the subscribers. Each subscriber gets the
+    most recent frame when it is ready for a new one, so the slow subscribers
+    skip frames instead of slowing down the others. Frames are only produced
+    while there is at least one subscriber.
+
+    :param `produce`: function returning the next frame, waiting for it if
+    needed. It raises a `ValueError` when no more frames can be produced (the
+    current subscribers are ended, and the next subscriber starts producing
+    the frames again).\n
+    :param `start`: function called each time the frames start being
+    produced, e.g. to (re)start the source of the frames once it has ended
+    (default: `None`).\n
+    '''
+
+    def __init__(self, produce, start=None):
+        self.produce = produce
+        self.start = start
+        self.frames = LatestSlot()
+        self._condition = threading.Condition()
+        self._subscribers = 0
+        self._thread = None
+
+    @property
+    def subscribers(self):
+        return self._subscribers
+
+    def _run(self):
+        # Produce the frames while there are subscribers
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._subscribers > 0)
+            try:
+                frame = self.produce()
+            except ValueError as error:
+                print(error)
+                break
+            self.frames.put(frame)
+        # End the current subscribers, and let the next one start a new thread
+        with self._condition:
+            self.frames.close()
+            self._thread = None
+
+    def subscribe(self):
+        '''
+        Subscribe to the frames, starting to produce them if needed.
+
+        :return A `generator` of the frames, until no more frames can be
+        produced or the generator is closed.
+        '''
+        with self._condition:
+            if self._thread is None:
+                if self.frames.closed:
+                    self.frames = LatestSlot()
+                if self.start is not None:
+                    self.start()
+                self._thread = threading.Thread(name="Broadcaster",
+                    target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._subscribers += 1
+            self._condition.notify_all()
+            frames = self.frames
+        try:
+            seq = 0
+            while True:
+                seq, frame = frames.get(seq, timeout=1)
+                if frame is None:
+                    if frames.closed:
+                        return
+                    continue
+                yield frame
+        finally:
+            with self._condition:
+                self._subscribers -= 1
@@ -0,0 +1,241 @@
+'''
+Sources of frames for the video pipeline: the camera, or a replay of a video
+file, of a folder of images or of synthetic frames, so the recognition can be
+run and timed without a physical camera (e.g. by `benchPipeline.py`).
+
+Every source has the interface of `cv2.VideoCapture` used by the pipeline:
+`read()`, returning `(grabbed, frame)`, and `release()`. The replayed sources
+are played either at a fixed rate (frames per second) or free-running (as
+fast as they are read).
+'''
+
+# Import the necessary packages
+import os
+import time
+import cv2
+import numpy as np
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+class FrameSource(object):
+    '''
+    Base class of the replayed sources, pacing the frames.
+
+    :param `rate`: frames per second (default: `None`, free-running).\n
+    :param `loop`: whether or not to start over at the end of the source
+    (default: `False`).\n
+    '''
+    finished = False    # Whether or not the source has no more frames
+
+    def __init__(self, rate=None, loop=False):
+        self.rate = rate
+        self.loop = loop
+        self.count = 0          # Number of frames read
+        self._next = None       # Time when the next frame is due
+
+    def _pace(self):
+        # Wait until the next frame is due, keeping a fixed rate (the delays
+        # don't accumulate)
+        if not self.rate:
+            return
+        now = time.monotonic()
+        if self._next is None:
+            self._next = now
+        elif self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(self._next, now - 1.0 / self.rate) + 1.0 / self.rate
+
+    def _next_frame(self):
+        # Return the next frame of the source, or None at its end
+        raise NotImplementedError
+
+    def _rewind(self):
+        # Go back to the start of the source
+        raise NotImplementedError
+
+    def read(self):
+        '''
+        Read the next frame, waiting for it if the source has a fixed rate.
+
+        :return Whether or not the frame was `grabbed`, and the `frame`.
+        '''
+        if self.finished:
+            return False, None
+        self._pace()
+        frame = self._next_frame()
+        if frame is None and self.loop and self.count > 0:
+            self._rewind()
+            frame = self._next_frame()
+        if frame is None:
+            self.finished = True
+            return False, None
+        self.count += 1
+        return True, frame
+
+    def release(self):
+        '''
+        Release the resources of the source.
+        '''
+        self.finished = True
+
+
+class CameraSource(object):
+    '''
+    Creates a CameraSource object, reading the frames of a camera.
+
+    :param `index`: index of the camera device (default: `0`).\n
+    '''
+    finished = False
+
+    def __init__(self, index=0):
+        self.capture = cv2.VideoCapture(index)
+
+    def read(self):
+        return self.capture.read()
+
+    def release(self):
+        self.capture.release()
+
+
+class VideoFileSource(FrameSource):
+    '''
+    Creates a VideoFileSource object, replaying a video file.
+
+    :param `path`: path to the video file.\n
+    :param `rate`: frames per second (default: `None`, free-running).\n
+    :param `loop`: whether or not to start over at the end of the video
+    (default: `False`).\n
+    '''
+
+    def __init__(self, path, rate=None, loop=False):
+        super(VideoFileSource, self).__init__(rate, loop)
+        if not os.path.isfile(path):
+            raise IOError("[ERROR] video file '%s' not found" % path)
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+
+    def _next_frame(self):
+        (grabbed, frame) = self.capture.read()
+        return frame if grabbed else None
+
+    def _rewind(self):
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def release(self):
+        super(VideoFileSource, self).release()
+        self.capture.release()
+
+
+class ImageFolderSource(FrameSource):
+    '''
+    Creates an ImageFolderSource object, replaying the images of a folder (in
+    order of file name) as a video.
+
+    :param `path`: path to the folder of images.\n
+    :param `rate`: frames per second (default: `None`, free-running).\n
+    :param `loop`: whether or not to start over after the last image (default:
+    `False`).\n
+    '''
+
+    def __init__(self, path, rate=None, loop=False):
+        super(ImageFolderSource, self).__init__(rate, loop)
+        self.paths = sorted(os.path.join(path, name)
+            for name in os.listdir(path)
+            if name.lower().endswith(IMAGE_EXTENSIONS))
+        if not self.paths:
+            raise IOError("[ERROR] no images found in folder '%s'" % path)
+        self.position = 0
+
+    def _next_frame(self):
+        while self.position < len(self.paths):
+            frame = cv2.imread(self.paths[self.position])
+            self.position += 1
+            if frame is not None:
+                return frame
+        return None
+
+    def _rewind(self):
+        self.position = 0
+
+
+class SyntheticSource(FrameSource):
+    '''
+    Creates a SyntheticSource object, generating frames deterministically: a
+    noisy background with, optionally, face images moving across it (e.g.
+    the images of a subject of the dataset).
+
+    :param `width`, `height`: size of the frames (default: `640` x `480`).\n
+    :param `faces`: list of BGR face images pasted on the frames, one after
+    the other (default: `None`, no faces).\n
+    :param `count`: number of frames generated (default: `None`, endless).\n
+    :param `rate`: frames per second (default: `None`, free-running).\n
+    :param `seed`: seed of the random noise (default: `0`).\n
+    '''
+
+    def __init__(self, width=640, height=480, faces=None, count=None,
+        rate=None, seed=0):
+        super(SyntheticSource, self).__init__(rate, loop=False)
+        self.width = width
+        self.height = height
+        self.faces = [self._fit(face) for face in (faces or [])]
+        self.total = count
+        self.seed = seed
+        # A few noisy versions of the same background, generated once
+        random = np.random.RandomState(seed)
+        background = random.randint(0, 256, (height, width, 3))
+        self.backgrounds = [np.clip(background + random.randint(-8, 9,
+            background.shape), 0, 255).astype(np.uint8) for _ in range(4)]
+
+    def _fit(self, face):
+        # Scale the face image to half the height of the frames, at most
+        scale = min(1.0, self.height / 2.0 / face.shape[0],
+            self.width / 2.0 / face.shape[1])
+        if scale < 1.0:
+            face = cv2.resize(face, (int(face.shape[1] * scale),
+                int(face.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        return face
+
+    def _next_frame(self):
+        if self.total is not None and self.count >= self.total:
+            return None
+        index = self.count
+        frame = self.backgrounds[index % len(self.backgrounds)].copy()
+        if self.faces:
+            # Each face stays for 30 frames, sliding slowly from left to right
+            face = self.faces[(index // 30) % len(self.faces)]
+            (height, width) = face.shape[:2]
+            span = max(1, self.width - width)
+            left = int(span * ((index % 30) / 30.0) * 0.5 + span * 0.25)
+            top = (self.height - height) // 2
+            frame[top:top + height, left:left + width] = face
+        return frame
+
+    def _rewind(self):
+        self.count = 0
+
+
+def open_source(spec, rate=None, loop=False):
+    '''
+    Open a source of frames from its description.
+
+    :param `spec`: index of a camera (e.g. `0`), `'synthetic'`, path to a
+    folder of images, path to a video file, or a source object (returned as
+    it is).\n
+    :param `rate`: frames per second of the replayed sources (default:
+    `None`, free-running).\n
+    :param `loop`: whether or not to start over at the end of the replayed
+    sources (default: `False`).\n
+    :return The `source` object.
+    '''
+    if hasattr(spec, "read"):
+        return spec
+    spec = str(spec)
+    if spec.isdigit():
+        return CameraSource(int(spec))
+    if spec == "synthetic":
+        return SyntheticSource(rate=rate)
+    if os.path.isdir(spec):
+        return ImageFolderSource(spec, rate, loop)
+    return VideoFileSource(spec, rate, loop)
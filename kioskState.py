@@ -0,0 +1,115 @@
+'''
+State of the kiosk (the screen at the door), as explicit transitions:
+
+    waiting -> card accepted -> recognizing -> granted / refused -> waiting
+    waiting -> refused (card not accepted) -> waiting
+
+Each transition is passed once to a callback (e.g. to push it to the clients
+over socket.io) at the moment it happens, instead of broadcasting the message
+periodically. The result of an attempt (granted or refused) is shown for a few
+seconds, then the kiosk goes back to waiting by itself.
+'''
+
+# Import the necessary packages
+import threading
+import time
+
+
+# States of the kiosk
+WAITING = "waiting"
+CARD_ACCEPTED = "card_accepted"
+RECOGNIZING = "recognizing"
+GRANTED = "granted"
+REFUSED = "refused"
+STATES = (WAITING, CARD_ACCEPTED, RECOGNIZING, GRANTED, REFUSED)
+
+
+def message(state, name="", reason=""):
+    '''
+    Message shown on the kiosk for a state.
+
+    :param `state`: the state of the kiosk.\n
+    :param `name`: name of the owner of the card swiped (default: `''`).\n
+    :param `reason`: reason of a refusal (default: `''`).\n
+    :return The `message` (HTML).
+    '''
+    if state == CARD_ACCEPTED:
+        return f"Hello {name}!<br/>Please now place yourself in front of "\
+            "the camera for face recognition."
+    if state == RECOGNIZING:
+        return f"Hello {name}!<br/>Recognizing... please look at the camera."
+    if state == GRANTED:
+        return f"Access granted.<br/>Welcome {name}!"
+    if state == REFUSED:
+        return "Access refused" + (f" ({reason})." if reason else ".")
+    return "Waiting for user..."
+
+
+class KioskState(object):
+    '''
+    Creates a KioskState object, in the waiting state.
+
+    :param `on_change`: function called with the new state (see `current`)
+    on each transition (default: `None`).\n
+    :param `hold`: number of seconds the result of an attempt is shown before
+    going back to waiting (default: `3`).\n
+    '''
+
+    def __init__(self, on_change=None, hold=3.0):
+        self.on_change = on_change
+        self.hold = hold
+        self.lock = threading.RLock()
+        self.transitions = 0    # Number of transitions (to expire the holds)
+        self.state = None
+        self.set(WAITING)
+
+    def set(self, state, name="", reason=""):
+        '''
+        Make a transition to a new state. Nothing is emitted if the state
+        (and its data) doesn't change.
+
+        :param `state`: the new state.\n
+        :param `name`: name of the owner of the card swiped (default: `''`).\n
+        :param `reason`: reason of a refusal (default: `''`).\n
+        :return Whether or not the state `changed`.
+        '''
+        if state not in STATES:
+            raise ValueError("[ERROR] unknown kiosk state '%s'" % state)
+        with self.lock:
+            if self.state is not None and (state, name, reason) == (
+                self.state["state"], self.state["name"],
+                self.state["reason"]):
+                return False
+            self.transitions += 1
+            self.state = {"state": state, "name": name, "reason": reason,
+                "message": message(state, name, reason), "since": time.time()}
+            # Emitted while holding the lock, so the clients get the
+            # transitions in order
+            if self.on_change is not None:
+                try:
+                    self.on_change(self.current())
+                except Exception as e:
+                    print("[WARNING] unable to emit the kiosk state: %s" % e)
+            if state in (GRANTED, REFUSED) and self.hold > 0:
+                timer = threading.Timer(self.hold, self._expire,
+                    args=(self.transitions,))
+                timer.daemon = True
+                timer.start()
+        return True
+
+    def _expire(self, transitions):
+        # Go back to waiting, unless there has been another transition since
+        # the result was shown
+        with self.lock:
+            if transitions == self.transitions:
+                self.set(WAITING)
+
+    def current(self):
+        '''
+        Current state of the kiosk (e.g. for the clients that connect).
+
+        :return The state `dictionary`: `state`, `name`, `reason`, `message`
+        and `since` (time of the transition).
+        '''
+        with self.lock:
+            return dict(self.state)
@@ -0,0 +1,215 @@
+'''
+Lightweight metrics (counters and histograms) for the hot path of the video
+pipeline, rendered in the Prometheus text format (served by faceSec on
+'/metrics').
+
+Recording a value only takes a lock and a few additions, so the metrics can be
+left on in production.
+
+Usage example:
+    detect_seconds = metrics.histogram("facesec_stage_seconds",
+        "Latency of each stage of the processing of a frame", stage="detect")
+    with metrics.Timer(detect_seconds):
+        face_recognition.face_locations(rgb)
+'''
+
+# Import the necessary packages
+import bisect
+import threading
+import time
+
+
+# Default buckets (in seconds) of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0)
+
+registry = []       # List of all the metrics created, in order of creation
+
+
+def _labels(labels):
+    # Format the labels of a metric as '{name="value",...}'
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, value)
+        for (key, value) in sorted(labels.items()))
+
+
+class Counter(object):
+    '''
+    Creates a Counter object: a value that only goes up.
+
+    :param `name`: name of the metric.\n
+    :param `help`: description of the metric.\n
+    :param `labels`: labels of the metric.\n
+    '''
+    kind = "counter"
+
+    def __init__(self, name, help, **labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        '''
+        Increment the counter.
+
+        :param `amount`: amount to add (default: `1`).
+        '''
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        # Lines of the metric in the text format
+        return ["%s%s %s" % (self.name, _labels(self.labels), self.value)]
+
+
+class Histogram(object):
+    '''
+    Creates a Histogram object, counting the observed values in buckets.
+
+    :param `name`: name of the metric.\n
+    :param `help`: description of the metric.\n
+    :param `buckets`: upper bounds of the buckets (default: latency buckets,
+    from 1 ms to 5 s).\n
+    :param `labels`: labels of the metric.\n
+    '''
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        '''
+        Record a value.
+
+        :param `value`: the observed value.
+        '''
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        '''
+        Copy of the current state of the histogram (e.g. to compute the
+        values observed during a benchmark, see `quantile`).
+
+        :return The `counts` of each bucket, the `sum` and the `count`.
+        '''
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def samples(self):
+        # Lines of the metric in the text format (cumulative buckets)
+        counts, total, count = self.snapshot()
+        lines = []
+        cumulative = 0
+        for (bound, bucket_count) in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            labels = dict(self.labels, le=bound)
+            lines.append("%s_bucket%s %s" % (self.name, _labels(labels),
+                cumulative))
+        lines.append("%s_sum%s %s" % (self.name, _labels(self.labels), total))
+        lines.append("%s_count%s %s" % (self.name, _labels(self.labels), count))
+        return lines
+
+
+class Timer(object):
+    '''
+    Creates a Timer object: a context manager recording the time spent in
+    its block into a histogram.
+
+    :param `histogram`: the Histogram object.\n
+    '''
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def counter(name, help, **labels):
+    '''
+    Create a counter and add it to the registry.
+
+    :return The `Counter` object.
+    '''
+    metric = Counter(name, help, **labels)
+    registry.append(metric)
+    return metric
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    '''
+    Create a histogram and add it to the registry.
+
+    :return The `Histogram` object.
+    '''
+    metric = Histogram(name, help, buckets, **labels)
+    registry.append(metric)
+    return metric
+
+
+def quantile(buckets, counts, q):
+    '''
+    Estimate a quantile from the counts of the buckets of a histogram,
+    interpolating linearly inside the bucket.
+
+    :param `buckets`: upper bounds of the buckets.\n
+    :param `counts`: number of values of each bucket (plus the overflow
+    bucket).\n
+    :param `q`: the quantile (between 0 and 1).\n
+    :return The estimated `value` (`None` if there aren't values, the
+    largest bound if it falls in the overflow bucket).
+    '''
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = q * total
+    cumulative = 0
+    for (index, count) in enumerate(counts):
+        if count and cumulative + count >= rank:
+            if index == len(buckets):
+                return buckets[-1]
+            lower = buckets[index - 1] if index > 0 else 0.0
+            return lower + (buckets[index] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+def render():
+    '''
+    Render all the metrics of the registry in the Prometheus text format.
+
+    :return The `text` of the metrics.
+    '''
+    lines = []
+    names = []
+    for metric in registry:
+        if metric.name not in names:
+            names.append(metric.name)
+    # The samples of the metrics with the same name (and different labels)
+    # must be together, after a single description
+    for name in names:
+        group = [metric for metric in registry if metric.name == name]
+        lines.append("# HELP %s %s" % (name, group[0].help))
+        lines.append("# TYPE %s %s" % (name, group[0].kind))
+        for metric in group:
+            lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,84 @@
+'''
+Cheap motion detection, to skip the face detection on the static frames of
+the video stream (e.g. the empty hallway before the person steps up).
+
+Each frame is downsampled, converted to gray and blurred, and compared with a
+running average of the previous frames (the background). A frame is worth
+processing if enough of its pixels have changed, and a few more frames are let
+through after the last motion, so a person who stops in front of the camera is
+still processed.
+'''
+
+# Import the necessary packages
+import cv2
+import numpy as np
+
+
+class MotionGate(object):
+    '''
+    Creates a MotionGate object.
+
+    :param `sensitivity`: min fraction of the pixels that must change for a
+    frame to have motion (default: `0.005`).\n
+    :param `threshold`: min difference of gray level for a pixel to be
+    considered changed (default: `25`).\n
+    :param `width`: width of the downsampled frames (default: `80`).\n
+    :param `learning_rate`: weight of each new frame in the running average of
+    the background (default: `0.05`).\n
+    :param `hold`: number of frames let through after the last frame with
+    motion (default: `5`).\n
+    '''
+
+    def __init__(self, sensitivity=0.005, threshold=25, width=80,
+        learning_rate=0.05, hold=5):
+        self.sensitivity = sensitivity
+        self.threshold = threshold
+        self.width = width
+        self.learning_rate = learning_rate
+        self.hold = hold
+        self.passed = 0     # Number of frames let through
+        self.skipped = 0    # Number of frames skipped (without motion)
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the background (e.g. between recognition sessions). The
+        counters are kept.
+        '''
+        self.background = None
+        self.holding = 0
+
+    def check(self, frame, force=False):
+        '''
+        Check whether or not a frame is worth processing, and update the
+        background with it.
+
+        :param `frame`: the BGR frame.\n
+        :param `force`: let the frame through, whether or not it has motion
+        (default: `False`).\n
+        :return `True` if the frame has motion (or it is forced), `False` if
+        it can be skipped.
+        '''
+        height = max(1, int(frame.shape[0] * self.width / frame.shape[1]))
+        gray = cv2.resize(frame, (self.width, height),
+            interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (5, 5), 0).astype(np.float32)
+
+        if self.background is None:
+            # First frame: nothing to compare it with
+            self.background = gray
+            self.holding = self.hold
+        else:
+            diff = cv2.absdiff(gray, self.background)
+            changed = np.count_nonzero(diff > self.threshold) / float(diff.size)
+            cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+            if changed >= self.sensitivity:
+                self.holding = self.hold
+
+        if force or self.holding > 0:
+            self.holding = max(0, self.holding - 1)
+            self.passed += 1
+            return True
+        self.skipped += 1
+        return False
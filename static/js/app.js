@@ -1,21 +1,49 @@
 $(document).ready(function(){
-    // Display the default welcome message on page load
-    window.onload = function(){
-        $('#welcome').html("<p>Waiting for user...</p>");
-    };
-
     // Connect to the socket server
     var socket = io.connect('https://' + document.domain + ':' + location.port, {secure: true});
     var connect_error_counter = 0;
-    // Receive new welcome message from server
+    // Receive the state of the kiosk from the server: the current one on
+    // connection, then each transition (waiting, card accepted, recognizing,
+    // granted or refused) when it happens
     socket.on('newMessage', function(msg) {
-        console.log("Welcome message = '" +msg.message+ "'");
+        console.log("Kiosk state = '" + msg.state + "'");
         // Update the welcome message to be displayed
         welcome_message = "<p>" + msg.message.toString() + "</p>"
-        $('#welcome').html(welcome_message);
-        // socket.emit('newMessage');
+        $('#welcome').html(welcome_message).attr('class', msg.state);
+    });
+    // Receive the status of the encodings update jobs (admin page only)
+    socket.on('jobStatus', function(status) {
+        $('#jobSchedule').text(status.next.length ?
+            "Next encodings update: " + status.next[0].at :
+            "Encodings update process stopped");
+        var job = status.current;
+        if (job) {
+            var progress = job.total ? " (" + job.done + "/" + job.total +
+                " images)" : "";
+            $('#jobCurrent').text("Running: " + job.name + progress + ", " +
+                job.duration + "s");
+            $('#jobProgress').attr({value: job.done, max: job.total || 1})
+                .prop('hidden', false);
+        } else {
+            $('#jobCurrent').text(status.queued.length ? "Queued: " +
+                status.queued.map(function(job) { return job.name; })
+                .join(", ") : "No encodings update running");
+            $('#jobProgress').prop('hidden', true);
+        }
+        job = status.last;
+        if (job) {
+            $('#jobLast').text("Last: " + job.name + " " + job.status +
+                " on " + job.finished + " in " + job.duration + "s" +
+                (job.error ? " (" + job.error + ")" : ""));
+        }
+    });
+    // Ask for the status on each (re)connection, so the admin page is
+    // subscribed to the next updates
+    socket.on('connect', function() {
+        if ($('#jobStatus').length) {
+            socket.emit('jobStatus');
+        }
     });
-    socket.emit('newMessage');
     socket.on('connect_error', function(err) {
         // If there are 3 connection errors to the server, close the
         // socket
@@ -0,0 +1,137 @@
+'''
+Tests of the video pipeline: the clients of the video stream disconnecting
+and reconnecting, and the camera restarted when its capture has ended.
+
+Usage example:
+    python -m unittest tests.test_framePipeline
+'''
+
+# Import the necessary packages
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+import encodingStore
+import framePipeline
+
+try:
+    import faceRecon
+except ImportError:
+    faceRecon = None
+
+
+class FlakyCamera(object):
+    # Camera disconnected after `count` frames, until it's released and
+    # opened again (it has the interface of the sources of frameSource)
+    finished = False
+
+    def __init__(self, count):
+        self.count = count
+        self.read_count = 0
+        self.released = 0
+
+    def read(self):
+        if self.read_count >= self.count:
+            return False, None
+        self.read_count += 1
+        time.sleep(0.01)
+        return True, np.zeros((48, 64, 3), dtype=np.uint8)
+
+    def release(self):
+        self.released += 1
+        self.read_count = 0
+
+
+class FrameBroadcasterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.produced = 0
+        self.started = 0
+        self.broadcaster = framePipeline.FrameBroadcaster(self.produce,
+            start=self.start)
+
+    def produce(self):
+        time.sleep(0.01)
+        self.produced += 1
+        return self.produced
+
+    def start(self):
+        self.started += 1
+
+    def wait_idle(self):
+        # Wait for the broadcaster to notice that it has no subscribers
+        deadline = time.time() + 2
+        while self.broadcaster.subscribers and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_reconnect(self):
+        # A client disconnecting (closing its stream) stops the production of
+        # the frames, and the next client gets new frames
+        frames = self.broadcaster.subscribe()
+        first = [next(frames) for _ in range(3)]
+        frames.close()
+        self.wait_idle()
+        self.assertEqual(self.broadcaster.subscribers, 0)
+        produced = self.produced
+        time.sleep(0.1)
+        self.assertLessEqual(self.produced, produced + 1)
+
+        frames = self.broadcaster.subscribe()
+        self.assertGreater(next(frames), first[-1])
+        frames.close()
+        self.assertEqual(self.started, 1)
+
+    def test_restart_after_end(self):
+        # Once the frames can't be produced anymore, the current clients are
+        # ended, and the next client starts producing them again
+        def produce():
+            if self.produced >= 3:
+                raise ValueError("[ERROR] no more frames")
+            return self.produce()
+        self.broadcaster.produce = produce
+        self.assertEqual(list(self.broadcaster.subscribe())[-1:], [3])
+        self.assertEqual(self.started, 1)
+
+        self.produced = 0
+        frames = self.broadcaster.subscribe()
+        self.assertEqual(next(frames), 1)
+        frames.close()
+        self.assertEqual(self.started, 2)
+
+
+@unittest.skipIf(faceRecon is None, "the face recognition isn't installed")
+class VideoCameraReconnectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.encodings = os.path.join(self.folder, "encodings.bin")
+        encodingStore.save(self.encodings, np.zeros((1, 128)),
+            ["000000001_Test_Subject"])
+        self.camera = FlakyCamera(5)
+        self.videoCamera = faceRecon.VideoCamera(
+            os.path.join(self.folder, "unknown"), self.encodings, "hog",
+            source=self.camera, watch_interval=0)
+        self.broadcaster = framePipeline.FrameBroadcaster(
+            self.videoCamera.get_frame, start=self.videoCamera.start)
+
+    def tearDown(self):
+        self.videoCamera.stop()
+        shutil.rmtree(self.folder)
+
+    def test_reconnect_after_disconnection(self):
+        # The camera is disconnected while a client is watching the video
+        # stream: its stream ends, and a new client restarts the camera
+        frames = list(self.broadcaster.subscribe())
+        self.assertTrue(frames)
+        self.assertFalse(self.videoCamera.running)
+
+        frames = self.broadcaster.subscribe()
+        self.assertTrue(next(frames).startswith(b"\xff\xd8"))
+        frames.close()
+        self.assertEqual(self.camera.released, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()